@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ResourceHub.settings')
 
 application = get_asgi_application()
+
+# Compile every template now instead of in each worker's first requests
+from myapp.template_backends import warm_templates  # noqa: E402
+
+warm_templates()
@@ -0,0 +1,47 @@
+"""
+Environment-driven cache configuration.
+
+    CACHE_BACKEND    sqlite (default), shm, file, redis, locmem or dummy
+    CACHE_LOCATION   file/directory path or redis:// URL (defaults below)
+    CACHE_TIMEOUT    default entry lifetime in seconds (default 300)
+
+`sqlite`, `shm` and `file` are shared by all worker processes on one host:
+`shm` is the file backend placed in /dev/shm (RAM), `sqlite` a single SQLite
+file (myapp/cache_backends.py). `redis` needs the redis package.
+"""
+import os
+
+BACKENDS = {
+    'sqlite': 'myapp.cache_backends.SQLiteCache',
+    'shm': 'django.core.cache.backends.filebased.FileBasedCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'dummy': 'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+def cache_config(base_dir, env=os.environ):
+    """Build the CACHES['default'] entry from environment variables"""
+    backend = env.get('CACHE_BACKEND', 'sqlite').lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unsupported CACHE_BACKEND {backend!r}; use one of {', '.join(BACKENDS)}")
+
+    default_locations = {
+        'sqlite': str(base_dir / 'cache.sqlite3'),
+        'shm': '/dev/shm/resourcehub-cache',
+        'file': str(base_dir / 'cache'),
+        'redis': 'redis://127.0.0.1:6379/1',
+        'locmem': 'resourcehub',
+        'dummy': '',
+    }
+    config = {
+        'BACKEND': BACKENDS[backend],
+        'LOCATION': env.get('CACHE_LOCATION', default_locations[backend]),
+        'TIMEOUT': int(env.get('CACHE_TIMEOUT', 300)),
+        'KEY_PREFIX': 'resourcehub',
+    }
+    if backend != 'redis':
+        # Redis evicts on its own (maxmemory); its OPTIONS go to the client instead
+        config['OPTIONS'] = {'MAX_ENTRIES': 50000}
+    return config
@@ -0,0 +1,104 @@
+"""
+Environment-driven database configuration.
+
+    DB_ENGINE            sqlite (default) or postgresql
+    DB_NAME              database name, or the file path for SQLite (default: BASE_DIR/db.sqlite3)
+    DB_TEST_NAME         name (or file) of the database created by `manage.py test`
+
+A read replica is configured the same way with the DB_REPLICA_ prefix
+(DB_REPLICA_NAME, DB_REPLICA_HOST, ...); its engine defaults to DB_ENGINE.
+
+SQLite:
+    DB_BUSY_TIMEOUT_MS   how long a writer waits for the lock before "database is locked" (default 5000)
+    DB_SQLITE_MMAP_SIZE  bytes of the file to memory-map for reads (default 256 MiB)
+    DB_SQLITE_TUNING     set to 0 to connect without the pragmas below, e.g. to compare
+
+journal_mode=WAL is stored in the database file itself: the first tuned
+connection converts it, and it stays in WAL mode. This includes the sample
+db.sqlite3 checked into the repository, which git then lists as modified;
+run against a copy (DB_NAME) or with DB_SQLITE_TUNING=0 to keep it untouched.
+
+PostgreSQL:
+    DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
+    DB_CONN_MAX_AGE      seconds to keep a connection open between requests (default 60)
+    DB_POOL_MAX_SIZE     use a psycopg 3 connection pool of this size instead of persistent connections
+    DB_POOL_MIN_SIZE     connections the pool keeps open when idle (default 2)
+"""
+import os
+
+
+def _setting(env, prefix, name, default=None):
+    return env.get(f'{prefix}{name}', default)
+
+
+def sqlite_config(name, env=os.environ, prefix='DB_'):
+    busy_timeout_ms = int(_setting(env, prefix, 'BUSY_TIMEOUT_MS', 5000))
+    config = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name,
+        'OPTIONS': {
+            # Python-level wait for the write lock, in seconds
+            'timeout': busy_timeout_ms / 1000,
+        },
+    }
+    if _setting(env, prefix, 'SQLITE_TUNING', '1') == '0':
+        return config
+
+    mmap_size = int(_setting(env, prefix, 'SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    config['OPTIONS'].update({
+        # Run on every new connection. WAL lets readers continue while one writer commits,
+        # and synchronous=NORMAL is durable across application crashes in WAL mode.
+        'init_command': ';'.join([
+            'PRAGMA journal_mode=WAL',
+            f'PRAGMA busy_timeout={busy_timeout_ms}',
+            'PRAGMA synchronous=NORMAL',
+            f'PRAGMA mmap_size={mmap_size}',
+            'PRAGMA temp_store=MEMORY',
+        ]),
+        # Take the write lock at BEGIN, so a transaction that reads and then writes
+        # waits for busy_timeout instead of failing on lock upgrade
+        'transaction_mode': 'IMMEDIATE',
+    })
+    return config
+
+
+def postgresql_config(env=os.environ, prefix='DB_'):
+    config = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': _setting(env, prefix, 'NAME', 'resourcehub'),
+        'USER': _setting(env, prefix, 'USER', ''),
+        'PASSWORD': _setting(env, prefix, 'PASSWORD', ''),
+        'HOST': _setting(env, prefix, 'HOST', ''),
+        'PORT': _setting(env, prefix, 'PORT', ''),
+        'CONN_MAX_AGE': int(_setting(env, prefix, 'CONN_MAX_AGE', 60)),
+        # Check a reused connection is still alive before the first query of a request
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {},
+    }
+
+    pool_max_size = _setting(env, prefix, 'POOL_MAX_SIZE')
+    if pool_max_size:
+        # Django does not allow persistent connections together with a pool
+        config['CONN_MAX_AGE'] = 0
+        config['OPTIONS']['pool'] = {
+            'min_size': int(_setting(env, prefix, 'POOL_MIN_SIZE', 2)),
+            'max_size': int(pool_max_size),
+            'timeout': 10,
+        }
+    return config
+
+
+def database_config(base_dir, env=os.environ, prefix='DB_'):
+    """Build one DATABASES entry from environment variables"""
+    engine = _setting(env, prefix, 'ENGINE', env.get('DB_ENGINE', 'sqlite')).lower()
+    if engine in ('postgres', 'postgresql'):
+        config = postgresql_config(env, prefix)
+    elif engine in ('sqlite', 'sqlite3'):
+        config = sqlite_config(_setting(env, prefix, 'NAME', base_dir / 'db.sqlite3'), env, prefix)
+    else:
+        raise ValueError(f"Unsupported {prefix}ENGINE {engine!r}; use 'sqlite' or 'postgresql'")
+
+    test_name = _setting(env, prefix, 'TEST_NAME')
+    if test_name:
+        config['TEST'] = {'NAME': test_name}
+    return config
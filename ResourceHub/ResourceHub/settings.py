@@ -10,11 +10,19 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 
+from .caches import cache_config
+from .database import database_config
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Running the test suite (`manage.py test`)
+TESTING = sys.argv[1:2] == ['test']
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/6.0/howto/deployment/checklist/
@@ -41,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'myapp.middleware.QueryInstrumentationMiddleware',
+    'myapp.middleware.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,15 +64,23 @@ ROOT_URLCONF = 'ResourceHub.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
-        'DIRS': ['templates'],
-        'APP_DIRS': True,
+        'BACKEND': 'myapp.template_backends.InstrumentedDjangoTemplates',
+        'DIRS': [BASE_DIR / 'templates'],
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
+            # Each process parses a template once and keeps it compiled in memory; runserver's
+            # autoreloader empties the cache when a template changes. The WSGI/ASGI entry points
+            # compile every template at startup (myapp.template_backends.warm_templates).
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
         },
     },
 ]
@@ -73,13 +91,53 @@ WSGI_APPLICATION = 'ResourceHub.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
+# Configured from DB_* environment variables, see ResourceHub/database.py
+# (SQLite with WAL tuning by default, PostgreSQL with persistent or pooled connections)
+
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': database_config(BASE_DIR),
+}
+
+# Optional read replica (DB_REPLICA_* variables). GET requests read from it unless the
+# visitor wrote something in the last REPLICA_PIN_SECONDS (see myapp/routers.py).
+if os.environ.get('DB_REPLICA_NAME') or os.environ.get('DB_REPLICA_HOST'):
+    DATABASES['replica'] = database_config(BASE_DIR, prefix='DB_REPLICA_')
+elif TESTING:
+    # The routing tests need a replica; the test run gets a second SQLite database
+    # (in memory, unless DB_REPLICA_TEST_NAME names a file)
+    DATABASES['replica'] = database_config(BASE_DIR, env={
+        'DB_NAME': str(BASE_DIR / 'replica.sqlite3'), 'DB_TEST_NAME': os.environ.get('DB_REPLICA_TEST_NAME', ''),
+    })
+
+DATABASE_ROUTERS = ['myapp.routers.ReplicaRouter']
+DATABASE_REPLICA_ALIAS = 'replica'
+REPLICA_PIN_SECONDS = 5
+
+
+# Cache
+# Configured from CACHE_* environment variables, see ResourceHub/caches.py
+# (a SQLite file shared by all worker processes by default)
+
+CACHES = {
+    'default': cache_config(BASE_DIR),
 }
+if TESTING and 'CACHE_BACKEND' not in os.environ:
+    # The test run gets an empty cache of its own instead of the developer's cache file
+    CACHES['default'] = cache_config(BASE_DIR, env={'CACHE_BACKEND': 'locmem', 'CACHE_LOCATION': 'resourcehub-tests'})
+
+# Sessions are read from the cache and written through to the database, so a visitor keeps
+# their login when the cache is cleared. The logged-in user's row is cached as well
+# (myapp/auth_backends.py), so authenticated requests spend no queries on who is asking.
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+AUTHENTICATION_BACKENDS = ['myapp.auth_backends.CachedModelBackend']
+AUTH_USER_CACHE_TIMEOUT = 300
+
 
+# Request metrics: query counts and timings per view (see myapp/metrics.py).
+# SERVER_TIMING adds them to every response as a Server-Timing header, which tells anyone
+# how long queries take, so it is only on by default with DEBUG (SERVER_TIMING=1/0 overrides).
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '1' if DEBUG else '0') == '1'
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -117,11 +175,31 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']
+# `manage.py collectstatic` writes hashed, precompressed copies here (see myapp/storage.py)
+STATIC_ROOT = BASE_DIR / 'staticfiles'
 
 # Media files (User uploads)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploads are stored under their content hash (see myapp/storage.py)
+STORAGES = {
+    'default': {
+        'BACKEND': 'myapp.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'myapp.storage.CompressedManifestStaticFilesStorage',
+    },
+}
+
+# Let the front-end server send media files: None, 'X-Accel-Redirect' (nginx) or 'X-Sendfile'
+MEDIA_SENDFILE_HEADER = None
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected'
+
+# Resized variants of uploaded images (see myapp/images.py)
+IMAGE_MAX_DIMENSION = 1600
+IMAGE_WORKERS = 2
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/6.0/ref/settings/#default-auto-field
 
@@ -131,3 +209,41 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_REDIRECT_URL = 'dashboard'
 LOGIN_URL = 'login'
 LOGOUT_REDIRECT_URL = 'home'
+
+# Messages: how many messages of a thread are loaded at a time
+CONVERSATION_PAGE_SIZE = 30
+
+# JSON API (myapp/api.py): rows per page of a collection, unless the client asks for ?limit=
+API_PAGE_SIZE = 25
+
+# Batched API requests (myapp/batch.py): sub-requests per batch, and threads its GETs are spread over
+API_BATCH_MAX_REQUESTS = 20
+API_BATCH_WORKERS = 4
+
+# Rate limits (myapp/ratelimit.py): requests per client (user, or IP address when logged out)
+# and scope, as 'count/period' with period s, m, h or d. The page polls for updates every 30s.
+RATE_LIMIT_ENABLED = True
+RATE_LIMITS = {
+    'updates': '20/m',
+    'map': '30/m',
+    'transfers': '10/m',
+    'conversations': '10/m',
+    'messages': '30/m',
+}
+
+# Message archival (manage.py archive_messages): messages older than this many days move
+# into compressed per-conversation segments of up to MESSAGE_ARCHIVE_SEGMENT_SIZE messages
+MESSAGE_ARCHIVE_AFTER_DAYS = 365
+MESSAGE_ARCHIVE_SEGMENT_SIZE = 500
+
+# Transactional outbox (myapp/outbox.py): notifications and confirmation messages of the
+# credit/borrow workflows are carried out by `manage.py drain_outbox --loop` in production.
+# In development they are drained right after each request's transaction commits instead.
+OUTBOX_DRAIN_ON_COMMIT = DEBUG
+
+# Events: how many weeks of upcoming occurrences are materialized for browsing
+EVENT_OCCURRENCE_WEEKS = 12
+
+# Analytics rollups (manage.py update_rollups): tool lending and event turnout can still change
+# after the day, so every run recomputes them for this many past days
+ROLLUP_RECOMPUTE_DAYS = 14
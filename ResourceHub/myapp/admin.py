@@ -1,15 +1,99 @@
 from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils import timezone
+from django.utils.functional import cached_property
+from .cache import bump_model
+from .outbox import enqueue_many
 from .models import (Profile, Skill, ServiceListing, Tool, Transaction, Event, 
-                     Review, ToolBorrow, Conversation, Message, Notification)
+                     Review, ToolBorrow, Conversation, Message, MessageArchiveSegment, Notification,
+                     OutboxEvent, DailyStat, RollupWatermark)
 
 # Register your models here.
 
+# Below this many rows an exact COUNT(*) is cheap enough
+ESTIMATE_COUNT_ABOVE = 10000
+
+def _estimated_rows(queryset):
+    """
+    Roughly how many rows the whole table holds, from the planner's statistics, without
+    counting them; None when the database keeps no statistic for the table
+    """
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+            row = cursor.fetchone()
+            # -1 until the table is first vacuumed or analyzed
+            return row[0] if row and row[0] >= 0 else None
+        if connection.vendor == 'sqlite':
+            # Written by ANALYZE (see analyze_table); the first number of an index's stat is the table's row count
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+            row = cursor.fetchone()
+            return int(row[0].split()[0]) if row else None
+    return None
+
+def analyze_table(model, using='default'):
+    """
+    Refresh SQLite's statistics of model's table after a bulk delete, so its changelist's
+    estimated count follows (PostgreSQL's autovacuum does this on its own)
+    """
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {connection.ops.quote_name(model._meta.db_table)}')
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Numbers the pages of an unfiltered changelist from the table's estimated size instead of
+    COUNT(*)-ing millions of rows on every page view. The last page may come up a little short.
+    """
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = _estimated_rows(self.object_list)
+            if estimate is not None and estimate > ESTIMATE_COUNT_ABOVE:
+                return estimate
+        return super().count
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelist settings for tables that grow to millions of rows: newest first by primary key
+    (an index scan), estimated page counts, no second COUNT(*) for "n of N selected", and
+    search by exact member username: search_fields written as '=<relation>__username' are
+    looked up through the Lower(username) index of migration 0015, as a LIKE over the table
+    would scan it all.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ['-id']
+    
+    def get_search_results(self, request, queryset, search_term):
+        fields = self.get_search_fields(request)
+        username = search_term.strip().lower()
+        if not username or not all(field.startswith('=') and field.endswith('__username') for field in fields):
+            return super().get_search_results(request, queryset, search_term)
+        members = User.objects.annotate(username_lower=Lower('username')).filter(username_lower=username).values('pk')
+        condition = Q()
+        for field in fields:
+            condition |= Q(**{f"{field[1:].removesuffix('__username')}__in": members})
+        return queryset.filter(condition), False
+
 @admin.register(Profile)
 class ProfileAdmin(admin.ModelAdmin):
     list_display = ['user', 'time_credits', 'location', 'is_available', 'created_at']
     list_filter = ['is_available', 'created_at']
     search_fields = ['user__username', 'location']
     readonly_fields = ['created_at']
+    list_select_related = ['user']
+    autocomplete_fields = ['user']
 
 @admin.register(Skill)
 class SkillAdmin(admin.ModelAdmin):
@@ -23,17 +107,28 @@ class ServiceListingAdmin(admin.ModelAdmin):
     search_fields = ['title', 'description', 'user__username']
     filter_horizontal = ['skills']
     readonly_fields = ['created_at']
+    list_select_related = ['user']
+    autocomplete_fields = ['user']
     
     actions = ['activate_listings', 'deactivate_listings']
     
+    def _set_active(self, queryset, is_active):
+        with transaction.atomic():
+            listing_ids = list(queryset.exclude(is_active=is_active).values_list('pk', flat=True))
+            ServiceListing.objects.filter(pk__in=listing_ids).update(is_active=is_active)
+            # update() sends no signals: queue the match rescores an edit would have (myapp/matching.py)
+            enqueue_many('rescore_listing', [{'listing_id': listing_id} for listing_id in listing_ids])
+        bump_model(ServiceListing)
+        return len(listing_ids)
+    
     def activate_listings(self, request, queryset):
-        queryset.update(is_active=True)
-        self.message_user(request, f"{queryset.count()} listings activated.")
+        count = self._set_active(queryset, True)
+        self.message_user(request, f"{count} listings activated.")
     activate_listings.short_description = "Activate selected listings"
     
     def deactivate_listings(self, request, queryset):
-        queryset.update(is_active=False)
-        self.message_user(request, f"{queryset.count()} listings deactivated.")
+        count = self._set_active(queryset, False)
+        self.message_user(request, f"{count} listings deactivated.")
     deactivate_listings.short_description = "Deactivate selected listings"
 
 @admin.register(Tool)
@@ -41,42 +136,79 @@ class ToolAdmin(admin.ModelAdmin):
     list_display = ['name', 'owner', 'is_available']
     list_filter = ['is_available']
     search_fields = ['name', 'description', 'owner__username']
+    list_select_related = ['owner']
+    autocomplete_fields = ['owner']
 
 @admin.register(Transaction)
-class TransactionAdmin(admin.ModelAdmin):
+class TransactionAdmin(LargeTableAdmin):
     list_display = ['sender', 'receiver', 'amount', 'timestamp', 'description']
     list_filter = ['timestamp']
-    search_fields = ['sender__username', 'receiver__username', 'description']
+    search_fields = ['=sender__username', '=receiver__username']
+    search_help_text = "Exact username of the sender or receiver"
     readonly_fields = ['timestamp']
-    date_hierarchy = 'timestamp'
+    list_select_related = ['sender', 'receiver']
+    autocomplete_fields = ['sender', 'receiver', 'related_listing']
 
 @admin.register(ToolBorrow)
-class ToolBorrowAdmin(admin.ModelAdmin):
+class ToolBorrowAdmin(LargeTableAdmin):
     list_display = ['tool', 'borrower', 'status', 'start_date', 'end_date']
     list_filter = ['status', 'start_date']
-    search_fields = ['tool__name', 'borrower__username']
+    search_fields = ['=borrower__username', '=tool__owner__username']
+    search_help_text = "Exact username of the borrower or the tool's owner"
     readonly_fields = ['requested_at']
+    list_select_related = ['tool', 'borrower']
+    autocomplete_fields = ['tool', 'borrower']
     
     actions = ['approve_requests', 'mark_returned']
     
     def approve_requests(self, request, queryset):
-        queryset.update(status='APPROVED')
-        self.message_user(request, f"{queryset.count()} borrow requests approved.")
+        with transaction.atomic():
+            borrows = list(queryset.filter(status='PENDING').select_for_update(of=('self',)).values_list(
+                'pk', 'borrower_id', 'tool_id', 'tool__name'
+            ))
+            ToolBorrow.objects.filter(pk__in=[pk for pk, *_ in borrows]).update(status='APPROVED')
+            Tool.objects.filter(pk__in={tool_id for _, _, tool_id, _ in borrows}).update(is_available=False)
+            enqueue_many('notification', [
+                {'user_id': borrower_id, 'notification_type': 'TOOL_APPROVED',
+                 'message': f"Your request to borrow {tool_name} was approved", 'link': f"/tools/{tool_id}/"}
+                for _, borrower_id, tool_id, tool_name in borrows
+            ])
+        bump_model(Tool)
+        self.message_user(request, f"{len(borrows)} borrow requests approved.")
     approve_requests.short_description = "Approve selected requests"
     
     def mark_returned(self, request, queryset):
-        queryset.update(status='RETURNED')
-        self.message_user(request, f"{queryset.count()} borrows marked as returned.")
+        with transaction.atomic():
+            borrows = list(queryset.filter(status__in=['APPROVED', 'BORROWED']).select_for_update(of=('self',)).values_list(
+                'pk', 'tool_id', 'tool__name', 'tool__owner_id', 'borrower__username'
+            ))
+            ToolBorrow.objects.filter(pk__in=[pk for pk, *_ in borrows]).update(status='RETURNED', actual_return_date=timezone.now())
+            # A tool stays unavailable while another borrow of it is approved or under way
+            Tool.objects.filter(pk__in={tool_id for _, tool_id, *_ in borrows}).exclude(
+                borrows__status__in=['APPROVED', 'BORROWED']
+            ).update(is_available=True)
+            enqueue_many('notification', [
+                {'user_id': owner_id, 'notification_type': 'TOOL_RETURNED',
+                 'message': f"{borrower} returned your {tool_name}", 'link': f"/tools/{tool_id}/"}
+                for _, tool_id, tool_name, owner_id, borrower in borrows
+            ])
+        bump_model(Tool)
+        self.message_user(request, f"{len(borrows)} borrows marked as returned.")
     mark_returned.short_description = "Mark as returned"
 
 @admin.register(Event)
 class EventAdmin(admin.ModelAdmin):
-    list_display = ['title', 'organizer', 'event_type', 'event_date', 'is_active']
-    list_filter = ['event_type', 'is_active', 'event_date']
+    list_display = ['title', 'organizer', 'event_type', 'event_date', 'recurrence', 'is_active']
+    list_filter = ['event_type', 'recurrence', 'is_active', 'event_date']
     search_fields = ['title', 'description', 'organizer__username']
-    filter_horizontal = ['participants']
     readonly_fields = ['created_at']
     date_hierarchy = 'event_date'
+    list_select_related = ['organizer']
+    autocomplete_fields = ['organizer', 'participants']
+    
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        obj.materialize_occurrences()
 
 @admin.register(Review)
 class ReviewAdmin(admin.ModelAdmin):
@@ -84,24 +216,66 @@ class ReviewAdmin(admin.ModelAdmin):
     list_filter = ['rating', 'created_at']
     search_fields = ['reviewer__username', 'reviewed_user__username', 'comment']
     readonly_fields = ['created_at']
+    list_select_related = ['reviewer', 'reviewed_user']
+    autocomplete_fields = ['reviewer', 'reviewed_user']
 
 @admin.register(Conversation)
-class ConversationAdmin(admin.ModelAdmin):
+class ConversationAdmin(LargeTableAdmin):
     list_display = ['participant1', 'participant2', 'listing', 'created_at', 'updated_at']
     list_filter = ['created_at', 'updated_at']
-    search_fields = ['participant1__username', 'participant2__username']
-    readonly_fields = ['created_at', 'updated_at']
+    search_fields = ['=participant1__username', '=participant2__username']
+    search_help_text = "Exact username of either participant"
+    readonly_fields = ['pair_key', 'created_at', 'updated_at']
+    list_select_related = ['participant1', 'participant2', 'listing']
+    autocomplete_fields = ['participant1', 'participant2', 'listing']
 
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(LargeTableAdmin):
     list_display = ['sender', 'recipient', 'conversation', 'is_read', 'is_credit_request', 'credit_amount', 'credit_status', 'created_at']
     list_filter = ['is_read', 'requires_response', 'response_status', 'is_credit_request', 'credit_status', 'created_at']
-    search_fields = ['sender__username', 'recipient__username', 'body']
+    search_fields = ['=sender__username', '=recipient__username']
+    search_help_text = "Exact username of the sender or recipient"
     readonly_fields = ['created_at']
+    # The conversation column prints both participants
+    list_select_related = ['sender', 'recipient', 'conversation__participant1', 'conversation__participant2']
+    autocomplete_fields = ['sender', 'recipient', 'conversation']
+
+@admin.register(MessageArchiveSegment)
+class MessageArchiveSegmentAdmin(LargeTableAdmin):
+    list_display = ['conversation', 'first_id', 'last_id', 'message_count', 'first_created_at', 'last_created_at']
+    list_filter = ['created_at']
+    exclude = ['data']
+    readonly_fields = ['conversation', 'first_id', 'last_id', 'message_count', 'first_created_at', 'last_created_at', 'created_at']
+    list_select_related = ['conversation__participant1', 'conversation__participant2']
+    
+    def get_queryset(self, request):
+        # Never read the compressed messages for the list
+        return super().get_queryset(request).defer('data')
 
 @admin.register(Notification)
-class NotificationAdmin(admin.ModelAdmin):
+class NotificationAdmin(LargeTableAdmin):
     list_display = ['user', 'notification_type', 'message', 'is_read', 'created_at']
     list_filter = ['notification_type', 'is_read', 'created_at']
-    search_fields = ['user__username', 'message']
+    search_fields = ['=user__username']
+    search_help_text = "Exact username of the recipient"
     readonly_fields = ['created_at']
+    list_select_related = ['user']
+    autocomplete_fields = ['user']
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(LargeTableAdmin):
+    list_display = ['kind', 'created_at', 'processed_at', 'attempts', 'last_error']
+    list_filter = ['kind', 'processed_at', 'created_at']
+    readonly_fields = ['kind', 'payload', 'attempts', 'last_error', 'created_at', 'processed_at']
+
+@admin.register(DailyStat)
+class DailyStatAdmin(LargeTableAdmin):
+    list_display = ['day', 'metric', 'key', 'label', 'value']
+    list_filter = ['metric', 'day']
+    search_fields = ['label']
+    readonly_fields = ['day', 'metric', 'key', 'label', 'value']
+
+@admin.register(RollupWatermark)
+class RollupWatermarkAdmin(admin.ModelAdmin):
+    list_display = ['source', 'last_id', 'updated_at']
+    readonly_fields = ['source', 'last_id', 'updated_at']
@@ -0,0 +1,536 @@
+"""
+JSON API, version 1 (/api/v1/).
+
+Listings, tools and events, plus the member's own conversations, messages and
+transactions, each as a collection (`/api/v1/listings/`) and as items
+(`/api/v1/listings/<id>/`). Rows are read with values() straight into dicts;
+no model instances are built to be serialized.
+
+- `?fields=id,title` returns only those fields.
+- `?include=user,skills` adds related data. Each include is loaded for the
+  whole page with one query, however many rows the page has.
+- Collections are newest first, API_PAGE_SIZE rows at a time (`?limit=`, at
+  most MAX_PAGE_SIZE). `next` links to the following page through a keyset
+  cursor (`?before_id=`), so page 1000 costs the same as page 1. `?after_id=`
+  pages forward instead, oldest first, to pick up new rows.
+- GET answers carry an ETag; sending it back in If-None-Match gets a 304
+  without the body.
+- Writes take a JSON body and go through the same ModelForms as the pages:
+  POST creates, PATCH changes only the fields given, DELETE removes. They need
+  a logged-in session and its CSRF token in the X-CSRFToken header.
+"""
+import hashlib
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db.models import Case, CharField, Count, Exists, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Concat
+from django.forms.models import model_to_dict
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+
+from .archive import archived_messages
+from .form import EventForm, MessageForm, ServiceListingForm, ToolForm, TransactionApiForm
+from .metrics import query_budget
+from .models import Conversation, Event, Message, ServiceListing, Tool, ToolBorrow, Transaction
+from .ratelimit import rate_limit
+from .views import _record_transfer, _send_message
+
+MAX_PAGE_SIZE = 100
+
+
+class ApiError(Exception):
+    """Ends the request with {'error': message} and the given status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _int_param(params, name, default=None):
+    if name not in params:
+        return default
+    try:
+        return int(params[name])
+    except ValueError:
+        raise ApiError(f'{name} must be a whole number.')
+
+
+def _names(params, name, known):
+    """The comma-separated names of a query parameter, checked against the known ones"""
+    names = [item.strip() for item in params.get(name, '').split(',') if item.strip()]
+    unknown = [item for item in names if item not in known]
+    if unknown:
+        raise ApiError(f"Unknown {name}: {', '.join(unknown)}. Choose from: {', '.join(known)}.")
+    return names
+
+
+# ============== INCLUDES ==============
+class Include:
+    """Related data for a page of rows, loaded for all of them with one query"""
+
+    def __init__(self, key, load, many=False):
+        self.key = key
+        self.load = load
+        self.default = () if many else None
+
+    def attach(self, name, rows):
+        keys = {row[self.key] for row in rows if row[self.key] is not None}
+        found = self.load(keys) if keys else {}
+        for row in rows:
+            row[name] = found.get(row[self.key], self.default)
+
+
+def _users(ids):
+    return {
+        row['id']: {
+            'id': row['id'],
+            'username': row['username'],
+            'name': f"{row['first_name']} {row['last_name']}".strip(),
+            'location': row['profile__location'],
+        }
+        for row in User.objects.filter(pk__in=ids).values('id', 'username', 'first_name', 'last_name', 'profile__location')
+    }
+
+
+def _listings(ids):
+    return {
+        row['id']: row
+        for row in ServiceListing.objects.filter(pk__in=ids).values('id', 'title', 'user_id', type=F('listing_type'))
+    }
+
+
+def _messages(ids):
+    return {
+        row['id']: row
+        for row in Message.objects.filter(pk__in=ids).values('id', 'sender_id', 'body', 'is_read', 'created_at')
+    }
+
+
+def _listing_skills(ids):
+    skills = defaultdict(list)
+    for listing_id, name in ServiceListing.skills.through.objects.filter(
+        servicelisting_id__in=ids
+    ).order_by('skill__name').values_list('servicelisting_id', 'skill__name'):
+        skills[listing_id].append(name)
+    return skills
+
+
+def _event_participants(ids):
+    participants = defaultdict(list)
+    for event_id, user_id, username in Event.participants.through.objects.filter(
+        event_id__in=ids
+    ).order_by('user__username').values_list('event_id', 'user_id', 'user__username'):
+        participants[event_id].append({'id': user_id, 'username': username})
+    return participants
+
+
+# ============== RESOURCES ==============
+class Resource:
+    """
+    How one model appears in the API, instantiated per request.
+    fields maps each output name to a model field, a lookup or an expression for values();
+    includes and filters (query parameter -> field) are optional.
+    """
+    model = None
+    fields = {}
+    includes = {}
+    filters = {}
+    form_class = None
+    owner_field = None      # who may PATCH/DELETE an item
+    public = False          # readable without logging in
+
+    def __init__(self, request, **kwargs):
+        self.request = request
+        self.kwargs = kwargs
+
+    def queryset(self):
+        return self.model.objects.all()
+
+    def field_map(self):
+        return self.fields
+
+    def _rows(self, queryset, names):
+        """values() of the named fields plus the keys the includes need (left out of the answer again)"""
+        fields = self.field_map()
+        includes = _names(self.request.GET, 'include', list(self.includes))
+        wanted = list(dict.fromkeys(['id', *names, *(self.includes[name].key for name in includes)]))
+        plain = [name for name in wanted if fields[name] == name]
+        aliased = {
+            name: F(fields[name]) if isinstance(fields[name], str) else fields[name]
+            for name in wanted if fields[name] != name
+        }
+        return queryset.values(*plain, **aliased), includes, wanted
+
+    def _finish(self, rows, includes, wanted, names):
+        for name in includes:
+            self.includes[name].attach(name, rows)
+        hidden = [name for name in wanted if name not in names]
+        for row in rows:
+            for name in hidden:
+                del row[name]
+        return rows
+
+    def _requested_fields(self):
+        return _names(self.request.GET, 'fields', list(self.field_map())) or list(self.field_map())
+
+    def with_older(self, rows, wanted, before_id, limit):
+        """The newest-first page rows, plus any older rows kept outside the table (see MessageResource)"""
+        return rows
+
+    def page(self):
+        params = self.request.GET
+        limit = min(max(_int_param(params, 'limit', settings.API_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+        before_id, after_id = _int_param(params, 'before_id'), _int_param(params, 'after_id')
+        names = self._requested_fields()
+
+        queryset = self.queryset()
+        try:
+            queryset = queryset.filter(**{
+                field: params[param] for param, field in self.filters.items() if param in params
+            })
+        except (ValueError, ValidationError):
+            raise ApiError('Invalid filter value.')
+
+        if after_id is not None:
+            queryset, cursor = queryset.filter(pk__gt=after_id).order_by('pk'), 'after_id'
+        else:
+            if before_id is not None:
+                queryset = queryset.filter(pk__lt=before_id)
+            queryset, cursor = queryset.order_by('-pk'), 'before_id'
+
+        values, includes, wanted = self._rows(queryset, names)
+        rows = list(values[:limit + 1])
+        if cursor == 'before_id':
+            rows = self.with_older(rows, wanted, before_id, limit + 1)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        next_url = None
+        if has_more:
+            next_params = params.copy()
+            next_params.pop('before_id', None)
+            next_params.pop('after_id', None)
+            next_params[cursor] = rows[-1]['id']
+            next_url = f'{self.request.path}?{next_params.urlencode()}'
+        return {'data': self._finish(rows, includes, wanted, names), 'next': next_url}
+
+    def item(self, pk):
+        names = self._requested_fields()
+        values, includes, wanted = self._rows(self.queryset().filter(pk=pk), names)
+        rows = list(values)
+        if not rows:
+            raise Http404
+        return {'data': self._finish(rows, includes, wanted, names)[0]}
+
+    # Writes
+
+    def writable(self, pk):
+        """The instance a PATCH or DELETE may change"""
+        if self.owner_field is None:
+            raise ApiError('This resource cannot be changed.', status=405)
+        return get_object_or_404(self.queryset(), pk=pk, **{self.owner_field: self.request.user})
+
+    def form_data(self, instance, data):
+        """The form's data: the instance's current values (or the model defaults) overlaid with data"""
+        form_fields = self.form_class._meta.fields
+        return {**model_to_dict(instance or self.model(), fields=form_fields), **data}
+
+    def save(self, form, created):
+        instance = form.save(commit=False)
+        if created:
+            setattr(instance, self.owner_field, self.request.user)
+        instance.save()
+        form.save_m2m()
+        return instance
+
+    def write(self, data, instance=None):
+        if self.form_class is None:
+            raise ApiError('This resource cannot be changed.', status=405)
+        form = self.form_class(data=self.form_data(instance, data), instance=instance)
+        if not form.is_valid():
+            return None, form.errors
+        return self.save(form, created=instance is None), None
+
+    def delete(self, instance):
+        instance.delete()
+
+
+class ListingResource(Resource):
+    model = ServiceListing
+    fields = {
+        'id': 'id', 'title': 'title', 'description': 'description', 'type': 'listing_type',
+        'user_id': 'user_id', 'is_active': 'is_active', 'created_at': 'created_at',
+    }
+    includes = {'user': Include('user_id', _users), 'skills': Include('id', _listing_skills, many=True)}
+    filters = {'type': 'listing_type', 'user': 'user_id'}
+    form_class = ServiceListingForm
+    owner_field = 'user'
+    public = True
+
+    def queryset(self):
+        return ServiceListing.objects.filter(is_active=True)
+
+    def form_data(self, instance, data):
+        data = dict(data)
+        if 'type' in data:
+            data['listing_type'] = data.pop('type')
+        # Skills are a list of names, resolved like the form's free-text field
+        if 'skills' in data:
+            skills = data.pop('skills')
+        else:
+            skills = list(instance.skills.values_list('name', flat=True)) if instance else []
+        if not isinstance(skills, list):
+            raise ApiError('skills must be a list of names.')
+        return {**super().form_data(instance, data), 'skills': [], 'other_skills': ','.join(map(str, skills))}
+
+    def delete(self, instance):
+        # Like the page: listings are deactivated, so conversations and matches keep their reference
+        instance.is_active = False
+        instance.save()
+
+
+class ToolResource(Resource):
+    model = Tool
+    includes = {'owner': Include('owner_id', _users)}
+    filters = {'owner': 'owner_id', 'available': 'is_available'}
+    form_class = ToolForm
+    owner_field = 'owner'
+    public = True
+
+    def field_map(self):
+        return {
+            'id': 'id', 'name': 'name', 'description': 'description', 'owner_id': 'owner_id',
+            'is_available': 'is_available',
+            'image_url': Case(
+                When(Q(image='') | Q(image__isnull=True), then=Value(None)),
+                default=Concat(Value(settings.MEDIA_URL), 'image'),
+                output_field=CharField(),
+            ),
+        }
+
+    def form_data(self, instance, data):
+        # Photos are uploaded through the page; the JSON API leaves them as they are
+        data = {**super().form_data(instance, data)}
+        data.pop('image', None)
+        return data
+
+    def delete(self, instance):
+        if ToolBorrow.objects.filter(tool=instance, status='APPROVED').exists():
+            raise ApiError('Cannot delete a tool with active borrows.', status=409)
+        instance.delete()
+
+
+class EventResource(Resource):
+    model = Event
+    fields = {
+        'id': 'id', 'title': 'title', 'description': 'description', 'event_type': 'event_type',
+        'location': 'location', 'event_date': 'event_date', 'recurrence': 'recurrence',
+        'recurrence_end': 'recurrence_end', 'max_participants': 'max_participants',
+        'organizer_id': 'organizer_id', 'created_at': 'created_at',
+        'participant_count': Count('participants'),
+    }
+    includes = {'organizer': Include('organizer_id', _users), 'participants': Include('id', _event_participants, many=True)}
+    filters = {'type': 'event_type', 'organizer': 'organizer_id'}
+    form_class = EventForm
+    owner_field = 'organizer'
+    public = True
+
+    def queryset(self):
+        return Event.objects.filter(is_active=True)
+
+    def save(self, form, created):
+        event = super().save(form, created)
+        event.materialize_occurrences()
+        return event
+
+    def delete(self, instance):
+        raise ApiError('Events cannot be deleted through the API.', status=405)
+
+
+class ConversationResource(Resource):
+    model = Conversation
+    includes = {
+        'other_user': Include('other_user_id', _users),
+        'listing': Include('listing_id', _listings),
+        'last_message': Include('last_message_id', _messages),
+    }
+
+    def queryset(self):
+        return Conversation.objects.filter(members__user=self.request.user)
+
+    def field_map(self):
+        user = self.request.user
+        return {
+            'id': 'id', 'listing_id': 'listing_id', 'created_at': 'created_at', 'updated_at': 'updated_at',
+            'other_user_id': Case(When(participant1=user, then=F('participant2_id')), default=F('participant1_id')),
+            'unread': Exists(Message.objects.filter(conversation=OuterRef('pk'), recipient=user, is_read=False)),
+            'last_message_id': Subquery(
+                Message.objects.filter(conversation=OuterRef('pk')).order_by('-id').values('id')[:1]
+            ),
+        }
+
+    def write(self, data, instance=None):
+        if instance is not None:
+            raise ApiError('Conversations cannot be changed.', status=405)
+        try:
+            other_user = User.objects.filter(pk=data['user_id'], is_active=True).first() if data.get('user_id') else None
+            listing = None
+            if data.get('listing_id'):
+                listing = ServiceListing.objects.filter(pk=data['listing_id']).select_related('user').first()
+        except (ValueError, TypeError, ValidationError):
+            raise ApiError('user_id and listing_id must be ids.')
+        if data.get('listing_id'):
+            if listing is None:
+                return None, {'listing_id': ['No such listing.']}
+            other_user = other_user or listing.user
+        if other_user is None or other_user == self.request.user:
+            return None, {'user_id': ['Choose another member.']}
+        conversation, _ = Conversation.get_or_create_between(self.request.user, other_user, listing)
+        return conversation, None
+
+
+class MessageResource(Resource):
+    """A conversation's messages (/api/v1/conversations/<id>/messages/), archived ones included"""
+    model = Message
+    fields = {
+        'id': 'id', 'conversation_id': 'conversation_id', 'sender_id': 'sender_id', 'recipient_id': 'recipient_id',
+        'body': 'body', 'is_read': 'is_read', 'requires_response': 'requires_response',
+        'response_status': 'response_status', 'is_credit_request': 'is_credit_request',
+        'credit_amount': 'credit_amount', 'credit_status': 'credit_status', 'created_at': 'created_at',
+    }
+    includes = {'sender': Include('sender_id', _users)}
+    form_class = MessageForm
+
+    def __init__(self, request, **kwargs):
+        super().__init__(request, **kwargs)
+        self.conversation = get_object_or_404(
+            Conversation.objects.filter(members__user=request.user).select_related('participant1', 'participant2'),
+            pk=kwargs['conversation_pk'],
+        )
+
+    def queryset(self):
+        return Message.objects.filter(conversation=self.conversation)
+
+    def with_older(self, rows, wanted, before_id, limit):
+        archived_up_to = self.conversation.archived_up_to
+        if not archived_up_to or (len(rows) >= limit and rows[-1]['id'] > archived_up_to):
+            return rows
+        # The page reaches back into the archive, which holds instances: project them like values() does
+        seen = {row['id'] for row in rows}
+        archived = [
+            {name: getattr(message, self.fields[name]) for name in wanted}
+            for message in archived_messages(self.conversation, before_id, limit) if message.pk not in seen
+        ]
+        return sorted(rows + archived, key=lambda row: row['id'], reverse=True)[:limit]
+
+    def save(self, form, created):
+        recipient = self.conversation.get_other_user(self.request.user)
+        return _send_message(self.conversation, form.save(commit=False), self.request.user, recipient)
+
+
+class TransactionResource(Resource):
+    model = Transaction
+    fields = {
+        'id': 'id', 'sender_id': 'sender_id', 'receiver_id': 'receiver_id', 'amount': 'amount',
+        'description': 'description', 'timestamp': 'timestamp', 'related_listing_id': 'related_listing_id',
+    }
+    includes = {
+        'sender': Include('sender_id', _users),
+        'receiver': Include('receiver_id', _users),
+        'related_listing': Include('related_listing_id', _listings),
+    }
+    form_class = TransactionApiForm
+
+    def queryset(self):
+        user = self.request.user
+        return Transaction.objects.filter(Q(sender=user) | Q(receiver=user))
+
+    def save(self, form, created):
+        transfer = form.save(commit=False)
+        transfer.sender = sender = self.request.user
+        if transfer.receiver_id == sender.pk:
+            raise ApiError('You cannot send credits to yourself.')
+        if not _record_transfer(transfer):
+            raise ApiError('Insufficient time credits.')
+        return transfer
+
+
+# ============== VIEWS ==============
+def _json_response(request, payload, status=200):
+    """The answer to a GET, with an ETag of its body: a 304 when the client already has it"""
+    response = JsonResponse(payload, status=status)
+    if request.method not in ('GET', 'HEAD'):
+        return response
+    etag = f'"{hashlib.sha1(response.content).hexdigest()}"'
+    response['ETag'] = etag
+    # Answers depend on who asks, so only the client's own cache may keep them, and must revalidate
+    response['Cache-Control'] = 'private, no-cache'
+    return get_conditional_response(request, etag=etag, response=response)
+
+
+def _json_body(request):
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        raise ApiError('The body must be JSON.')
+    if not isinstance(data, dict):
+        raise ApiError('The body must be a JSON object.')
+    return data
+
+
+def api_view(resource_class, methods, budget):
+    """
+    A view for a collection (methods GET/POST) or, called with pk, an item (GET/PATCH/DELETE)
+    of resource_class, within the given query budget
+    """
+    @query_budget(budget)
+    def view(request, pk=None, **kwargs):
+        if request.method not in methods and not (request.method == 'HEAD' and 'GET' in methods):
+            return JsonResponse({'error': f'{request.method} is not allowed here.'}, status=405,
+                                headers={'Allow': ', '.join(methods)})
+        if not request.user.is_authenticated and (request.method not in ('GET', 'HEAD') or not resource_class.public):
+            return JsonResponse({'error': 'Log in first.'}, status=401)
+        try:
+            resource = resource_class(request, **kwargs)
+            if request.method in ('GET', 'HEAD'):
+                return _json_response(request, resource.page() if pk is None else resource.item(pk))
+            if request.method == 'DELETE':
+                resource.delete(resource.writable(pk))
+                return HttpResponse(status=204)
+
+            instance = resource.writable(pk) if request.method == 'PATCH' else None
+            saved, errors = resource.write(_json_body(request), instance)
+            if errors:
+                return JsonResponse({'errors': errors}, status=400)
+            return _json_response(request, resource.item(saved.pk), status=201 if instance is None else 200)
+        except ApiError as exc:
+            return JsonResponse({'error': str(exc)}, status=exc.status)
+        except Http404:
+            return JsonResponse({'error': 'Not found.'}, status=404)
+
+    view.__doc__ = f'JSON API: {resource_class.model._meta.verbose_name_plural}'
+    return view
+
+
+COLLECTION_METHODS = ('GET', 'POST')
+ITEM_METHODS = ('GET', 'PATCH', 'DELETE')
+
+# Budgets cover the heaviest method: creating a listing resolves and sets its skills and queues a rescore
+
+listings = api_view(ListingResource, COLLECTION_METHODS, 12)
+listing = api_view(ListingResource, ITEM_METHODS, 8)
+tools = api_view(ToolResource, COLLECTION_METHODS, 6)
+tool = api_view(ToolResource, ITEM_METHODS, 6)
+events = api_view(EventResource, COLLECTION_METHODS, 8)
+event = api_view(EventResource, ITEM_METHODS, 9)
+# Starting conversations, sending messages and transfers share their rate limits with the pages
+conversations = rate_limit('conversations', methods=('POST',))(api_view(ConversationResource, COLLECTION_METHODS, 10))
+conversation = api_view(ConversationResource, ('GET',), 5)
+conversation_messages = rate_limit('messages', methods=('POST',))(api_view(MessageResource, COLLECTION_METHODS, 9))
+transactions = rate_limit('transfers', methods=('POST',))(api_view(TransactionResource, COLLECTION_METHODS, 10))
+transaction_detail = api_view(TransactionResource, ('GET',), 5)
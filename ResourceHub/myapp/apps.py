@@ -2,11 +2,11 @@ from django.apps import AppConfig
 
 
 class MyappConfig(AppConfig):
-    name = 'myapp'
-
-class CoreConfig(AppConfig):
-    default_auto_field = 'django.db.models.BigAutoField'
+    default = True
     name = 'myapp'
 
     def ready(self):
-        import myapp.signals
+        from . import auth_backends, cache, matching
+        auth_backends.connect_invalidation()
+        cache.connect_invalidation()
+        matching.connect_signals()
@@ -0,0 +1,120 @@
+"""
+Cold storage for old messages.
+
+`manage.py archive_messages` moves messages older than
+MESSAGE_ARCHIVE_AFTER_DAYS out of the Message table into
+MessageArchiveSegment rows, each holding up to MESSAGE_ARCHIVE_SEGMENT_SIZE
+messages of one conversation as gzip-compressed JSON lines. Threads keep their
+whole history: when a reader scrolls back past the live messages,
+conversation_history merges in archived ones, decompressing only the segments
+that page needs.
+
+Some messages always stay live, because views act on those rows: unread
+messages, requests still waiting for an answer, and the latest message of each
+thread (the inbox preview). Archived messages drop out of message search, as
+their index rows are deleted with them.
+"""
+import gzip
+import json
+from decimal import Decimal
+from operator import attrgetter
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery, Value
+from django.db.models.functions import Greatest
+from django.utils.dateparse import parse_datetime
+
+from .models import Conversation, Message, MessageArchiveSegment
+
+ARCHIVED_FIELDS = ['id', 'sender_id', 'recipient_id', 'body', 'is_read', 'requires_response', 'response_status',
+                   'is_credit_request', 'credit_amount', 'credit_status', 'created_at']
+COMPRESSION_LEVEL = 6
+
+
+def archivable(conversation_id, cutoff):
+    """The conversation's messages that may be archived, oldest first"""
+    latest = Message.objects.filter(conversation=OuterRef('conversation')).order_by('-id').values('id')[:1]
+    return Message.objects.filter(
+        conversation_id=conversation_id, created_at__lt=cutoff, is_read=True, id__lt=Subquery(latest)
+    ).exclude(
+        Q(response_status='PENDING') | Q(credit_status='PENDING')
+    ).order_by('id')
+
+
+def encode(rows):
+    """gzip-compressed JSON lines for a list of Message.values() rows"""
+    lines = (json.dumps(row, cls=DjangoJSONEncoder, separators=(',', ':')) for row in rows)
+    return gzip.compress('\n'.join(lines).encode(), compresslevel=COMPRESSION_LEVEL)
+
+
+def decode(segment):
+    """The segment's messages as unsaved Message instances, oldest first"""
+    messages = []
+    for line in gzip.decompress(segment.data).decode().splitlines():
+        row = json.loads(line)
+        row['created_at'] = parse_datetime(row['created_at'])
+        if row['credit_amount'] is not None:
+            row['credit_amount'] = Decimal(row['credit_amount'])
+        messages.append(Message(conversation_id=segment.conversation_id, **row))
+    return messages
+
+
+def archive_conversation(conversation_id, cutoff, segment_size):
+    """
+    Move the conversation's archivable messages older than cutoff into segments,
+    one transaction per segment so memory stays flat. Returns how many moved.
+    """
+    moved = 0
+    while True:
+        with transaction.atomic():
+            rows = list(archivable(conversation_id, cutoff).values(*ARCHIVED_FIELDS)[:segment_size])
+            if not rows:
+                return moved
+            created = [row['created_at'] for row in rows]
+            MessageArchiveSegment.objects.create(
+                conversation_id=conversation_id,
+                first_id=rows[0]['id'],
+                last_id=rows[-1]['id'],
+                message_count=len(rows),
+                first_created_at=min(created),
+                last_created_at=max(created),
+                data=encode(rows),
+            )
+            Message.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+            Conversation.objects.filter(pk=conversation_id).update(
+                archived_up_to=Greatest('archived_up_to', Value(rows[-1]['id']))
+            )
+        moved += len(rows)
+
+
+def archived_messages(conversation, before_id=None, limit=30):
+    """
+    Up to limit archived messages of the conversation with ids below before_id,
+    newest first. Segments are decompressed newest first, and only while they
+    can still hold messages newer than the ones already found.
+    """
+    segments = conversation.archive_segments.defer('data').order_by('-last_id')
+    if before_id is not None:
+        segments = segments.filter(first_id__lt=before_id)
+    segments = list(segments)
+
+    # The newest segments that together hold a full page usually suffice: fetch them in one query
+    wanted, covered = [], 0
+    for segment in segments:
+        if covered >= limit:
+            break
+        wanted.append(segment.pk)
+        if before_id is None or segment.last_id < before_id:
+            covered += segment.message_count
+    data = dict(MessageArchiveSegment.objects.filter(pk__in=wanted).values_list('pk', 'data'))
+
+    found = []
+    for segment in segments:
+        if len(found) >= limit and segment.last_id < found[limit - 1].pk:
+            break
+        if segment.pk in data:
+            segment.data = data[segment.pk]
+        found.extend(message for message in decode(segment) if before_id is None or message.pk < before_id)
+        found.sort(key=attrgetter('pk'), reverse=True)
+    return found[:limit]
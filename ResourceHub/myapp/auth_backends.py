@@ -0,0 +1,90 @@
+"""
+Authentication backend that keeps logged-in users in the cache.
+
+ModelBackend reads the auth_user row on every authenticated request, before
+any view code runs. CachedModelBackend serves that row from the cache instead
+(AUTH_USER_CACHE_TIMEOUT seconds), and together with the cached_db session
+engine an authenticated request such as check_updates spends no queries on
+who is asking.
+
+The cached copy leaves out the password hash: it holds the other columns and
+the session auth hash (an HMAC of the password hash) that Django compares with
+the one stored in the session on every request. The password itself is loaded
+from the database only if something asks for it, such as check_password().
+
+Saving or deleting a user through the ORM drops their cached copy, so a
+password change, deactivation or the last_login update of a new login is seen
+by the next request of every worker process (the cache is shared). Logging out
+drops it too. Bulk User.objects.update() calls send no signals; call
+forget_user() after them.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.signals import user_logged_out
+from django.core.cache import cache
+from django.db import router
+from django.db.models.signals import post_delete, post_save
+
+
+def _key(user_id):
+    return f'auth:user:v2:{user_id}'
+
+
+def forget_user(user_id):
+    cache.delete(_key(user_id))
+
+
+def _cached_copy(user):
+    """What is cached for user: every column but the password, and the session auth hash"""
+    fields = {field.attname: getattr(user, field.attname)
+              for field in user._meta.concrete_fields if field.attname != 'password'}
+    return {'fields': fields, 'session_auth_hash': user.get_session_auth_hash()}
+
+
+def _restore(copy):
+    """A user instance from its cached copy, with the password left deferred"""
+    user_model = get_user_model()
+    user = user_model.from_db(router.db_for_read(user_model), list(copy['fields']), list(copy['fields'].values()))
+    cached_hash = copy['session_auth_hash']
+
+    def get_session_auth_hash():
+        # The cached hash only describes the password this copy was made from: once the
+        # password is loaded or changed (set_password), compute it from the real one
+        if 'password' in user.get_deferred_fields():
+            return cached_hash
+        return user_model.get_session_auth_hash(user)
+
+    user.get_session_auth_hash = get_session_auth_hash
+    return user
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend whose per-request user lookup is served from the cache"""
+
+    def get_user(self, user_id):
+        copy = cache.get(_key(user_id))
+        if copy is not None:
+            user = _restore(copy)
+        else:
+            user = super().get_user(user_id)
+            if user is None:
+                return None
+            cache.set(_key(user_id), _cached_copy(user), settings.AUTH_USER_CACHE_TIMEOUT)
+        # Deactivation drops the cached copy, but check like ModelBackend does
+        return user if self.user_can_authenticate(user) else None
+
+
+def connect_invalidation():
+    """Drop a user's cached copy whenever their row changes or they log out"""
+    def user_changed(sender, instance, **kwargs):
+        forget_user(instance.pk)
+
+    def logged_out(sender, user, **kwargs):
+        if user is not None:
+            forget_user(user.pk)
+
+    user_model = get_user_model()
+    post_save.connect(user_changed, sender=user_model, weak=False, dispatch_uid='auth-user-cache')
+    post_delete.connect(user_changed, sender=user_model, weak=False, dispatch_uid='auth-user-cache')
+    user_logged_out.connect(logged_out, weak=False, dispatch_uid='auth-user-cache-logout')
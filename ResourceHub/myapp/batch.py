@@ -0,0 +1,226 @@
+"""
+Batched JSON requests (/api/v1/batch/).
+
+A page that needs several endpoints at once (the dashboard's balance and
+unread counts, the map's markers and the upcoming events) can POST them as one
+request instead of paying a round trip for each:
+
+    {"requests": [{"method": "GET", "path": "/api/check-updates/"},
+                  {"method": "GET", "path": "/api/v1/events/?limit=5"},
+                  {"method": "POST", "path": "/api/v1/transactions/", "body": {...}}]}
+
+and gets back one answer per sub-request, in the same order:
+
+    {"responses": [{"status": 200, "headers": {"ETag": "..."}, "body": {...}}, ...]}
+
+Only /api/ endpoints can be batched. Each sub-request is dispatched straight
+to its view with the batch request's session and user, so it sees what a
+request of its own would see; a `body` is sent as JSON, and `headers` (such as
+If-None-Match) are passed on. Sub-requests run in the order given, except that
+a run of consecutive GETs is spread over up to API_BATCH_WORKERS threads.
+Writes run one at a time, and commit (or roll back) just as they would on
+their own. A sub-request that fails, even with an exception, only fails its
+own entry.
+
+The batch itself is a POST, but its GETs may read from the read replica
+(myapp/routers.py) like GET requests of their own, until the batch writes
+anything; a write anywhere in the batch, even by a GET, pins the visitor to
+the primary as usual.
+
+Every sub-request is measured as a request to its own view (myapp/metrics.py),
+against that view's query budget.
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from contextvars import copy_context
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db import connections
+from django.http import Http404, HttpRequest, JsonResponse, QueryDict
+from django.urls import Resolver404, resolve
+from django.views.decorators.http import require_POST
+
+from .metrics import collecting, registry
+from .middleware import REPLICA_PIN_COOKIE
+from .routers import mark_wrote_to_primary, replica_reads, wrote_to_primary
+
+logger = logging.getLogger(__name__)
+
+READ_ONLY_METHODS = ('GET', 'HEAD')
+METHODS = READ_ONLY_METHODS + ('POST', 'PATCH', 'DELETE')
+
+# Headers of a sub-request's response that are passed back to the client
+FORWARDED_HEADERS = ('ETag', 'Location', 'Allow', 'Retry-After')
+
+
+def _error(status, message):
+    return {'status': status, 'headers': {}, 'body': {'error': message}}
+
+
+def _sub_request(request, method, url, match, item):
+    """An HttpRequest for one sub-request, made on behalf of the batch request's session and user"""
+    sub = HttpRequest()
+    sub.method = method
+    sub.path = sub.path_info = url.path
+    # Conditional headers of the batch request aren't meant for its sub-requests
+    sub.META = {key: value for key, value in request.META.items() if not key.startswith('HTTP_IF_')}
+    body = json.dumps(item['body']).encode() if item.get('body') is not None else b''
+    sub.META.update(
+        REQUEST_METHOD=method, PATH_INFO=url.path, QUERY_STRING=url.query,
+        CONTENT_TYPE='application/json', CONTENT_LENGTH=str(len(body)),
+    )
+    for name, value in (item.get('headers') or {}).items():
+        sub.META['HTTP_' + str(name).upper().replace('-', '_')] = str(value)
+    sub._body = body
+    sub.GET = QueryDict(url.query)
+    sub.COOKIES = request.COOKIES
+    sub.session = request.session
+    sub.user = request.user
+    if hasattr(request, '_messages'):
+        sub._messages = request._messages
+    # The batch request itself passed the CSRF check
+    sub.csrf_processing_done = True
+    sub.resolver_match = match
+    return sub
+
+
+def _resolve(item):
+    """(method, url, match) of a sub-request, or the error entry to answer it with"""
+    if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+        return _error(400, 'Each sub-request needs a path.')
+    method = str(item.get('method', 'GET')).upper()
+    if method not in METHODS:
+        return _error(405, f'{method} is not allowed in a batch.')
+    url = urlsplit(item['path'])
+    if not url.path.startswith('/api/'):
+        return _error(400, 'Only /api/ endpoints can be batched.')
+    try:
+        match = resolve(url.path)
+    except Resolver404:
+        return _error(404, 'Not found.')
+    if match.func is batch:
+        return _error(400, 'Batches cannot be nested.')
+    return method, url, match
+
+
+def _entry(response):
+    """The batch answer's entry for a sub-request's response"""
+    body = None
+    if response.content and response.get('Content-Type', '').startswith('application/json'):
+        body = json.loads(response.content)
+    elif response.content:
+        body = response.content.decode(response.charset)
+    headers = {name: response[name] for name in FORWARDED_HEADERS if response.has_header(name)}
+    return {'status': response.status_code, 'headers': headers, 'body': body}
+
+
+def _run(request, item, resolved):
+    """Dispatch one sub-request to its view; returns (entry, its metrics)"""
+    method, url, match = resolved
+    sub = _sub_request(request, method, url, match, item)
+    with collecting() as metrics, ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(metrics))
+        try:
+            entry = _entry(match.func(sub, *match.args, **match.kwargs))
+        except Http404:
+            entry = _error(404, 'Not found.')
+        except PermissionDenied:
+            entry = _error(403, 'Permission denied.')
+        except Exception:
+            logger.exception('Batched %s %s failed', method, item['path'])
+            entry = _error(500, 'Internal error.')
+    metrics.finish()
+    registry.record(match.view_name, metrics, getattr(match.func, 'query_budget', None))
+    return entry, metrics
+
+
+def _run_in_thread(request, item, resolved):
+    """_run on a pool thread; also returns whether the sub-request wrote"""
+    try:
+        entry, metrics = _run(request, item, resolved)
+        return entry, metrics, wrote_to_primary()
+    finally:
+        # Pool threads end with the batch; close the connections they opened
+        connections.close_all()
+
+
+def _run_reads(request, reads, pool, entries, replica):
+    """
+    Run read-only sub-requests side by side (on the replica, if allowed), filling in their
+    entries. Returns whether any of them wrote.
+    """
+    with replica_reads(replica) as wrote:
+        if pool is None or len(reads) == 1:
+            for index, item, resolved in reads:
+                entries[index] = _run(request, item, resolved)[0]
+            return wrote()
+
+        # Each task gets its own copy of the request's context (replica routing, metrics)
+        futures = [
+            (index, pool.submit(copy_context().run, _run_in_thread, request, item, resolved))
+            for index, item, resolved in reads
+        ]
+        outer = getattr(request, 'metrics', None)
+        any_wrote = False
+        for index, future in futures:
+            entries[index], metrics, thread_wrote = future.result()
+            any_wrote = any_wrote or thread_wrote
+            # Queries on the pool's connections escaped the batch request's own count
+            if outer is not None:
+                outer.queries += metrics.queries
+                outer.db_time += metrics.db_time
+        return any_wrote
+
+
+@require_POST
+def batch(request):
+    """Run a list of /api/ sub-requests and answer them together"""
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'The body must be JSON.'}, status=400)
+    items = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return JsonResponse({'error': 'Send the sub-requests as a non-empty "requests" list.'}, status=400)
+    if len(items) > settings.API_BATCH_MAX_REQUESTS:
+        return JsonResponse(
+            {'error': f'A batch holds at most {settings.API_BATCH_MAX_REQUESTS} sub-requests.'}, status=400
+        )
+
+    # Load the user (and with them the session) once, before any thread shares them
+    request.user.is_authenticated
+
+    entries = [None] * len(items)
+    reads = []
+    # Like a GET request of its own: the replica, unless the visitor is pinned to the primary
+    replica = REPLICA_PIN_COOKIE not in request.COOKIES
+
+    def run_reads():
+        nonlocal replica
+        if reads and _run_reads(request, reads, pool, entries, replica):
+            # Let ReplicaRoutingMiddleware pin the visitor, and read what was written from now on
+            mark_wrote_to_primary()
+            replica = False
+        reads.clear()
+
+    workers = min(settings.API_BATCH_WORKERS, len(items))
+    with ExitStack() as stack:
+        pool = stack.enter_context(ThreadPoolExecutor(workers)) if workers > 1 else None
+        for index, item in enumerate(items):
+            resolved = _resolve(item)
+            if isinstance(resolved, dict):
+                entries[index] = resolved
+            elif resolved[0] in READ_ONLY_METHODS:
+                reads.append((index, item, resolved))
+            else:
+                # A write waits for the reads before it, and the reads after it see what it wrote
+                run_reads()
+                entries[index] = _run(request, item, resolved)[0]
+                replica = False
+        run_reads()
+    return JsonResponse({'responses': entries})
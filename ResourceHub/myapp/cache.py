@@ -0,0 +1,173 @@
+"""
+Namespaced, versioned caching on top of the configured cache.
+
+Keys look like `<namespace>:v<version>:<parts>`. Each namespace keeps a
+version number in the cache, and bump_namespace() moves it on, which orphans
+every key of the old version at once without having to know them (they
+simply expire). Saving or deleting one of the models listed in
+NAMESPACE_MODELS bumps the namespaces built from it; bulk queryset.update()
+calls send no signals, so code making them calls bump_model() itself (or the
+changes show up when the entries time out).
+
+Hits and misses are counted per namespace and flushed to the cache in
+batches, so `manage.py cache_stats` sees the totals of every worker process.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+# namespace -> models (app_label.ModelName) whose changes invalidate it
+NAMESPACE_MODELS = {
+    'map': ['myapp.Profile', 'myapp.ServiceListing', 'myapp.Tool'],
+    'users': ['auth.User'],
+    'skills': ['myapp.Skill'],  # the name -> id registry of every process (myapp/skills.py)
+}
+
+# Saves that write only these fields (save(update_fields=...)) invalidate nothing: every login
+# updates last_login, which no cached value shows
+IGNORED_UPDATE_FIELDS = {
+    'auth.User': {'last_login'},
+}
+
+STATS_FLUSH_EVERY = 100      # accesses
+STATS_FLUSH_INTERVAL = 10    # seconds
+STATS_TIMEOUT = None         # stats never expire on their own
+_MISSING = object()
+
+
+def _version_key(namespace):
+    return f'ns:{namespace}:version'
+
+
+def namespace_version(namespace):
+    version = cache.get(_version_key(namespace))
+    if version is None:
+        cache.add(_version_key(namespace), 1, timeout=None)
+        version = cache.get(_version_key(namespace), 1)
+    return version
+
+
+def bump_namespace(namespace):
+    """Invalidate every key in a namespace"""
+    try:
+        return cache.incr(_version_key(namespace))
+    except ValueError:
+        cache.set(_version_key(namespace), 2, timeout=None)
+        return 2
+
+
+def bump_model(model):
+    """Invalidate the namespaces built from model, e.g. after a queryset.update() that sent no signals"""
+    for namespace, labels in NAMESPACE_MODELS.items():
+        if model._meta.label in labels:
+            bump_namespace(namespace)
+
+
+def make_key(namespace, *parts):
+    return ':'.join([namespace, f'v{namespace_version(namespace)}', *(str(part) for part in parts)])
+
+
+def cached(namespace, parts, compute, timeout=None):
+    """Return the cached value for (namespace, *parts), computing and storing it on a miss"""
+    key = make_key(namespace, *parts)
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        stats.record(namespace, hit=True)
+        return value
+
+    stats.record(namespace, hit=False)
+    value = compute()
+    if timeout is None:
+        cache.set(key, value)
+    else:
+        cache.set(key, value, timeout)
+    return value
+
+
+class CacheStats:
+    """Per-process hit/miss counters, periodically added to shared counters in the cache"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(lambda: [0, 0])
+        self._accesses = 0
+        self._last_flush = time.monotonic()
+
+    def record(self, namespace, hit):
+        with self._lock:
+            self._pending[namespace][0 if hit else 1] += 1
+            self._accesses += 1
+            due = (self._accesses >= STATS_FLUSH_EVERY
+                   or time.monotonic() - self._last_flush >= STATS_FLUSH_INTERVAL)
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(lambda: [0, 0])
+            self._accesses = 0
+            self._last_flush = time.monotonic()
+
+        for namespace, counts in pending.items():
+            for field, count in zip(('hits', 'misses'), counts):
+                if not count:
+                    continue
+                key = f'stats:{namespace}:{field}'
+                if not cache.add(key, count, timeout=STATS_TIMEOUT):
+                    try:
+                        cache.incr(key, count)
+                    except ValueError:
+                        cache.set(key, count, timeout=STATS_TIMEOUT)
+        self._remember_namespaces(pending)
+
+    def _remember_namespaces(self, pending):
+        known = cache.get('stats:namespaces', set())
+        if not set(pending) <= known:
+            cache.set('stats:namespaces', known | set(pending), timeout=STATS_TIMEOUT)
+
+    def snapshot(self):
+        """Totals per namespace across all processes: {namespace: (hits, misses)}"""
+        self.flush()
+        namespaces = sorted(cache.get('stats:namespaces', set()) | set(NAMESPACE_MODELS))
+        return {
+            namespace: (cache.get(f'stats:{namespace}:hits', 0), cache.get(f'stats:{namespace}:misses', 0))
+            for namespace in namespaces
+        }
+
+    def reset(self):
+        with self._lock:
+            self._pending.clear()
+        namespaces = cache.get('stats:namespaces', set()) | set(NAMESPACE_MODELS)
+        cache.delete_many([f'stats:{ns}:{field}' for ns in namespaces for field in ('hits', 'misses')])
+
+
+stats = CacheStats()
+
+
+def connect_invalidation():
+    """Bump the dependent namespaces whenever one of their models changes"""
+    from django.apps import apps
+
+    model_namespaces = defaultdict(list)
+    for namespace, labels in NAMESPACE_MODELS.items():
+        for label in labels:
+            model_namespaces[apps.get_model(label)].append(namespace)
+
+    for model, namespaces in model_namespaces.items():
+        ignored = IGNORED_UPDATE_FIELDS.get(model._meta.label, set())
+
+        def invalidate(sender, namespaces=tuple(namespaces), ignored=ignored, **kwargs):
+            update_fields = kwargs.get('update_fields')
+            if update_fields and set(update_fields) <= ignored:
+                return
+            for namespace in namespaces:
+                bump_namespace(namespace)
+
+        uid = f'cache-invalidation-{model._meta.label_lower}'
+        post_save.connect(invalidate, sender=model, weak=False, dispatch_uid=uid)
+        post_delete.connect(invalidate, sender=model, weak=False, dispatch_uid=uid)
+        for field in model._meta.local_many_to_many:
+            m2m_changed.connect(invalidate, sender=field.remote_field.through, weak=False, dispatch_uid=f'{uid}-{field.name}')
@@ -1,8 +1,10 @@
 from django import forms
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
+from django.db.models.functions import Lower
 from .models import (Transaction, ServiceListing, Tool, Event, Review, Profile, 
-                     ToolBorrow, Skill, Message)
+                     ToolBorrow, Message)
+from .skills import registry as skill_registry
 
 class UserRegistrationForm(UserCreationForm):
     email = forms.EmailField(required=True, widget=forms.EmailInput(attrs={'class': 'form-control'}))
@@ -36,10 +38,22 @@ class ProfileForm(forms.ModelForm):
         }
 
 class TransferForm(forms.ModelForm):
-    # We override the receiver field to filter users properly if needed
+    # Picked with the member typeahead (api/users/search/), so only the chosen id is
+    # submitted and validated with a single primary-key lookup
     receiver = forms.ModelChoiceField(
-        queryset=User.objects.all(), 
-        widget=forms.Select(attrs={'class': 'form-select'})
+        queryset=User.objects.filter(is_active=True),
+        required=False,
+        widget=forms.HiddenInput
+    )
+    
+    receiver_name = forms.CharField(
+        label='Recipient',
+        max_length=150,
+        widget=forms.TextInput(attrs={
+            'class': 'form-control',
+            'placeholder': 'Start typing a username or name',
+            'autocomplete': 'off',
+        })
     )
     
     amount = forms.DecimalField(
@@ -55,6 +69,17 @@ class TransferForm(forms.ModelForm):
     class Meta:
         model = Transaction
         fields = ['receiver', 'amount', 'description']
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('receiver') and cleaned_data.get('receiver_name'):
+            # Without JavaScript nothing was picked from the list, so take the username as typed
+            cleaned_data['receiver'] = User.objects.annotate(username_key=Lower('username')).filter(
+                is_active=True, username_key=cleaned_data['receiver_name'].strip().lower()
+            ).first()
+        if not cleaned_data.get('receiver') and 'receiver_name' not in self.errors:
+            self.add_error('receiver_name', 'Choose a member from the list.')
+        return cleaned_data
 
     def clean_amount(self):
         amount = self.cleaned_data['amount']
@@ -62,6 +87,17 @@ class TransferForm(forms.ModelForm):
             raise forms.ValidationError("Time credits must be positive.")
         return amount
 
+class TransactionApiForm(forms.ModelForm):
+    """A transfer from a JSON client (myapp/api.py), which names the recipient by id"""
+    receiver = forms.ModelChoiceField(queryset=User.objects.filter(is_active=True))
+    amount = forms.DecimalField(max_digits=5, decimal_places=2)
+
+    class Meta:
+        model = Transaction
+        fields = ['receiver', 'amount', 'description']
+
+    clean_amount = TransferForm.clean_amount
+
 class ServiceListingForm(forms.ModelForm):
     PREDEFINED_SKILLS = [
         'Tutoring', 'Cooking', 'Gardening', 'Pet Care', 'Child Care',
@@ -104,8 +140,8 @@ class ServiceListingForm(forms.ModelForm):
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        # If editing existing listing, populate with existing skills
-        if self.instance and self.instance.pk:
+        # If editing existing listing, populate with existing skills (a submitted form doesn't need them)
+        if self.instance and self.instance.pk and not self.is_bound:
             existing_skill_names = list(self.instance.skills.values_list('name', flat=True))
             
             # Separate predefined and custom skills
@@ -115,31 +151,16 @@ class ServiceListingForm(forms.ModelForm):
             self.fields['skills'].initial = predefined
             self.fields['other_skills'].initial = ', '.join(custom)
     
-    def save(self, commit=True):
-        instance = super().save(commit=False)
+    def _save_m2m(self):
+        # Runs from save(), or from save_m2m() after save(commit=False)
+        super()._save_m2m()
         
-        # Must save the instance first before working with many-to-many relationships
-        if commit:
-            instance.save()
-            
-            # Clear existing skills
-            instance.skills.clear()
-            
-            # Add selected predefined skills
-            selected_skills = self.cleaned_data.get('skills', [])
-            for skill_name in selected_skills:
-                skill, created = Skill.objects.get_or_create(name=skill_name)
-                instance.skills.add(skill)
-            
-            # Add custom skills from other_skills field
-            other_skills_text = self.cleaned_data.get('other_skills', '')
-            if other_skills_text:
-                skill_names = [name.strip() for name in other_skills_text.split(',') if name.strip()]
-                for skill_name in skill_names:
-                    skill, created = Skill.objects.get_or_create(name=skill_name)
-                    instance.skills.add(skill)
+        # Selected predefined skills plus the comma-separated custom ones
+        skill_names = list(self.cleaned_data.get('skills', []))
+        skill_names += self.cleaned_data.get('other_skills', '').split(',')
         
-        return instance
+        # Resolved from the registry, then applied as one diff against the current skills
+        self.instance.skills.set(skill_registry.resolve(skill_names))
 
 class ToolForm(forms.ModelForm):
     class Meta:
@@ -165,15 +186,25 @@ class ToolBorrowForm(forms.ModelForm):
 class EventForm(forms.ModelForm):
     class Meta:
         model = Event
-        fields = ['title', 'description', 'event_type', 'location', 'event_date', 'max_participants']
+        fields = ['title', 'description', 'event_type', 'location', 'event_date', 'recurrence', 'recurrence_end', 'max_participants']
         widgets = {
             'title': forms.TextInput(attrs={'class': 'form-control'}),
             'description': forms.Textarea(attrs={'class': 'form-control', 'rows': 4}),
             'event_type': forms.Select(attrs={'class': 'form-select'}),
             'location': forms.TextInput(attrs={'class': 'form-control'}),
             'event_date': forms.DateTimeInput(attrs={'class': 'form-control', 'type': 'datetime-local'}),
+            'recurrence': forms.Select(attrs={'class': 'form-select'}),
+            'recurrence_end': forms.DateTimeInput(attrs={'class': 'form-control', 'type': 'datetime-local'}),
             'max_participants': forms.NumberInput(attrs={'class': 'form-control'}),
         }
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        event_date = cleaned_data.get('event_date')
+        recurrence_end = cleaned_data.get('recurrence_end')
+        if event_date and recurrence_end and recurrence_end < event_date:
+            self.add_error('recurrence_end', "The last date must be after the first event date.")
+        return cleaned_data
 
 class ReviewForm(forms.ModelForm):
     class Meta:
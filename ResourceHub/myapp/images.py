@@ -0,0 +1,131 @@
+"""
+Resized variants of uploaded images (profile pictures and tool photos).
+
+Originals are kept as uploaded. Each variant is written next to them under
+`variants/` in both WebP and JPEG, with metadata stripped and dimensions
+capped, e.g. `profiles/alice.jpg` -> `profiles/variants/alice.avatar.1a2b3c4d.webp`.
+The middle part is VARIANTS_VERSION, a hash of the sizes and encoder settings:
+changing them gives every variant a new name, so browsers and proxies never
+keep an old rendition under a name that is cached as immutable.
+
+Once they are written, the image's row records it in the `<field>_variants`
+column next to the image field, so templates can link the variants without
+asking the storage whether they exist.
+"""
+import hashlib
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from .cache import bump_model
+
+logger = logging.getLogger(__name__)
+
+# name -> (width, height, crop). Cropped variants fill the box like `object-fit: cover`.
+VARIANTS = {
+    'avatar': (96, 96, True),     # navbar, inbox and listing avatars
+    'profile': (320, 320, True),  # profile page picture
+    'card': (640, 640, False),    # tool cards in the browse grid
+    'large': (settings.IMAGE_MAX_DIMENSION, settings.IMAGE_MAX_DIMENSION, False),
+}
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+VARIANTS_VERSION = hashlib.sha256(repr((VARIANTS, FORMATS)).encode()).hexdigest()[:8]
+
+_executor = ThreadPoolExecutor(max_workers=settings.IMAGE_WORKERS, thread_name_prefix='image-variants')
+
+
+def variant_name(name, variant, fmt):
+    """Storage name of a variant of the image stored at `name`"""
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    return posixpath.join(directory, 'variants', f'{stem}.{variant}.{VARIANTS_VERSION}.{fmt}')
+
+
+def variants_key(name):
+    """What `<field>_variants` holds once the current variants of the image at `name` exist"""
+    return f'{VARIANTS_VERSION}:{name}'
+
+
+def has_variants(field_file):
+    """Whether the variants of an image field's current file have been generated"""
+    recorded = getattr(field_file.instance, f'{field_file.field.name}_variants', '')
+    return recorded == variants_key(field_file.name)
+
+
+def _record_variants(field_file):
+    """Note on the image's row that its variants exist, unless it was replaced meanwhile"""
+    instance, column = field_file.instance, f'{field_file.field.name}_variants'
+    key = variants_key(field_file.name)
+    type(instance)._default_manager.filter(pk=instance.pk, **{field_file.field.name: field_file.name}).update(
+        **{column: key}
+    )
+    setattr(instance, column, key)
+    bump_model(type(instance))
+
+
+def _prepare(image):
+    """Apply EXIF orientation, then drop all metadata (EXIF, GPS, ICC, comments)"""
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    image.info = {}
+    return image
+
+
+def _encode(image, fmt):
+    pil_format, options = FORMATS[fmt]
+    if pil_format == 'JPEG' and image.mode == 'RGBA':
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    buffer = BytesIO()
+    image.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def generate_variants(field_file):
+    """Write every size/format variant for an uploaded image; returns the names written"""
+    storage = field_file.storage
+    with storage.open(field_file.name, 'rb') as source:
+        original = _prepare(Image.open(source))
+
+    written = []
+    for variant, (width, height, crop) in VARIANTS.items():
+        if crop:
+            resized = ImageOps.fit(original, (width, height), Image.Resampling.LANCZOS)
+        else:
+            resized = original.copy()
+            resized.thumbnail((width, height), Image.Resampling.LANCZOS)
+
+        for fmt in FORMATS:
+            # The storage replaces a variant in place with an atomic rename, so the name stays
+            # predictable for the template tag and is never missing while it is rewritten
+            name = variant_name(field_file.name, variant, fmt)
+            written.append(storage.save(name, ContentFile(_encode(resized, fmt))))
+    _record_variants(field_file)
+    return written
+
+
+def _generate_logged(field_file):
+    try:
+        generate_variants(field_file)
+    except Exception:
+        logger.exception("Could not generate image variants for %s", field_file.name)
+
+
+def schedule_variants(field_file):
+    """Generate variants in the background worker pool once the upload is committed"""
+    if not field_file:
+        return
+    transaction.on_commit(lambda: _executor.submit(_generate_logged, field_file))
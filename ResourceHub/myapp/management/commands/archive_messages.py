@@ -0,0 +1,55 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from myapp.admin import analyze_table
+from myapp.archive import archivable, archive_conversation
+from myapp.models import Conversation, Message
+
+class Command(BaseCommand):
+    help = ('Move old messages into compressed per-conversation archive segments '
+            '(run regularly, e.g. nightly from cron)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Archive messages older than this many days (default: MESSAGE_ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--segment-size', type=int, default=None,
+                            help='Messages per segment (default: MESSAGE_ARCHIVE_SEGMENT_SIZE)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Conversations per batch (default 500)')
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be archived')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else settings.MESSAGE_ARCHIVE_AFTER_DAYS
+        segment_size = options['segment_size'] or settings.MESSAGE_ARCHIVE_SEGMENT_SIZE
+        cutoff = timezone.now() - timedelta(days=days)
+
+        # Walk conversations by primary key so memory stays flat however many there are
+        candidates = Conversation.objects.filter(
+            Exists(Message.objects.filter(conversation=OuterRef('pk'), created_at__lt=cutoff))
+        ).order_by('pk').values_list('pk', flat=True)
+
+        last_id, conversations, moved = 0, 0, 0
+        while True:
+            batch = list(candidates.filter(pk__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            for conversation_id in batch:
+                if options['dry_run']:
+                    count = archivable(conversation_id, cutoff).count()
+                else:
+                    count = archive_conversation(conversation_id, cutoff, segment_size)
+                conversations += bool(count)
+                moved += count
+            last_id = batch[-1]
+            self.stdout.write(f'  {moved} messages from {conversations} conversations', ending='\r')
+
+        if moved and not options['dry_run']:
+            # The admin's message count comes from the table's statistics
+            analyze_table(Message)
+
+        verb = 'Would archive' if options['dry_run'] else 'Archived'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {moved} messages older than {days} days from {conversations} conversations.'
+        ))
@@ -0,0 +1,131 @@
+import json
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.urls import reverse
+from myapp.management.commands.db_loadtest import percentile
+from myapp.management.commands.generate_benchmark_data import BENCHMARK_PREFIX
+from myapp.models import Conversation, Event, ServiceListing, Tool
+
+
+class Command(BaseCommand):
+    help = ('Replay the main pages with the Django test client as one user and report latency '
+            'percentiles and SQL query counts per endpoint. Seed data first with generate_benchmark_data.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help='Timed requests per endpoint (default 50)')
+        parser.add_argument('--warmup', type=int, default=3, help='Untimed requests per endpoint first (default 3)')
+        parser.add_argument('--user', help='Username to browse as (default: the busiest benchmark user)')
+        parser.add_argument('--only', action='append', default=[], metavar='NAME',
+                            help='Only benchmark this endpoint (repeatable)')
+        parser.add_argument('--host', default='localhost', help='Host header to send; must be in ALLOWED_HOSTS')
+        parser.add_argument('--json', dest='json_path', help='Also write the results to this JSON file')
+        parser.add_argument('--rate-limits', action='store_true',
+                            help='Keep the rate limits on (by default they are off, as one user polls in a loop)')
+
+    def handle(self, *args, **options):
+        if options['rate_limits']:
+            return self._benchmark(options)
+        with override_settings(RATE_LIMIT_ENABLED=False):
+            return self._benchmark(options)
+
+    def _benchmark(self, options):
+        user = self._user(options['user'])
+        endpoints = self._endpoints(user)
+        if options['only']:
+            unknown = set(options['only']) - set(endpoints)
+            if unknown:
+                raise CommandError(f"Unknown endpoint(s) {', '.join(sorted(unknown))}; choose from {', '.join(endpoints)}")
+            endpoints = {name: url for name, url in endpoints.items() if name in options['only']}
+
+        client = Client(HTTP_HOST=options['host'])
+        client.force_login(user)
+
+        self.stdout.write(f"Browsing as {user.username}, {options['requests']} requests per endpoint\n")
+        self.stdout.write(f"{'Endpoint':<22}{'Status':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'Queries':>9}{'Max q':>7}")
+        results = {}
+        for name, url in endpoints.items():
+            for _ in range(options['warmup']):
+                client.get(url)
+
+            latencies, queries, statuses = [], [], set()
+            for _ in range(options['requests']):
+                started = time.perf_counter()
+                response = client.get(url)
+                latencies.append(time.perf_counter() - started)
+                statuses.add(response.status_code)
+                metrics = getattr(response.wsgi_request, 'metrics', None)
+                if metrics is not None:
+                    queries.append(metrics.queries)
+
+            latencies.sort()
+            result = {
+                'url': url,
+                'status': sorted(statuses),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+                'queries': statistics.median_low(queries) if queries else None,
+                'max_queries': max(queries) if queries else None,
+            }
+            results[name] = result
+            self.stdout.write(
+                f"{name:<22}{'/'.join(map(str, result['status'])):>7}{result['p50_ms']:>9}{result['p95_ms']:>9}"
+                f"{result['p99_ms']:>9}{result['queries'] if queries else '-':>9}{result['max_queries'] if queries else '-':>7}"
+            )
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump({'user': user.username, 'requests': options['requests'], 'endpoints': results}, output, indent=2)
+            self.stdout.write(f"\nWrote {options['json_path']}")
+
+    def _user(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f'No user named {username}')
+
+        # The benchmark user with the most conversations makes the inbox a realistic worst case
+        user = User.objects.filter(username__startswith=BENCHMARK_PREFIX).annotate(
+            conversation_count=Count('conversation_memberships')
+        ).order_by('-conversation_count').first()
+        if user is None:
+            raise CommandError('No benchmark users; run generate_benchmark_data first or pass --user')
+        return user
+
+    def _endpoints(self, user):
+        """URL name -> URL for the pages worth timing, filled in with this user's data"""
+        endpoints = {
+            'home': reverse('home'),
+            'dashboard': reverse('dashboard'),
+            'listing_browse': reverse('listing_browse'),
+            'listing_search': reverse('listing_browse') + '?q=garden',
+            'tool_browse': reverse('tool_browse'),
+            'event_browse': reverse('event_browse'),
+            'find_matches': reverse('find_matches'),
+            'inbox': reverse('inbox'),
+            'message_search': reverse('message_search') + '?q=garden+repair',
+            'notifications': reverse('notifications'),
+            'view_profile': reverse('view_profile', args=[user.username]),
+            'map_data': reverse('map_data'),
+            'check_updates': reverse('check_updates'),
+        }
+
+        conversation = Conversation.objects.filter(members__user=user).first()
+        if conversation:
+            endpoints['conversation_detail'] = reverse('conversation_detail', args=[conversation.pk])
+        listing = ServiceListing.objects.filter(is_active=True).order_by('-pk').first()
+        if listing:
+            endpoints['listing_detail'] = reverse('listing_detail', args=[listing.pk])
+        tool = Tool.objects.order_by('-pk').first()
+        if tool:
+            endpoints['tool_detail'] = reverse('tool_detail', args=[tool.pk])
+        event = Event.objects.filter(is_active=True).order_by('-pk').first()
+        if event:
+            endpoints['event_detail'] = reverse('event_detail', args=[event.pk])
+        return endpoints
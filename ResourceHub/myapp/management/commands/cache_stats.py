@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from myapp.cache import bump_namespace, namespace_version, stats
+
+class Command(BaseCommand):
+    help = 'Show cache hit ratios per namespace (totals across all worker processes)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the hit/miss counters')
+        parser.add_argument('--invalidate', metavar='NAMESPACE', action='append', default=[],
+                            help='Invalidate every key in a namespace (repeatable)')
+
+    def handle(self, *args, **options):
+        for namespace in options['invalidate']:
+            version = bump_namespace(namespace)
+            self.stdout.write(f'Invalidated {namespace} (now v{version})')
+
+        if options['reset']:
+            stats.reset()
+            self.stdout.write(self.style.SUCCESS('Cache statistics reset.'))
+            return
+
+        cache_settings = settings.CACHES['default']
+        self.stdout.write(f"Backend: {cache_settings['BACKEND']} ({cache_settings.get('LOCATION', '')})\n")
+        self.stdout.write(f"{'Namespace':<15}{'Version':>9}{'Hits':>10}{'Misses':>10}{'Hit ratio':>11}")
+
+        total_hits = total_misses = 0
+        for namespace, (hits, misses) in stats.snapshot().items():
+            total_hits += hits
+            total_misses += misses
+            ratio = f'{hits / (hits + misses):.1%}' if hits + misses else '-'
+            self.stdout.write(f'{namespace:<15}{namespace_version(namespace):>9}{hits:>10}{misses:>10}{ratio:>11}')
+
+        if total_hits + total_misses:
+            self.stdout.write(f'\nOverall hit ratio: {total_hits / (total_hits + total_misses):.1%}')
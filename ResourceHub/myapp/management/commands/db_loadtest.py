@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from myapp.models import Conversation, Message, Notification, Profile, Transaction
+
+LOADTEST_PREFIX = 'loadtest_'
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    help = ('Hammer the configured database with concurrent messaging and ledger writes. '
+            'Run it once per DB_* configuration to compare them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent workers (default 8)')
+        parser.add_argument('--seconds', type=float, default=10, help='How long to run (default 10)')
+        parser.add_argument('--configured-db', action='store_true',
+                            help='Write to the configured database instead of a temporary one')
+
+    def handle(self, *args, **options):
+        if options['configured_db']:
+            self._run(options)
+            return
+        with self._temporary_database():
+            self._run(options)
+
+    @contextmanager
+    def _temporary_database(self):
+        """
+        Point the default connection at a new, migrated database with the same engine and options,
+        the way `manage.py test` does: a file in a temporary directory for SQLite (an in-memory one
+        would not be shared by the worker threads), test_<name> for PostgreSQL.
+        """
+        temp_dir = tempfile.mkdtemp(prefix='db_loadtest-')
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(temp_dir, 'loadtest.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _run(self, options):
+        users = self._create_fixtures(options['threads'])
+        conversation = Conversation.objects.create(participant1=users[0], participant2=users[1])
+
+        stop_at = time.monotonic() + options['seconds']
+        results = []
+        lock = threading.Lock()
+
+        def worker(index):
+            sender, receiver = users[index % len(users)], users[(index + 1) % len(users)]
+            latencies, errors = [], 0
+            try:
+                while time.monotonic() < stop_at:
+                    started = time.perf_counter()
+                    try:
+                        if len(latencies) % 2:
+                            self._send_message(conversation, sender, receiver)
+                        else:
+                            self._transfer(sender, receiver)
+                        latencies.append(time.perf_counter() - started)
+                    except OperationalError:
+                        # "database is locked" and friends
+                        errors += 1
+            finally:
+                connections.close_all()
+            with lock:
+                results.append((latencies, errors))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options['threads'])]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        self._report(results, elapsed, options['threads'])
+        self._cleanup()
+
+    def _create_fixtures(self, count):
+        self._cleanup()
+        users = []
+        for i in range(max(count, 2)):
+            user = User.objects.create(username=f'{LOADTEST_PREFIX}{i}')
+            Profile.objects.get_or_create(user=user, defaults={'time_credits': Decimal('1000000')})
+            users.append(user)
+        return users
+
+    def _send_message(self, conversation, sender, receiver):
+        """The conversation_detail POST path: message, conversation touch, notification"""
+        with transaction.atomic():
+            Message.objects.create(conversation=conversation, sender=sender, recipient=receiver, body='load test')
+            Conversation.objects.filter(pk=conversation.pk).update(updated_at=timezone.now())
+            Notification.objects.create(user=receiver, notification_type='MESSAGE', message='load test')
+
+    def _transfer(self, sender, receiver):
+        """A ledger write: the transaction row plus both balances"""
+        amount = Decimal('0.50')
+        with transaction.atomic():
+            Transaction.objects.create(sender=sender, receiver=receiver, amount=amount, description='load test')
+            Profile.objects.filter(user=sender).update(time_credits=F('time_credits') - amount)
+            Profile.objects.filter(user=receiver).update(time_credits=F('time_credits') + amount)
+
+    def _report(self, results, elapsed, threads):
+        latencies = sorted(latency for worker_latencies, _ in results for latency in worker_latencies)
+        errors = sum(worker_errors for _, worker_errors in results)
+        settings_dict = connection.settings_dict
+
+        self.stdout.write(f"Backend:    {settings_dict['ENGINE']} ({settings_dict['NAME']})")
+        self.stdout.write(f"Options:    {settings_dict.get('OPTIONS', {})}")
+        self.stdout.write(f'Threads:    {threads}, {elapsed:.1f}s')
+        self.stdout.write(f'Writes:     {len(latencies)} ok, {errors} failed (locked)')
+        self.stdout.write(f'Throughput: {len(latencies) / elapsed:.0f} write transactions/s')
+        self.stdout.write('Latency:    p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms'.format(
+            *(percentile(latencies, pct) * 1000 for pct in (50, 95, 99))
+        ))
+
+    def _cleanup(self):
+        users = User.objects.filter(username__startswith=LOADTEST_PREFIX)
+        Transaction.objects.filter(sender__in=users).delete()
+        Conversation.objects.filter(participant1__in=users).delete()
+        Notification.objects.filter(user__in=users).delete()
+        users.delete()
@@ -0,0 +1,54 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from myapp.admin import analyze_table
+from myapp.models import OutboxEvent
+from myapp.outbox import drain
+
+PRUNE_EVERY = 3600  # seconds between clean-ups of processed events with --loop
+
+class Command(BaseCommand):
+    help = ('Carry out pending outbox events (notifications and messages from the credit and '
+            'borrow workflows). Run with --loop as a long-lived worker.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Events per transaction (default 100)')
+        parser.add_argument('--loop', action='store_true', help='Keep running, polling for new events')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to wait when idle with --loop (default 1)')
+        parser.add_argument('--keep-days', type=int, default=7,
+                            help='Delete processed events older than this many days (default 7)')
+
+    def handle(self, *args, **options):
+        processed = failed = 0
+        pruned = self._prune(options['keep_days'])
+        last_pruned = time.monotonic()
+        try:
+            while True:
+                done, errors = drain(options['batch_size'])
+                processed += done
+                failed += errors
+                if done:
+                    continue
+                if not options['loop']:
+                    break
+                if time.monotonic() - last_pruned > PRUNE_EVERY:
+                    pruned += self._prune(options['keep_days'])
+                    last_pruned = time.monotonic()
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {processed} events ({failed} failures, pruned {pruned} old events).'
+        ))
+
+    def _prune(self, keep_days):
+        deleted, _ = OutboxEvent.objects.filter(
+            processed_at__lt=timezone.now() - timedelta(days=keep_days)
+        ).delete()
+        if deleted:
+            # The admin's event count comes from the table's statistics
+            analyze_table(OutboxEvent)
+        return deleted
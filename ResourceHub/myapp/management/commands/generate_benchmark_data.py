@@ -0,0 +1,313 @@
+import math
+import random
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from myapp.cache import NAMESPACE_MODELS, bump_namespace
+from myapp.matching import refresh_all
+from myapp.search import index_messages
+from myapp.models import (Conversation, ConversationMember, Event, Message, MessageSearchTerm, Notification,
+                          Profile, ServiceListing, Skill, Tool, Transaction)
+
+BENCHMARK_PREFIX = 'bench_'
+KM_PER_DEGREE = 111.32
+
+SKILL_NAMES = [
+    'Tutoring', 'Cooking', 'Home Repair', 'Gardening', 'Tech Support', 'Language Teaching',
+    'Music Lessons', 'Pet Care', 'Carpentry', 'Plumbing', 'Electrical Work', 'Painting',
+    'Cleaning', 'Childcare', 'Elder Care', 'Transportation', 'Moving Help',
+    'Administrative Help', 'Photography', 'Web Design', 'Writing/Editing', 'Yoga',
+    'Fitness Training', 'Sewing', 'Auto Repair',
+]
+WORDS = ('help need offer weekend garden bike repair lesson dinner move paint fix dog walk '
+         'tutor math guitar spanish laptop shelf fence ride market plants recipe').split()
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@contextmanager
+def _explicit_timestamps(*fields):
+    """Let bulk_create write our spread-out timestamps instead of auto_now/auto_now_add"""
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = ('Generate a large synthetic dataset for benchmarking (users, listings, conversations, '
+            'messages, transactions, tools and events), written with bulk_create in batches. '
+            f'Users are named {BENCHMARK_PREFIX}<n> with password "password123".')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Users to create (default 1000)')
+        parser.add_argument('--listings-per-user', type=int, default=3, help='Service listings per user (default 3)')
+        parser.add_argument('--conversations-per-user', type=int, default=2, help='Conversations started by each user (default 2)')
+        parser.add_argument('--messages-per-conversation', type=int, default=20, help='Messages per conversation (default 20)')
+        parser.add_argument('--notifications-per-user', type=int, default=10, help='Notifications per user (default 10)')
+        parser.add_argument('--transactions', type=int, default=10000, help='Ledger transactions in total (default 10000)')
+        parser.add_argument('--tools-per-user', type=float, default=0.5, help='Tools per user, may be fractional (default 0.5)')
+        parser.add_argument('--events', type=int, default=50, help='Events in total (default 50)')
+        parser.add_argument('--center', default='52.370,4.890', help='LAT,LON the users are spread around')
+        parser.add_argument('--spread-km', type=float, default=25, help='Radius of the area users live in (default 25 km)')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per INSERT batch (default 5000)')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, for repeatable datasets')
+        parser.add_argument('--clear', action='store_true', help=f'Delete existing {BENCHMARK_PREFIX}* data first')
+
+    def handle(self, *args, **options):
+        try:
+            self.center = tuple(float(value) for value in options['center'].split(','))
+        except ValueError:
+            self.center = ()
+        if len(self.center) != 2:
+            raise CommandError('--center must look like LAT,LON')
+        if options['users'] < 2:
+            raise CommandError('--users must be at least 2')
+
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.now = timezone.now()
+        started = time.monotonic()
+
+        if options['clear']:
+            self._clear()
+        elif User.objects.filter(username__startswith=BENCHMARK_PREFIX).exists():
+            raise CommandError(f'{BENCHMARK_PREFIX}* users already exist; pass --clear to replace them')
+
+        user_ids = self._step('users and profiles', self._create_users, options['users'], options['spread_km'])
+        skill_ids = self._step('skills', self._create_skills)
+        self._step('listings', self._create_listings, user_ids, skill_ids, options['listings_per_user'])
+        self._step('listing matches', refresh_all)
+        conversations = self._step('conversations', self._create_conversations, user_ids, options['conversations_per_user'])
+        self._step('messages', self._create_messages, conversations, options['messages_per_conversation'])
+        self._step('message search index', self._index_messages)
+        self._step('notifications', self._create_notifications, user_ids, options['notifications_per_user'])
+        self._step('transactions', self._create_transactions, user_ids, options['transactions'])
+        self._step('tools', self._create_tools, user_ids, options['tools_per_user'])
+        self._step('events', self._create_events, user_ids, options['events'])
+
+        # bulk_create sends no signals, so the cached pages would not notice the new rows
+        for namespace in NAMESPACE_MODELS:
+            bump_namespace(namespace)
+
+        self.stdout.write(self.style.SUCCESS(f'Done in {time.monotonic() - started:.1f}s.'))
+
+    def _step(self, label, create, *args):
+        started = time.monotonic()
+        result = create(*args)
+        count = result if isinstance(result, int) else len(result)
+        self.stdout.write(f'  {label:<22}{count:>10} rows  {time.monotonic() - started:6.1f}s')
+        return result
+
+    def _bulk_create(self, model, rows):
+        """Insert rows (any iterable) batch by batch; returns the number written"""
+        written = 0
+        for batch in _chunks(rows, self.batch_size):
+            with transaction.atomic():
+                model.objects.bulk_create(batch, batch_size=self.batch_size)
+            written += len(batch)
+        return written
+
+    def _bulk_create_returning(self, model, rows):
+        """Like _bulk_create, but keep the saved objects (SQLite and PostgreSQL return their pks)"""
+        created = []
+        for batch in _chunks(rows, self.batch_size):
+            with transaction.atomic():
+                created.extend(model.objects.bulk_create(batch, batch_size=self.batch_size))
+        return created
+
+    def _past(self, days):
+        return self.now - timedelta(seconds=self.rng.uniform(0, days * 86400))
+
+    def _location(self, spread_km):
+        """A uniformly random point within spread_km of the center"""
+        lat, lon = self.center
+        distance = spread_km * math.sqrt(self.rng.random())
+        angle = self.rng.uniform(0, 2 * math.pi)
+        dlat = distance * math.cos(angle) / KM_PER_DEGREE
+        dlon = distance * math.sin(angle) / (KM_PER_DEGREE * math.cos(math.radians(lat)))
+        return Decimal(f'{lat + dlat:.6f}'), Decimal(f'{lon + dlon:.6f}')
+
+    def _create_users(self, count, spread_km):
+        password = make_password('password123')  # hashing once keeps this step fast
+        self._bulk_create(User, (
+            User(username=f'{BENCHMARK_PREFIX}{n}', first_name='Bench', last_name=str(n),
+                 email=f'{BENCHMARK_PREFIX}{n}@example.com', password=password,
+                 date_joined=self._past(365))
+            for n in range(count)
+        ))
+        user_ids = list(User.objects.filter(username__startswith=BENCHMARK_PREFIX).values_list('id', flat=True))
+
+        def profiles():
+            for user_id in user_ids:
+                latitude, longitude = self._location(spread_km)
+                yield Profile(user_id=user_id, location='Benchmark City', latitude=latitude, longitude=longitude,
+                              time_credits=Decimal(self.rng.randint(0, 50)), bio=_text(self.rng, 12))
+
+        self._bulk_create(Profile, profiles())
+        return user_ids
+
+    def _create_skills(self):
+        Skill.objects.bulk_create([Skill(name=name) for name in SKILL_NAMES], ignore_conflicts=True)
+        return list(Skill.objects.values_list('id', flat=True))
+
+    def _create_listings(self, user_ids, skill_ids, per_user):
+        listings = self._bulk_create_returning(ServiceListing, (
+            ServiceListing(user_id=user_id, title=_text(self.rng, 4), description=_text(self.rng, 30),
+                           listing_type=self.rng.choice(('OFFER', 'REQUEST')))
+            for user_id in user_ids for _ in range(per_user)
+        ))
+        through = ServiceListing.skills.through
+        self._bulk_create(through, (
+            through(servicelisting_id=listing.pk, skill_id=skill_id)
+            for listing in listings
+            for skill_id in self.rng.sample(skill_ids, self.rng.randint(1, 3))
+        ))
+        return len(listings)
+
+    def _create_conversations(self, user_ids, per_user):
+        """Conversations between distinct pairs of users, with their participants"""
+        pairs = set()
+        for user_id in user_ids:
+            for _ in range(per_user):
+                other_id = self.rng.choice(user_ids)
+                if other_id != user_id and (other_id, user_id) not in pairs:
+                    pairs.add((user_id, other_id))
+
+        # bulk_create skips Conversation.save(), which fills in the pair key and members
+        with _explicit_timestamps(Conversation._meta.get_field('created_at')):
+            conversations = self._bulk_create_returning(Conversation, (
+                Conversation(participant1_id=first, participant2_id=second, created_at=self._past(180),
+                             pair_key=Conversation.make_pair_key(first, second))
+                for first, second in pairs
+            ))
+        self._bulk_create(ConversationMember, (
+            ConversationMember(conversation_id=conversation.pk, user_id=user_id)
+            for conversation in conversations
+            for user_id in (conversation.participant1_id, conversation.participant2_id)
+        ))
+        return conversations
+
+    def _create_messages(self, conversations, per_conversation):
+        """Alternating messages spread between each conversation's start and now; the last ones unread"""
+        # Building a fresh body per row dominated the run time; reuse a pool of them
+        bodies = [_text(self.rng, self.rng.randint(3, 40)) for _ in range(2000)]
+
+        def messages():
+            for conversation in conversations:
+                participants = (conversation.participant1_id, conversation.participant2_id)
+                span = (self.now - conversation.created_at).total_seconds()
+                offsets = sorted(self.rng.uniform(0, span) for _ in range(per_conversation))
+                unread_from = per_conversation - self.rng.randint(0, 3)
+                for index, offset in enumerate(offsets):
+                    sender = participants[index % 2] if self.rng.random() < 0.8 else participants[1 - index % 2]
+                    yield Message(
+                        conversation_id=conversation.pk, sender_id=sender,
+                        recipient_id=participants[1] if sender == participants[0] else participants[0],
+                        body=self.rng.choice(bodies), is_read=index < unread_from,
+                        created_at=conversation.created_at + timedelta(seconds=offset),
+                    )
+
+        with _explicit_timestamps(Message._meta.get_field('created_at')):
+            written = self._bulk_create(Message, messages())
+
+        # Conversations are listed by their latest activity
+        with _explicit_timestamps(Conversation._meta.get_field('updated_at')):
+            for batch in _chunks(conversations, self.batch_size):
+                for conversation in batch:
+                    conversation.updated_at = self.now - timedelta(seconds=self.rng.uniform(0, 86400 * 30))
+                with transaction.atomic():
+                    Conversation.objects.bulk_update(batch, ['updated_at'], batch_size=self.batch_size)
+        return written
+
+    def _index_messages(self):
+        """bulk_create skipped Message.save(), which indexes a message for search"""
+        messages = Message.objects.filter(sender__username__startswith=BENCHMARK_PREFIX)
+        rows = 0
+        for _, rows in index_messages(messages, self.batch_size):
+            pass
+        return rows
+
+    def _create_notifications(self, user_ids, per_user):
+        types = [code for code, _ in Notification.NOTIFICATION_TYPES]
+        with _explicit_timestamps(Notification._meta.get_field('created_at')):
+            return self._bulk_create(Notification, (
+                Notification(user_id=user_id, notification_type=self.rng.choice(types),
+                             message=_text(self.rng, 8), is_read=self.rng.random() < 0.7,
+                             created_at=self._past(60))
+                for user_id in user_ids for _ in range(per_user)
+            ))
+
+    def _create_transactions(self, user_ids, count):
+        def transactions():
+            for _ in range(count):
+                sender_id, receiver_id = self.rng.sample(user_ids, 2)
+                yield Transaction(sender_id=sender_id, receiver_id=receiver_id,
+                                  amount=Decimal(self.rng.randint(1, 8)) / 2,
+                                  description=_text(self.rng, 5), timestamp=self._past(365))
+
+        return self._bulk_create(Transaction, transactions())
+
+    def _create_tools(self, user_ids, per_user):
+        owners = self.rng.sample(user_ids, min(len(user_ids), round(len(user_ids) * per_user)))
+        return self._bulk_create(Tool, (
+            Tool(owner_id=owner_id, name=_text(self.rng, 2), description=_text(self.rng, 20),
+                 is_available=self.rng.random() < 0.8)
+            for owner_id in owners
+        ))
+
+    def _create_events(self, user_ids, count):
+        recurrences = [code for code, _ in Event.RECURRENCE_CHOICES]
+        event_types = [code for code, _ in Event.EVENT_TYPE_CHOICES]
+        events = self._bulk_create_returning(Event, (
+            Event(organizer_id=self.rng.choice(user_ids), title=_text(self.rng, 3),
+                  description=_text(self.rng, 25), event_type=self.rng.choice(event_types),
+                  location='Benchmark City', event_date=self.now + timedelta(days=self.rng.uniform(-30, 60)),
+                  max_participants=self.rng.choice([None, 10, 25, 50]), recurrence=self.rng.choice(recurrences))
+            for _ in range(count)
+        ))
+        through = Event.participants.through
+        self._bulk_create(through, (
+            through(event_id=event.pk, user_id=user_id)
+            for event in events
+            for user_id in self.rng.sample(user_ids, min(len(user_ids), self.rng.randint(0, 20)))
+        ))
+        for event in events:
+            event.materialize_occurrences()
+        return len(events)
+
+    def _clear(self):
+        users = User.objects.filter(username__startswith=BENCHMARK_PREFIX)
+        # Delete the bulky tables first with plain DELETEs instead of the cascade collector, which
+        # would load every message to find its search terms: those go first, by the same filter
+        for rows in (MessageSearchTerm.objects.filter(message__sender__in=users), Message.objects.filter(sender__in=users)):
+            rows._raw_delete(rows.db)
+        Notification.objects.filter(user__in=users).delete()
+        Transaction.objects.filter(sender__in=users).delete()
+        Transaction.objects.filter(receiver__in=users).delete()
+        deleted, _ = users.delete()
+        self.stdout.write(f'  cleared {deleted} rows')
@@ -0,0 +1,33 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from myapp.images import generate_variants
+from myapp.models import Profile, Tool
+from myapp.storage import content_digest
+
+class Command(BaseCommand):
+    help = 'Move uploads saved under their original names to content-addressed names'
+
+    def handle(self, *args, **options):
+        sources = [
+            ('profile pictures', Profile, 'profile_picture'),
+            ('tool photos', Tool, 'image'),
+        ]
+
+        for label, model, field_name in sources:
+            moved = 0
+            queryset = model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+            for obj in queryset.only('pk', field_name).iterator():
+                field_file = getattr(obj, field_name)
+                if content_digest(field_file.name) or not default_storage.exists(field_file.name):
+                    continue
+
+                with default_storage.open(field_file.name, 'rb') as source:
+                    new_name = default_storage.save(field_file.name, source)
+                # Old files are left in place; identical uploads now resolve to one stored copy
+                model.objects.filter(pk=obj.pk).update(**{field_name: new_name})
+                field_file.name = new_name
+                generate_variants(field_file)
+                moved += 1
+            self.stdout.write(f'  {label}: {moved} moved')
+
+        self.stdout.write(self.style.SUCCESS('✅ Media is content-addressed.'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from myapp.models import Message, MessageSearchTerm
+from myapp.search import index_messages
+
+class Command(BaseCommand):
+    help = ('Rebuild the message search index from scratch, e.g. after messages were '
+            'imported with bulk_create or the tokenizer changed')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Messages per batch (default 2000)')
+
+    def handle(self, *args, **options):
+        deleted, _ = MessageSearchTerm.objects.all().delete()
+        self.stdout.write(f'Removed {deleted} old index rows.')
+
+        indexed, rows = 0, 0
+        for indexed, rows in index_messages(Message.objects.all(), options['batch_size']):
+            self.stdout.write(f'  {indexed} messages indexed', ending='\r')
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} messages ({rows} index rows).'))
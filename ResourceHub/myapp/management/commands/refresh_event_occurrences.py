@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+from myapp.models import Event, EventOccurrence
+
+class Command(BaseCommand):
+    help = 'Roll the materialized event occurrence window forward (run daily, e.g. from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--weeks', type=int, default=None,
+                            help='Weeks of upcoming occurrences to keep (default: EVENT_OCCURRENCE_WEEKS)')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+
+        # Past occurrences are never read by the browse pages
+        pruned, _ = EventOccurrence.objects.filter(start__lt=now).delete()
+        EventOccurrence.objects.filter(event__is_active=False).delete()
+
+        # Only series that can still produce upcoming dates need expanding
+        events = Event.objects.filter(is_active=True).filter(
+            Q(recurrence='NONE', event_date__gte=now) |
+            (~Q(recurrence='NONE') & (Q(recurrence_end__isnull=True) | Q(recurrence_end__gte=now)))
+        )
+
+        total = 0
+        for event in events.iterator():
+            total += event.materialize_occurrences(weeks=options['weeks'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Materialized {total} upcoming occurrences (pruned {pruned} past rows).'
+        ))
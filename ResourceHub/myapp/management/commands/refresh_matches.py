@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+from myapp.matching import refresh_all
+
+class Command(BaseCommand):
+    help = 'Recompute every listing\'s precomputed matches from scratch (run nightly, e.g. from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Listings per batch (default 200)')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        created = refresh_all(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Refreshed listing matches ({created} new) in {time.monotonic() - started:.1f}s.'
+        ))
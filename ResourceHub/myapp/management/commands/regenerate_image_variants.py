@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from myapp.images import generate_variants
+from myapp.models import Profile, Tool
+
+class Command(BaseCommand):
+    help = 'Generate resized image variants for existing profile pictures and tool photos'
+
+    def handle(self, *args, **options):
+        sources = [
+            ('profile pictures', Profile.objects.exclude(profile_picture='').exclude(profile_picture__isnull=True), 'profile_picture'),
+            ('tool photos', Tool.objects.exclude(image='').exclude(image__isnull=True), 'image'),
+        ]
+
+        for label, queryset, field_name in sources:
+            done = failed = 0
+            for obj in queryset.only('pk', field_name).iterator():
+                field_file = getattr(obj, field_name)
+                try:
+                    generate_variants(field_file)
+                    done += 1
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'  Skipped {field_file.name}: {e}')
+            self.stdout.write(f'  {label}: {done} processed, {failed} skipped')
+
+        self.stdout.write(self.style.SUCCESS('✅ Image variants regenerated.'))
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from myapp.matching import send_match_alerts
+
+class Command(BaseCommand):
+    help = 'Notify listing owners about their new high-scoring matches (run every 15 minutes, e.g. from cron)'
+
+    def handle(self, *args, **options):
+        notified = send_match_alerts()
+        self.stdout.write(self.style.SUCCESS(f'Sent new-match alerts to {notified} users.'))
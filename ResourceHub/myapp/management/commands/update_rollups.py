@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from myapp.models import DailyActiveUser, DailyStat, RollupWatermark
+from myapp.rollups import SOURCES, count_new_rows, recompute
+
+class Command(BaseCommand):
+    help = 'Bring the analytics rollups up to date (run every few minutes, e.g. from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Source rows counted per transaction (default 5000)')
+        parser.add_argument('--recompute-days', type=int, default=None,
+                            help='Past days to recompute tool lending and event turnout for '
+                                 '(default: ROLLUP_RECOMPUTE_DAYS; use a large value after --rebuild)')
+        parser.add_argument('--rebuild', action='store_true', help='Delete all rollups and count everything again')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        if options['rebuild']:
+            with transaction.atomic():
+                DailyStat.objects.all().delete()
+                DailyActiveUser.objects.all().delete()
+                RollupWatermark.objects.all().delete()
+
+        for source in SOURCES:
+            total = 0
+            while True:
+                counted = count_new_rows(source, batch_size=options['batch_size'])
+                if not counted:
+                    break
+                total += counted
+                self.stdout.write(f'  {source}: {total} rows', ending='\r')
+            self.stdout.write(f'  {source:<14}{total:>10} new rows')
+
+        recompute(days=options['recompute_days'])
+        self.stdout.write(self.style.SUCCESS(f'Rollups updated in {time.monotonic() - started:.1f}s.'))
@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from myapp.template_backends import warm_templates
+
+class Command(BaseCommand):
+    help = ('Compile every template and fail on syntax errors (run at deploy). Web workers warm their own '
+            'template cache at startup through ResourceHub/wsgi.py and asgi.py.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        compiled, errors = warm_templates()
+        elapsed = time.monotonic() - started
+        for name, error in errors.items():
+            self.stderr.write(f'{name}: {error}')
+        if errors:
+            raise CommandError(f'{len(errors)} template(s) failed to compile.')
+        self.stdout.write(self.style.SUCCESS(f'Compiled {len(compiled)} templates in {elapsed * 1000:.0f}ms.'))
@@ -0,0 +1,255 @@
+"""
+Precomputed matches between offers and requests.
+
+Every active listing keeps its best MATCHES_PER_LISTING counterparts (offers
+for a request, requests for an offer, by other users, sharing at least one
+skill) as ListingMatch rows: nearest first, then most shared skills. The
+matches page only reads these rows.
+
+Creating or editing a listing, or changing its skills, queues a rescore through
+the outbox (myapp/outbox.py). The rescore finds candidates through the skill
+index, rebuilds the listing's own list and updates the lists of the
+counterparts it enters, moves in or leaves; nothing else is recomputed. Owners
+moving house are picked up by the nightly `manage.py refresh_matches`.
+
+When a listing enters another user's list sharing at least
+MATCH_ALERT_MIN_SKILLS skills (or all of its own, if it has fewer), the row is
+flagged, and `manage.py send_match_alerts` tells each owner about their new
+matches in one notification.
+"""
+from collections import Counter, defaultdict
+from math import asin, cos, radians, sin, sqrt
+
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+
+from .models import ListingMatch, Notification, Profile, ServiceListing
+from .outbox import enqueue, handler
+
+MATCHES_PER_LISTING = 20
+MATCH_ALERT_MIN_SKILLS = 2
+
+COUNTERPART_TYPE = {'OFFER': 'REQUEST', 'REQUEST': 'OFFER'}
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """
+    Calculate the great circle distance in kilometers between two points
+    on the earth (specified in decimal degrees)
+    """
+    if not all([lat1, lon1, lat2, lon2]):
+        return float('inf')  # Return infinity if coordinates are missing
+
+    # Convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = map(radians, [float(lon1), float(lat1), float(lon2), float(lat2)])
+
+    # Haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(a))
+    km = 6371 * c  # Radius of earth in kilometers
+    return km
+
+
+def _distance(lat1, lon1, lat2, lon2):
+    km = calculate_distance(lat1, lon1, lat2, lon2)
+    return None if km == float('inf') else round(km, 3)
+
+
+def _rank(item):
+    """Sort key for a (matched listing id, (score, distance)) entry: nearest, then most shared skills"""
+    matched_id, (score, distance) = item
+    return (distance if distance is not None else float('inf'), -score, matched_id)
+
+
+def _top(entries):
+    return dict(sorted(entries.items(), key=_rank)[:MATCHES_PER_LISTING])
+
+
+def _location(user_id):
+    return Profile.objects.filter(user_id=user_id).values_list('latitude', 'longitude').first() or (None, None)
+
+
+def _candidates(listing, skill_ids, location):
+    """{listing id: (shared skills, distance)} for every counterpart of listing, found through the skill index"""
+    if not listing.is_active or not skill_ids:
+        return {}
+    rows = ServiceListing.objects.filter(
+        listing_type=COUNTERPART_TYPE[listing.listing_type], is_active=True, skills__in=skill_ids
+    ).exclude(
+        user_id=listing.user_id
+    ).values(
+        'pk', 'user__profile__latitude', 'user__profile__longitude'
+    ).annotate(score=Count('pk')).order_by()
+    return {
+        row['pk']: (row['score'], _distance(*location, row['user__profile__latitude'], row['user__profile__longitude']))
+        for row in rows
+    }
+
+
+def _own_list(listing):
+    skill_ids = list(listing.skills.values_list('pk', flat=True))
+    return _top(_candidates(listing, skill_ids, _location(listing.user_id)))
+
+
+def _save_lists(lists, alerts=()):
+    """
+    Make each listing's stored matches equal lists[listing id] ({matched id: (score, distance)}).
+    Rows that stay are updated in place, so their alert state survives; new rows listed
+    in alerts as (listing id, matched id) are flagged for send_match_alerts.
+    """
+    stored = defaultdict(dict)
+    for row in ListingMatch.objects.filter(listing_id__in=list(lists)):
+        stored[row.listing_id][row.matched_listing_id] = row
+
+    created, updated, deleted = [], [], []
+    for listing_id, entries in lists.items():
+        current = stored[listing_id]
+        for matched_id, (score, distance) in entries.items():
+            row = current.pop(matched_id, None)
+            if row is None:
+                created.append(ListingMatch(listing_id=listing_id, matched_listing_id=matched_id, score=score,
+                                            distance_km=distance, alert_pending=(listing_id, matched_id) in alerts))
+            elif (row.score, row.distance_km) != (score, distance):
+                row.score, row.distance_km = score, distance
+                updated.append(row)
+        deleted.extend(row.pk for row in current.values())
+
+    with transaction.atomic():
+        ListingMatch.objects.filter(pk__in=deleted).delete()
+        ListingMatch.objects.bulk_update(updated, ['score', 'distance_km'], batch_size=500)
+        ListingMatch.objects.bulk_create(created, batch_size=500, ignore_conflicts=True)
+    return len(created)
+
+
+def rescore(listing_id):
+    """Rebuild a listing's matches and its place in the lists of its counterparts"""
+    listing = ServiceListing.objects.filter(pk=listing_id).first()
+    if listing is None:
+        return
+    skill_ids = list(listing.skills.values_list('pk', flat=True))
+    candidates = _candidates(listing, skill_ids, _location(listing.user_id))
+    lists = {listing.pk: _top(candidates)}
+
+    # Every counterpart that lists this listing now, or might from now on
+    affected = set(candidates) | set(
+        ListingMatch.objects.filter(matched_listing=listing).values_list('listing_id', flat=True)
+    )
+    stored = defaultdict(dict)
+    rows = ListingMatch.objects.filter(listing_id__in=affected).values_list(
+        'listing_id', 'matched_listing_id', 'score', 'distance_km'
+    )
+    for counterpart_id, matched_id, score, distance in rows:
+        stored[counterpart_id][matched_id] = (score, distance)
+
+    alert_threshold = min(MATCH_ALERT_MIN_SKILLS, len(skill_ids))
+    alerts, refill = set(), []
+    for counterpart_id in affected:
+        entries = stored[counterpart_id]
+        was_full = len(entries) >= MATCHES_PER_LISTING
+        before = entries.pop(listing.pk, None)
+        after = candidates.get(counterpart_id)
+        if was_full and before is not None and (after is None or _rank((0, after)) > _rank((0, before))):
+            # This listing dropped out of a full list or fell down it, so a listing that did
+            # not make the cut before may belong in it now
+            refill.append(counterpart_id)
+            continue
+        if after is not None:
+            entries[listing.pk] = after
+        lists[counterpart_id] = _top(entries)
+        if before is None and listing.pk in lists[counterpart_id] and after[0] >= alert_threshold:
+            alerts.add((counterpart_id, listing.pk))
+
+    for counterpart in ServiceListing.objects.filter(pk__in=refill):
+        lists[counterpart.pk] = _own_list(counterpart)
+    _save_lists(lists, alerts)
+
+
+def refresh_all(batch_size=200):
+    """Recompute every listing's list from scratch (no alerts). Returns the number of new rows."""
+    ListingMatch.objects.filter(listing__is_active=False).delete()
+    listings = ServiceListing.objects.filter(is_active=True).order_by('pk')
+    through = ServiceListing.skills.through
+
+    # Walk by primary key so memory stays flat however many listings there are
+    last_id, created = 0, 0
+    while True:
+        batch = list(listings.filter(pk__gt=last_id)[:batch_size])
+        if not batch:
+            return created
+        skills = defaultdict(list)
+        for listing_id, skill_id in through.objects.filter(
+            servicelisting_id__in=[listing.pk for listing in batch]
+        ).values_list('servicelisting_id', 'skill_id'):
+            skills[listing_id].append(skill_id)
+        locations = {
+            user_id: (lat, lon) for user_id, lat, lon in Profile.objects.filter(
+                user_id__in={listing.user_id for listing in batch}
+            ).values_list('user_id', 'latitude', 'longitude')
+        }
+        created += _save_lists({
+            listing.pk: _top(_candidates(listing, skills[listing.pk], locations.get(listing.user_id, (None, None))))
+            for listing in batch
+        })
+        last_id = batch[-1].pk
+
+
+def send_match_alerts():
+    """One notification per owner for their listings' new matches. Returns how many owners were told."""
+    with transaction.atomic():
+        pending = list(ListingMatch.objects.select_for_update(skip_locked=True, of=('self',)).filter(
+            alert_pending=True
+        ).values_list('pk', 'listing__user_id'))
+        if not pending:
+            return 0
+
+        per_user = Counter(user_id for _, user_id in pending)
+        Notification.objects.bulk_create([
+            Notification(
+                user_id=user_id,
+                notification_type='NEW_MATCH',
+                message=f"{count} new match{'es' if count > 1 else ''} for your listings",
+                link='/matches/',
+            )
+            for user_id, count in per_user.items()
+        ])
+        ListingMatch.objects.filter(pk__in=[pk for pk, _ in pending]).update(alert_pending=False)
+    return len(per_user)
+
+
+@handler('rescore_listing')
+def _rescore_listing(listing_id):
+    rescore(listing_id)
+
+
+@handler('refill_matches')
+def _refill_matches(listing_ids):
+    _save_lists({listing.pk: _own_list(listing) for listing in ServiceListing.objects.filter(pk__in=listing_ids)})
+
+
+def connect_signals():
+    """Queue a rescore whenever a listing or its skills change"""
+    def listing_saved(sender, instance, created, raw=False, **kwargs):
+        # A new listing has no skills yet; adding them queues the rescore
+        if not created and not raw:
+            enqueue('rescore_listing', listing_id=instance.pk)
+
+    def skills_changed(sender, instance, action, reverse, pk_set, **kwargs):
+        if action not in ('post_add', 'post_remove', 'post_clear'):
+            return
+        # Changed from the skill's side (skill.listings.add(...)), the listings are in pk_set
+        listing_ids = (pk_set or []) if reverse else [instance.pk]
+        for listing_id in listing_ids:
+            enqueue('rescore_listing', listing_id=listing_id)
+
+    def listing_deleted(sender, instance, **kwargs):
+        # Its rows go with it (CASCADE), leaving gaps in the lists it was part of
+        listing_ids = list(ListingMatch.objects.filter(matched_listing=instance).values_list('listing_id', flat=True))
+        if listing_ids:
+            enqueue('refill_matches', listing_ids=listing_ids)
+
+    post_save.connect(listing_saved, sender=ServiceListing, weak=False, dispatch_uid='matching-listing-saved')
+    m2m_changed.connect(skills_changed, sender=ServiceListing.skills.through, weak=False, dispatch_uid='matching-skills')
+    pre_delete.connect(listing_deleted, sender=ServiceListing, weak=False, dispatch_uid='matching-listing-deleted')
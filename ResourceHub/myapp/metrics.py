@@ -0,0 +1,179 @@
+"""
+Per-request performance metrics.
+
+QueryInstrumentationMiddleware (myapp/middleware.py) measures every request:
+how many SQL queries it ran, the time spent in the database, the time spent
+rendering templates (see myapp/template_backends.py) and the total time.
+The latest samples are kept in memory per URL name, and `registry.summary()`
+turns them into rolling percentiles. Render times are also kept per
+template a view renders (includes and parents count towards it), for
+`registry.template_summary()`. Each worker process keeps its own samples.
+
+Views declare how many queries they may issue with @query_budget(n).
+Requests over budget are logged, and myapp/testing.py turns the budget into
+a test assertion.
+"""
+import logging
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_WINDOW = 500  # samples kept per URL name (and per template)
+
+_current = ContextVar('request_metrics', default=None)
+
+
+def query_budget(max_queries):
+    """Declare the most SQL queries a view may issue per request"""
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+    return decorator
+
+
+class RequestMetrics:
+    """What one request spent its time on"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.total_time = 0.0
+        self._rendering = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        """connection.execute_wrapper hook: time every query"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+    def finish(self):
+        self.total_time = time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Value for the Server-Timing response header (durations in ms)"""
+        return (
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries", '
+            f'tpl;dur={self.template_time * 1000:.1f};desc="Templates", '
+            f'total;dur={self.total_time * 1000:.1f}'
+        )
+
+
+@contextmanager
+def collecting():
+    """Make a fresh RequestMetrics the current one for the duration of the block"""
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def rendering(template_name=None):
+    """Add the time spent in the block to the current request's template time, and to template_name's samples"""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+
+    # Templates rendered from inside another template are part of the outer render
+    metrics._rendering += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics._rendering -= 1
+        if not metrics._rendering:
+            elapsed = time.perf_counter() - start
+            metrics.template_time += elapsed
+            if template_name:
+                registry.record_template(template_name, elapsed)
+
+
+def _percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class MetricsRegistry:
+    """Rolling windows of request samples, keyed by URL name, and of render times, keyed by template"""
+
+    def __init__(self, window=SAMPLE_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._renders = defaultdict(lambda: deque(maxlen=window))
+        self._budgets = {}
+        self._over_budget = defaultdict(int)
+
+    def record(self, name, metrics, budget=None):
+        sample = (metrics.total_time, metrics.db_time, metrics.template_time, metrics.queries)
+        with self._lock:
+            self._samples[name].append(sample)
+            if budget is not None:
+                self._budgets[name] = budget
+                if metrics.queries > budget:
+                    self._over_budget[name] += 1
+        if budget is not None and metrics.queries > budget:
+            logger.warning('%s issued %d queries (budget %d)', name, metrics.queries, budget)
+
+    def record_template(self, template_name, seconds):
+        with self._lock:
+            self._renders[template_name].append(seconds)
+
+    def summary(self):
+        """Percentiles per URL name over the current windows (times in ms)"""
+        with self._lock:
+            samples = {name: list(window) for name, window in self._samples.items()}
+            budgets = dict(self._budgets)
+            over_budget = dict(self._over_budget)
+
+        summary = {}
+        for name, window in sorted(samples.items()):
+            total, db, tpl, queries = (sorted(column) for column in zip(*window))
+            summary[name] = {
+                'requests': len(window),
+                'total_ms': {p: round(_percentile(total, f) * 1000, 1) for p, f in (('p50', .5), ('p95', .95), ('p99', .99))},
+                'db_ms': {p: round(_percentile(db, f) * 1000, 1) for p, f in (('p50', .5), ('p95', .95))},
+                'template_ms': {p: round(_percentile(tpl, f) * 1000, 1) for p, f in (('p50', .5), ('p95', .95))},
+                'queries': {'p50': _percentile(queries, .5), 'p95': _percentile(queries, .95), 'max': queries[-1]},
+                'query_budget': budgets.get(name),
+                'over_budget': over_budget.get(name, 0),
+            }
+        return summary
+
+    def template_summary(self):
+        """Render-time percentiles per template, slowest p95 first (times in ms)"""
+        with self._lock:
+            renders = {name: sorted(window) for name, window in self._renders.items()}
+
+        summary = {
+            name: {
+                'renders': len(times),
+                'render_ms': {p: round(_percentile(times, f) * 1000, 1) for p, f in (('p50', .5), ('p95', .95), ('p99', .99))},
+            }
+            for name, times in renders.items()
+        }
+        return dict(sorted(summary.items(), key=lambda item: -item[1]['render_ms']['p95']))
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._renders.clear()
+            self._budgets.clear()
+            self._over_budget.clear()
+
+
+registry = MetricsRegistry()
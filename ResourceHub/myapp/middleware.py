@@ -0,0 +1,55 @@
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from .metrics import collecting, registry
+from .routers import replica_reads
+
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+REPLICA_PIN_COOKIE = 'pin_primary'
+
+
+class ReplicaRoutingMiddleware:
+    """Let read-only requests use the read replica, and pin writers to the primary for a while"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        allowed = request.method in READ_ONLY_METHODS and REPLICA_PIN_COOKIE not in request.COOKIES
+        with replica_reads(allowed) as wrote_to_primary:
+            response = self.get_response(request)
+            if wrote_to_primary():
+                response.set_cookie(
+                    REPLICA_PIN_COOKIE, '1',
+                    max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite='Lax',
+                )
+        return response
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Count the SQL queries and time the database, templates and whole request,
+    report them in a Server-Timing header (with SERVER_TIMING) and add them to the rolling metrics
+    of the view's URL name (myapp/metrics.py).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with collecting() as metrics, ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(metrics))
+            request.metrics = metrics
+            response = self.get_response(request)
+        metrics.finish()
+
+        match = request.resolver_match
+        if match is not None:
+            budget = getattr(match.func, 'query_budget', None)
+            registry.record(match.view_name, metrics, budget)
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = metrics.server_timing()
+        return response
@@ -0,0 +1,49 @@
+# Generated by Django 6.0 on 2026-10-19 08:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def materialize_existing_events(apps, schema_editor):
+    """Existing events are all one-off, so each upcoming one gets a single occurrence"""
+    Event = apps.get_model('myapp', 'Event')
+    EventOccurrence = apps.get_model('myapp', 'EventOccurrence')
+    upcoming = Event.objects.filter(is_active=True, event_date__gte=timezone.now())
+    EventOccurrence.objects.bulk_create(
+        [EventOccurrence(event_id=pk, start=start) for pk, start in upcoming.values_list('pk', 'event_date')],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0006_message_credit_amount_message_credit_status_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='recurrence',
+            field=models.CharField(choices=[('NONE', 'Does not repeat'), ('DAILY', 'Daily'), ('WEEKLY', 'Weekly'), ('BIWEEKLY', 'Every two weeks'), ('MONTHLY', 'Monthly')], default='NONE', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='recurrence_end',
+            field=models.DateTimeField(blank=True, help_text='Last date of a repeating event. Leave blank to repeat indefinitely', null=True),
+        ),
+        migrations.CreateModel(
+            name='EventOccurrence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(db_index=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occurrences', to='myapp.event')),
+            ],
+            options={
+                'ordering': ['start'],
+                'unique_together': {('event', 'start')},
+            },
+        ),
+        migrations.RunPython(materialize_existing_events, migrations.RunPython.noop),
+    ]
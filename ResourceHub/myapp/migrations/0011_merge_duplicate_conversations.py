@@ -0,0 +1,57 @@
+# Generated by Django 6.0 on 2026-10-19 09:20
+
+from collections import defaultdict
+
+from django.db import migrations
+from django.db.models import Max
+
+
+def make_pair_key(user_id, other_user_id, listing_id):
+    low, high = sorted((user_id, other_user_id))
+    return f"{low}:{high}:{listing_id or ''}"
+
+
+def merge_duplicates(apps, schema_editor):
+    """
+    Give every conversation its pair key and members. Threads that turn out to share a
+    key (A↔B next to B↔A about the same listing) are merged into the oldest one.
+    """
+    Conversation = apps.get_model('myapp', 'Conversation')
+    ConversationMember = apps.get_model('myapp', 'ConversationMember')
+    Message = apps.get_model('myapp', 'Message')
+    MessageSearchTerm = apps.get_model('myapp', 'MessageSearchTerm')
+
+    by_key = defaultdict(list)
+    rows = Conversation.objects.order_by('pk').values_list('pk', 'participant1_id', 'participant2_id', 'listing_id')
+    for pk, participant1_id, participant2_id, listing_id in rows.iterator():
+        by_key[make_pair_key(participant1_id, participant2_id, listing_id)].append(pk)
+
+    keyed = []
+    for pair_key, pks in by_key.items():
+        keep, duplicates = pks[0], pks[1:]
+        if duplicates:
+            Message.objects.filter(conversation_id__in=duplicates).update(conversation_id=keep)
+            MessageSearchTerm.objects.filter(conversation_id__in=duplicates).update(conversation_id=keep)
+            latest = Conversation.objects.filter(pk__in=pks).aggregate(latest=Max('updated_at'))['latest']
+            Conversation.objects.filter(pk__in=duplicates).delete()
+            Conversation.objects.filter(pk=keep).update(updated_at=latest)
+        keyed.append(Conversation(pk=keep, pair_key=pair_key))
+    Conversation.objects.bulk_update(keyed, ['pair_key'], batch_size=1000)
+
+    members = [
+        ConversationMember(conversation_id=pk, user_id=user_id)
+        for pk, participant1_id, participant2_id in Conversation.objects.values_list('pk', 'participant1_id', 'participant2_id').iterator()
+        for user_id in {participant1_id, participant2_id}
+    ]
+    ConversationMember.objects.bulk_create(members, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0010_conversation_pair_key_conversationmember'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
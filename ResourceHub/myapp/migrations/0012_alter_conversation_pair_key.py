@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 09:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0011_merge_duplicate_conversations'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversation',
+            name='pair_key',
+            field=models.CharField(editable=False, max_length=64, unique=True),
+        ),
+    ]
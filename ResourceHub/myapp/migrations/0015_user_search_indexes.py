@@ -0,0 +1,39 @@
+# Generated by Django 6.0 on 2026-10-19 09:40
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+
+def user_search_indexes():
+    """Expression indexes behind the member typeahead (see views._user_search)"""
+    return [
+        models.Index(Lower('username'), name='user_username_lower_idx'),
+        models.Index(Lower('first_name'), name='user_first_name_lower_idx'),
+        models.Index(Lower('last_name'), name='user_last_name_lower_idx'),
+    ]
+
+
+def add_indexes(apps, schema_editor):
+    # The user model belongs to another app, so its indexes are added here rather than in its Meta
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    for index in user_search_indexes():
+        schema_editor.add_index(User, index)
+
+
+def remove_indexes(apps, schema_editor):
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    for index in user_search_indexes():
+        schema_editor.remove_index(User, index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0014_outboxevent'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(add_indexes, remove_indexes),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 6.0 on 2026-10-19 09:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0015_user_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='notification_type',
+            field=models.CharField(choices=[('MESSAGE', 'New Message'), ('LISTING_RESPONSE', 'Response to Listing'), ('TOOL_REQUEST', 'Tool Borrow Request'), ('TOOL_APPROVED', 'Tool Request Approved'), ('EVENT_JOINED', 'User Joined Event'), ('REVIEW_RECEIVED', 'New Review'), ('CREDIT_RECEIVED', 'Credits Received'), ('NEW_MATCH', 'New Match')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='ListingMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.PositiveSmallIntegerField(help_text='Number of shared skills')),
+                ('distance_km', models.FloatField(blank=True, help_text='Between the two owners; empty if either has no location', null=True)),
+                ('alert_pending', models.BooleanField(default=False, help_text="New match the listing's owner has not been told about yet")),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('listing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='myapp.servicelisting')),
+                ('matched_listing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='myapp.servicelisting')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('alert_pending', True)), fields=['id'], name='listing_match_alert_idx')],
+                'constraints': [models.UniqueConstraint(fields=('listing', 'matched_listing'), name='unique_listing_match')],
+            },
+        ),
+    ]
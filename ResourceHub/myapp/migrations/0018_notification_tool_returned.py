@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 09:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0017_analytics_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='notification_type',
+            field=models.CharField(choices=[('MESSAGE', 'New Message'), ('LISTING_RESPONSE', 'Response to Listing'), ('TOOL_REQUEST', 'Tool Borrow Request'), ('TOOL_APPROVED', 'Tool Request Approved'), ('TOOL_RETURNED', 'Tool Returned'), ('EVENT_JOINED', 'User Joined Event'), ('REVIEW_RECEIVED', 'New Review'), ('CREDIT_RECEIVED', 'Credits Received'), ('NEW_MATCH', 'New Match')], max_length=20),
+        ),
+    ]
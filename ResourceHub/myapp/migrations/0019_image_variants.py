@@ -0,0 +1,51 @@
+# Generated by Django 6.0 on 2026-10-19 10:09
+
+import posixpath
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+# Frozen from myapp/images.py as it stood when this migration was written, so later changes
+# to the variant spec don't change what the migration does. Under a newer spec the key
+# recorded here no longer matches, and the image is served as uploaded until
+# regenerate_image_variants has run.
+VARIANTS_VERSION = 'ea67128f'
+VARIANTS = ('avatar', 'profile', 'card', 'large')
+FORMATS = ('webp', 'jpeg')
+
+
+def variant_name(name, variant, fmt):
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    return posixpath.join(directory, 'variants', f'{stem}.{variant}.{VARIANTS_VERSION}.{fmt}')
+
+
+def record_existing_variants(apps, schema_editor):
+    """Record the images whose current variants are already in storage"""
+    for model_name, field_name in (('Profile', 'profile_picture'), ('Tool', 'image')):
+        model = apps.get_model('myapp', model_name)
+        rows = model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+        for pk, name in rows.values_list('pk', field_name).iterator():
+            if all(default_storage.exists(variant_name(name, variant, fmt)) for variant in VARIANTS for fmt in FORMATS):
+                model.objects.filter(pk=pk).update(**{f'{field_name}_variants': f'{VARIANTS_VERSION}:{name}'})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0018_notification_tool_returned'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='profile_picture_variants',
+            field=models.CharField(blank=True, editable=False, help_text='Picture whose resized variants exist (myapp/images.py)', max_length=120),
+        ),
+        migrations.AddField(
+            model_name='tool',
+            name='image_variants',
+            field=models.CharField(blank=True, editable=False, help_text='Image whose resized variants exist (myapp/images.py)', max_length=120),
+        ),
+        migrations.RunPython(record_existing_variants, migrations.RunPython.noop),
+    ]
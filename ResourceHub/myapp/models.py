@@ -1,4 +1,8 @@
-from django.db import models
+import calendar
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
 
 # Create your models here.
 from django.contrib.auth.models import User
@@ -12,6 +16,8 @@ class Profile(models.Model):
     location = models.CharField(max_length=100, help_text="Neighborhood or City")
     phone = models.CharField(max_length=20, blank=True)
     profile_picture = models.ImageField(upload_to='profiles/', blank=True, null=True)
+    profile_picture_variants = models.CharField(max_length=120, blank=True, editable=False,
+                                                help_text="Picture whose resized variants exist (myapp/images.py)")
     latitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
     longitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
     is_available = models.BooleanField(default=True, help_text="Available to help others")
@@ -52,12 +58,35 @@ class ServiceListing(models.Model):
     def __str__(self):
         return f"[{self.get_listing_type_display()}] {self.title}"
 
+class ListingMatch(models.Model):
+    """One of a listing's best counterparts (offers for a request, requests for an offer), kept up to date by myapp/matching.py"""
+    listing = models.ForeignKey(ServiceListing, on_delete=models.CASCADE, related_name='matches')
+    matched_listing = models.ForeignKey(ServiceListing, on_delete=models.CASCADE, related_name='+')
+    score = models.PositiveSmallIntegerField(help_text="Number of shared skills")
+    distance_km = models.FloatField(null=True, blank=True, help_text="Between the two owners; empty if either has no location")
+    alert_pending = models.BooleanField(default=False, help_text="New match the listing's owner has not been told about yet")
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['listing', 'matched_listing'], name='unique_listing_match'),
+        ]
+        indexes = [
+            # send_match_alerts only reads the flagged rows
+            models.Index(fields=['id'], condition=models.Q(alert_pending=True), name='listing_match_alert_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.listing_id} → {self.matched_listing_id} ({self.score} skills)"
+
 # 4. Tool Library
 class Tool(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='tools')
     name = models.CharField(max_length=100)
     description = models.TextField()
     image = models.ImageField(upload_to='tools/', blank=True, null=True)
+    image_variants = models.CharField(max_length=120, blank=True, editable=False,
+                                      help_text="Image whose resized variants exist (myapp/images.py)")
     is_available = models.BooleanField(default=True)
     
     def __str__(self):
@@ -107,6 +136,21 @@ class Event(models.Model):
         ('OTHER', 'Other'),
     ]
     
+    RECURRENCE_CHOICES = [
+        ('NONE', 'Does not repeat'),
+        ('DAILY', 'Daily'),
+        ('WEEKLY', 'Weekly'),
+        ('BIWEEKLY', 'Every two weeks'),
+        ('MONTHLY', 'Monthly'),
+    ]
+    
+    # Fixed-length steps; MONTHLY is handled separately since months vary in length
+    RECURRENCE_STEPS = {
+        'DAILY': timedelta(days=1),
+        'WEEKLY': timedelta(weeks=1),
+        'BIWEEKLY': timedelta(weeks=2),
+    }
+    
     organizer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='organized_events')
     title = models.CharField(max_length=200)
     description = models.TextField()
@@ -117,6 +161,8 @@ class Event(models.Model):
     participants = models.ManyToManyField(User, related_name='joined_events', blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
+    recurrence = models.CharField(max_length=10, choices=RECURRENCE_CHOICES, default='NONE')
+    recurrence_end = models.DateTimeField(null=True, blank=True, help_text="Last date of a repeating event. Leave blank to repeat indefinitely")
     
     def __str__(self):
         return f"{self.title} - {self.event_date.strftime('%Y-%m-%d')}"
@@ -125,6 +171,84 @@ class Event(models.Model):
         if self.max_participants:
             return self.max_participants - self.participants.count()
         return None
+    
+    @property
+    def is_recurring(self):
+        return self.recurrence != 'NONE'
+    
+    def _nth_occurrence(self, n):
+        """Start time of the n-th occurrence (0 is event_date itself)"""
+        # Step the wall-clock time in the site's time zone (the one event times are entered in),
+        # so a 7pm event stays at 7pm when daylight saving time starts or ends
+        zone = timezone.get_default_timezone()
+        local = timezone.localtime(self.event_date, zone).replace(tzinfo=None)
+        if self.recurrence == 'MONTHLY':
+            month_index = local.month - 1 + n
+            year = local.year + month_index // 12
+            month = month_index % 12 + 1
+            # Clamp e.g. the 31st to the last day of shorter months
+            day = min(local.day, calendar.monthrange(year, month)[1])
+            local = local.replace(year=year, month=month, day=day)
+        else:
+            local += self.RECURRENCE_STEPS[self.recurrence] * n
+        return timezone.make_aware(local, zone)
+    
+    def _first_index_from(self, start):
+        """Index of the first occurrence at or after start, without walking the series"""
+        if start <= self.event_date:
+            return 0
+        if self.recurrence == 'MONTHLY':
+            n = max((start.year - self.event_date.year) * 12 + start.month - self.event_date.month - 1, 0)
+        else:
+            n = (start - self.event_date) // self.RECURRENCE_STEPS[self.recurrence]
+        while self._nth_occurrence(n) < start:
+            n += 1
+        return n
+    
+    def iter_occurrences(self, start, end):
+        """Lazily yield occurrence start times within [start, end)"""
+        if not self.is_recurring:
+            if start <= self.event_date < end:
+                yield self.event_date
+            return
+        
+        n = self._first_index_from(start)
+        while True:
+            occurrence = self._nth_occurrence(n)
+            if occurrence >= end:
+                return
+            if self.recurrence_end and occurrence > self.recurrence_end:
+                return
+            yield occurrence
+            n += 1
+    
+    def materialize_occurrences(self, weeks=None):
+        """Rebuild the stored upcoming occurrences for the next `weeks` weeks"""
+        weeks = weeks or settings.EVENT_OCCURRENCE_WEEKS
+        now = timezone.now()
+        
+        occurrences = [
+            EventOccurrence(event=self, start=start)
+            for start in self.iter_occurrences(now, now + timedelta(weeks=weeks))
+        ] if self.is_active else []
+        
+        # One transaction, so the browse page never sees the event without its dates
+        with transaction.atomic():
+            self.occurrences.all().delete()
+            EventOccurrence.objects.bulk_create(occurrences, ignore_conflicts=True)
+        return len(occurrences)
+
+class EventOccurrence(models.Model):
+    """A materialized upcoming date of an Event, kept only for the browse window"""
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='occurrences')
+    start = models.DateTimeField(db_index=True)
+    
+    class Meta:
+        ordering = ['start']
+        unique_together = ['event', 'start']
+    
+    def __str__(self):
+        return f"{self.event.title} - {self.start.strftime('%Y-%m-%d %H:%M')}"
 
 # 8. Reviews and Reputation System
 class Review(models.Model):
@@ -147,28 +271,76 @@ class Conversation(models.Model):
     participant1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations_as_participant1')
     participant2 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations_as_participant2')
     listing = models.ForeignKey(ServiceListing, on_delete=models.SET_NULL, null=True, blank=True, related_name='conversations')
+    # "<lower user id>:<higher user id>:<listing id or empty>" - the same for A↔B and B↔A,
+    # so the unique index stops duplicate threads however they are started
+    pair_key = models.CharField(max_length=64, unique=True, editable=False)
+    # Highest message id moved into a MessageArchiveSegment (0 = nothing archived),
+    # so threads without an archive never look for one
+    archived_up_to = models.BigIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         ordering = ['-updated_at']
-        unique_together = ['participant1', 'participant2', 'listing']
     
     def __str__(self):
         return f"{self.participant1.username} ↔ {self.participant2.username}"
     
+    @staticmethod
+    def make_pair_key(user_id, other_user_id, listing_id=None):
+        low, high = sorted((user_id, other_user_id))
+        return f"{low}:{high}:{listing_id or ''}"
+    
+    @classmethod
+    def get_or_create_between(cls, user, other_user, listing=None):
+        """The thread between two users (about a listing, if given), created if needed"""
+        pair_key = cls.make_pair_key(user.pk, other_user.pk, listing.pk if listing else None)
+        conversation = cls.objects.filter(pair_key=pair_key).first()
+        if conversation:
+            return conversation, False
+        try:
+            with transaction.atomic():
+                return cls.objects.create(participant1=user, participant2=other_user, listing=listing), True
+        except IntegrityError:
+            # Someone started the same thread at the same moment
+            return cls.objects.get(pair_key=pair_key), False
+    
+    def save(self, *args, **kwargs):
+        is_new = self._state.adding
+        if not self.pair_key:
+            self.pair_key = self.make_pair_key(self.participant1_id, self.participant2_id, self.listing_id)
+        super().save(*args, **kwargs)
+        if is_new:
+            ConversationMember.objects.bulk_create([
+                ConversationMember(conversation=self, user_id=user_id)
+                for user_id in {self.participant1_id, self.participant2_id}
+            ], ignore_conflicts=True)
+    
     def get_other_user(self, current_user):
         """Get the other participant in the conversation"""
         return self.participant2 if current_user == self.participant1 else self.participant1
     
     def get_last_message(self):
         """Get the most recent message in this conversation"""
-        return self.messages.first()
+        return self.messages.last()
     
     def has_unread_for(self, user):
         """Check if there are unread messages for a user"""
         return self.messages.filter(recipient=user, is_read=False).exists()
 
+class ConversationMember(models.Model):
+    """A user's membership of a conversation, so their inbox is a single indexed lookup"""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='members')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversation_memberships')
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'conversation'], name='unique_conversation_member'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user_id} in conversation {self.conversation_id}"
+
 class Message(models.Model):
     """Individual message within a conversation"""
     STATUS_CHOICES = [
@@ -195,9 +367,58 @@ class Message(models.Model):
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Thread pages are read newest-first by id cursor (see conversation_history)
+            models.Index(fields=['conversation', 'id'], name='message_conversation_id_idx'),
+        ]
     
     def __str__(self):
         return f"{self.sender.username} → {self.recipient.username}: {self.body[:50]}"
+    
+    def save(self, *args, **kwargs):
+        is_new = self._state.adding
+        super().save(*args, **kwargs)
+        if is_new:
+            # Bodies never change after sending, so indexing new messages keeps search current
+            from .search import index_message
+            index_message(self)
+
+class MessageSearchTerm(models.Model):
+    """Inverted index of message bodies: one row per word, message and participant"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    term = models.CharField(max_length=40)
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='search_terms')
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='+')
+    frequency = models.PositiveSmallIntegerField(default=1)
+    
+    class Meta:
+        constraints = [
+            # Also the index every search runs on: (user, term) -> messages
+            models.UniqueConstraint(fields=['user', 'term', 'message'], name='unique_message_search_term'),
+        ]
+    
+    def __str__(self):
+        return f"{self.term} ({self.user_id} → message {self.message_id})"
+
+class MessageArchiveSegment(models.Model):
+    """A run of a conversation's old messages, moved out of Message as gzipped JSON lines (see myapp/archive.py)"""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='archive_segments')
+    first_id = models.BigIntegerField(help_text="Lowest message id in the segment")
+    last_id = models.BigIntegerField(help_text="Highest message id in the segment")
+    message_count = models.PositiveIntegerField()
+    first_created_at = models.DateTimeField()
+    last_created_at = models.DateTimeField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            # Scrolling back reads a thread's segments newest-first
+            models.Index(fields=['conversation', 'last_id'], name='archive_segment_last_id_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Conversation {self.conversation_id}: messages {self.first_id}–{self.last_id} ({self.message_count})"
 
 # 10. Notification System
 class Notification(models.Model):
@@ -206,9 +427,11 @@ class Notification(models.Model):
         ('LISTING_RESPONSE', 'Response to Listing'),
         ('TOOL_REQUEST', 'Tool Borrow Request'),
         ('TOOL_APPROVED', 'Tool Request Approved'),
+        ('TOOL_RETURNED', 'Tool Returned'),
         ('EVENT_JOINED', 'User Joined Event'),
         ('REVIEW_RECEIVED', 'New Review'),
         ('CREDIT_RECEIVED', 'Credits Received'),
+        ('NEW_MATCH', 'New Match'),
     ]
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
@@ -223,3 +446,68 @@ class Notification(models.Model):
     
     def __str__(self):
         return f"{self.user.username}: {self.get_notification_type_display()}"
+
+# 11. Transactional Outbox
+class OutboxEvent(models.Model):
+    """
+    A side effect (notification, confirmation message) recorded in the same transaction
+    as the state change that caused it, and carried out later by drain_outbox (see myapp/outbox.py)
+    """
+    kind = models.CharField(max_length=30)
+    payload = models.JSONField(default=dict)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # The worker only ever reads the pending events, oldest first
+            models.Index(fields=['id'], condition=models.Q(processed_at__isnull=True), name='outbox_pending_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({'done' if self.processed_at else 'pending'})"
+
+# 12. Analytics Rollups
+class DailyStat(models.Model):
+    """
+    One number per day for the organizers' analytics (hours exchanged, new listings per skill,
+    event turnout, ...), maintained incrementally by update_rollups (see myapp/rollups.py)
+    """
+    day = models.DateField()
+    metric = models.CharField(max_length=30)
+    key = models.CharField(max_length=50, blank=True, help_text="Breakdown within the metric, e.g. a skill or event id")
+    label = models.CharField(max_length=200, blank=True)
+    value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['metric', 'day', 'key'], name='unique_daily_stat'),
+        ]
+    
+    def __str__(self):
+        return f"{self.day} {self.metric}{f' [{self.key}]' if self.key else ''}: {self.value}"
+
+class DailyActiveUser(models.Model):
+    """A member who did something (traded hours, posted, messaged, borrowed) on a day"""
+    day = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'user'], name='unique_daily_active_user'),
+        ]
+    
+    def __str__(self):
+        return f"{self.day} {self.user_id}"
+
+class RollupWatermark(models.Model):
+    """The last row of a source table already counted in the rollups"""
+    source = models.CharField(max_length=30, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.source} up to #{self.last_id}"
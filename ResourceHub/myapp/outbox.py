@@ -0,0 +1,108 @@
+"""
+Transactional outbox for the side effects of the credit, borrow and request workflows.
+
+A view makes its state change and calls enqueue() inside one
+transaction.atomic() block, so the OutboxEvent row commits or rolls back with
+the change it describes. `manage.py drain_outbox` then carries the events out
+in batches. Each handler runs in the same transaction that marks its event
+processed, so a notification or confirmation message is written exactly once,
+even when the worker is killed halfway or several workers run at once (they
+claim rows with SELECT ... FOR UPDATE SKIP LOCKED where the database has it).
+
+A failing handler is rolled back on its own and retried by later drains, up to
+MAX_ATTEMPTS times. With OUTBOX_DRAIN_ON_COMMIT (on in development) events are
+also drained as soon as the request's transaction commits, so no worker is needed.
+"""
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Conversation, Message, Notification, OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register the function that carries out events of this kind"""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+@handler('notification')
+def _create_notification(user_id, notification_type, message, link=''):
+    Notification.objects.create(user_id=user_id, notification_type=notification_type, message=message, link=link)
+
+
+@handler('message')
+def _post_message(conversation_id, sender_id, recipient_id, body):
+    message = Message.objects.create(
+        conversation_id=conversation_id, sender_id=sender_id, recipient_id=recipient_id, body=body
+    )
+    Conversation.objects.filter(pk=conversation_id).update(updated_at=message.created_at)
+
+
+def enqueue(kind, **payload):
+    """Record a side effect; call it inside the transaction that makes the change it belongs to"""
+    if kind not in HANDLERS:
+        raise ValueError(f'Unknown outbox event kind {kind!r}')
+    event = OutboxEvent.objects.create(kind=kind, payload=payload)
+    if settings.OUTBOX_DRAIN_ON_COMMIT:
+        transaction.on_commit(drain, robust=True)
+    return event
+
+
+def enqueue_many(kind, payloads):
+    """Record many side effects of one kind with a single INSERT (e.g. for an admin bulk action)"""
+    if kind not in HANDLERS:
+        raise ValueError(f'Unknown outbox event kind {kind!r}')
+    events = OutboxEvent.objects.bulk_create([OutboxEvent(kind=kind, payload=payload) for payload in payloads])
+    if events and settings.OUTBOX_DRAIN_ON_COMMIT:
+        transaction.on_commit(drain, robust=True)
+    return events
+
+
+def notify(user, notification_type, message, link=''):
+    return enqueue('notification', user_id=user.pk, notification_type=notification_type, message=message, link=link)
+
+
+def post_message(conversation, sender, recipient, body):
+    return enqueue('message', conversation_id=conversation.pk, sender_id=sender.pk, recipient_id=recipient.pk, body=body)
+
+
+def drain(batch_size=100):
+    """Carry out one batch of pending events, oldest first. Returns (processed, failed)."""
+    processed = failed = 0
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            # Foreign keys are checked at COMMIT by default, where a dangling reference made by
+            # one handler would roll back the whole batch; check them per statement instead
+            with connection.cursor() as cursor:
+                cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+        events = list(OutboxEvent.objects.select_for_update(skip_locked=True).filter(
+            processed_at__isnull=True, attempts__lt=MAX_ATTEMPTS
+        ).order_by('id')[:batch_size])
+
+        for event in events:
+            try:
+                with transaction.atomic():
+                    HANDLERS[event.kind](**event.payload)
+            except Exception as exc:
+                logger.exception('Outbox event %s (%s) failed', event.pk, event.kind)
+                event.attempts += 1
+                event.last_error = repr(exc)
+                failed += 1
+            else:
+                event.processed_at = timezone.now()
+                processed += 1
+
+        OutboxEvent.objects.bulk_update(events, ['attempts', 'last_error', 'processed_at'])
+    return processed, failed
@@ -0,0 +1,176 @@
+"""
+Rate limiting for the polling and write endpoints.
+
+Views declare a scope with @rate_limit('scope'), and RATE_LIMITS in the
+settings gives each scope its rate, such as '10/m' (per second, minute, hour
+or day). Logged-in members are counted by user id, anyone else by IP address
+(REMOTE_ADDR; a proxy in front must set it to the client's address). A request
+over the rate gets a 429 with a Retry-After header telling when to try again,
+without running the view.
+
+Counts use a sliding window: a counter per fixed window in the shared cache,
+with the previous window's count weighed by how much of it still overlaps
+the last `period` seconds. That keeps a client from sending twice the rate
+around a window boundary, at the cost of two cache keys per client and scope.
+Refused requests count too, so a client that keeps hammering stays refused.
+When the cache fails, each worker process counts in its own memory instead.
+
+The allowed and refused requests per scope are counted in memory per worker
+process and listed by /api/metrics/.
+"""
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """'10/m' -> (10, 60)"""
+    count, _, period = rate.partition('/')
+    return int(count), PERIODS[period.strip().lower()[:1]]
+
+
+class MemoryCounters:
+    """Expiring counters in this process's memory, for when the cache is unavailable"""
+
+    SWEEP_EVERY = 1000  # increments
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._increments = 0
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            return {key: self._counts[key][0] for key in keys if key in self._counts and self._counts[key][1] > now}
+
+    def incr(self, key, timeout):
+        now = time.monotonic()
+        with self._lock:
+            self._increments += 1
+            if self._increments >= self.SWEEP_EVERY:
+                self._counts = {k: entry for k, entry in self._counts.items() if entry[1] > now}
+                self._increments = 0
+            count, expires = self._counts.get(key, (0, 0))
+            if expires <= now:
+                count, expires = 0, now + timeout
+            self._counts[key] = (count + 1, expires)
+            return count + 1
+
+
+class CacheCounters:
+    """Expiring counters in the configured cache, shared by every worker process"""
+
+    def get_many(self, keys):
+        return cache.get_many(keys)
+
+    def incr(self, key, timeout):
+        if cache.add(key, 1, timeout):
+            return 1
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.set(key, 1, timeout)
+            return 1
+
+
+_cache_counters = CacheCounters()
+_memory_counters = MemoryCounters()
+
+
+def _count(key, timeout, previous_key):
+    """Count a hit on key; returns (hits in this window, hits in the previous one)"""
+    try:
+        return _cache_counters.incr(key, timeout), _cache_counters.get_many([previous_key]).get(previous_key, 0)
+    except Exception:
+        logger.warning('Rate limit cache unavailable, counting in process memory', exc_info=True)
+        return _memory_counters.incr(key, timeout), _memory_counters.get_many([previous_key]).get(previous_key, 0)
+
+
+def hit(scope, ident, rate, now=None):
+    """Count a request of ident in scope; returns (allowed, seconds until the next one would be)"""
+    limit, period = parse_rate(rate)
+    now = time.time() if now is None else now
+    window, elapsed = divmod(now, period)
+    current, previous = _count(f'rl:{scope}:{ident}:{int(window)}', 2 * period, f'rl:{scope}:{ident}:{int(window) - 1}')
+
+    weight = 1 - elapsed / period
+    if previous * weight + current <= limit:
+        return True, 0
+    # Once enough of the previous window has slid out of the last `period` seconds...
+    wait = period * (previous * weight + current + 1 - limit) / previous if current < limit else period
+    if wait > period - elapsed:
+        # ...or else in the next window, once enough of this one has
+        wait = period - elapsed + period * max(0, 1 - (limit - 1) / current)
+    return False, max(1, math.ceil(wait))
+
+
+class RateLimitStats:
+    """Allowed and refused requests per scope, in this worker process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: [0, 0])
+
+    def record(self, scope, allowed):
+        with self._lock:
+            self._counts[scope][0 if allowed else 1] += 1
+
+    def summary(self):
+        with self._lock:
+            counts = {scope: list(pair) for scope, pair in self._counts.items()}
+        return [
+            {'scope': scope, 'rate': rate, 'allowed': counts.get(scope, [0, 0])[0],
+             'limited': counts.get(scope, [0, 0])[1]}
+            for scope, rate in sorted(settings.RATE_LIMITS.items())
+        ]
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+stats = RateLimitStats()
+
+
+def client_ident(request):
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+
+
+def _too_many_requests(request, retry_after):
+    message = 'Too many requests. Please wait a moment and try again.'
+    headers = {'Retry-After': str(retry_after)}
+    if 'text/html' in request.headers.get('Accept', ''):
+        return HttpResponse(message, status=429, content_type='text/plain; charset=utf-8', headers=headers)
+    return JsonResponse({'error': message}, status=429, headers=headers)
+
+
+def rate_limit(scope, methods=None):
+    """Limit the view to RATE_LIMITS[scope] requests per client (only requests of the given methods, if any)"""
+    def decorator(view):
+        @wraps(view)
+        def limited(request, *args, **kwargs):
+            rate = settings.RATE_LIMITS.get(scope)
+            if rate and settings.RATE_LIMIT_ENABLED and (methods is None or request.method in methods):
+                allowed, retry_after = hit(scope, client_ident(request), rate)
+                stats.record(scope, allowed)
+                if not allowed:
+                    logger.info('Rate limit %s (%s) reached by %s', scope, rate, client_ident(request))
+                    return _too_many_requests(request, retry_after)
+            return view(request, *args, **kwargs)
+        return limited
+    return decorator
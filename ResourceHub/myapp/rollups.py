@@ -0,0 +1,274 @@
+"""
+Daily rollups behind the organizers' analytics.
+
+The analytics page and /api/analytics/ read only DailyStat and
+DailyActiveUser, never the raw tables. `manage.py update_rollups` keeps them
+current in two ways:
+
+- Facts that never change once written (transactions, new listings and their
+  skills, messages, borrow requests) are counted incrementally. Each source
+  table has a RollupWatermark holding the last id already counted; a run
+  counts the rows after it, a batch at a time, and moves the watermark in the
+  same transaction as the counts, so every row is counted exactly once. Rows
+  younger than SETTLE_DELAY wait for the next run, as a transaction still
+  open elsewhere may yet commit a lower id.
+- Facts that keep changing after the fact (a borrow gets approved and
+  returned, people join an event up to the day) are recomputed for the last
+  ROLLUP_RECOMPUTE_DAYS days on every run; older days are left as they are.
+
+Rows deleted after they were counted (a listing, a user) stay in the history.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q, Sum
+from django.utils import timezone
+
+from .models import (DailyActiveUser, DailyStat, Event, Message, RollupWatermark, ServiceListing, Tool, ToolBorrow,
+                     Transaction)
+
+SETTLE_DELAY = timedelta(minutes=5)
+
+LENT_STATUSES = ('APPROVED', 'BORROWED', 'RETURNED')
+RECOMPUTED_METRICS = ('tool_days_lent', 'events_held', 'event_turnout')
+
+
+class Counts:
+    """Metric increments and active members collected from one batch of source rows"""
+
+    def __init__(self):
+        self.stats = defaultdict(Decimal)
+        self.labels = {}
+        self.active = set()
+
+    def add(self, day, metric, value=1, key='', label=''):
+        self.stats[day, metric, str(key)] += Decimal(value)
+        if label:
+            self.labels[day, metric, str(key)] = label
+
+    def member(self, day, user_id):
+        self.active.add((day, user_id))
+
+
+def _day(moment):
+    return timezone.localdate(moment)
+
+
+def _monday(day):
+    return day - timedelta(days=day.weekday())
+
+
+def _count_transactions(rows, counts):
+    for row in rows:
+        day = _day(row['timestamp'])
+        counts.add(day, 'hours_exchanged', row['amount'])
+        counts.add(day, 'transactions')
+        counts.member(day, row['sender_id'])
+        counts.member(day, row['receiver_id'])
+
+
+def _count_listings(rows, counts):
+    days = {}
+    for row in rows:
+        days[row['id']] = day = _day(row['created_at'])
+        counts.add(day, 'listings_created', key=row['listing_type'])
+        counts.member(day, row['user_id'])
+    through = ServiceListing.skills.through
+    for listing_id, skill_id, name in through.objects.filter(
+        servicelisting_id__in=list(days)
+    ).values_list('servicelisting_id', 'skill_id', 'skill__name'):
+        counts.add(days[listing_id], 'skill_listings', key=skill_id, label=name)
+
+
+def _count_messages(rows, counts):
+    for row in rows:
+        day = _day(row['created_at'])
+        counts.add(day, 'messages_sent')
+        counts.member(day, row['sender_id'])
+
+
+def _count_borrow_requests(rows, counts):
+    for row in rows:
+        day = _day(row['requested_at'])
+        counts.add(day, 'borrow_requests')
+        counts.member(day, row['borrower_id'])
+
+
+# source name: (model, creation timestamp field, other fields read, counting function)
+SOURCES = {
+    'transactions': (Transaction, 'timestamp', ['sender_id', 'receiver_id', 'amount'], _count_transactions),
+    'listings': (ServiceListing, 'created_at', ['user_id', 'listing_type'], _count_listings),
+    'messages': (Message, 'created_at', ['sender_id'], _count_messages),
+    'borrows': (ToolBorrow, 'requested_at', ['borrower_id'], _count_borrow_requests),
+}
+
+
+def _save(counts, replace=False):
+    """Add the counted increments to the stored DailyStat rows (or overwrite them, with replace)"""
+    if not counts.stats:
+        return
+    days = {day for day, _, _ in counts.stats}
+    metrics = {metric for _, metric, _ in counts.stats}
+    stored = {
+        (row.day, row.metric, row.key): row
+        for row in DailyStat.objects.filter(day__in=days, metric__in=metrics)
+    }
+    created, updated = [], []
+    for item, value in counts.stats.items():
+        row = stored.get(item)
+        if row is None:
+            day, metric, key = item
+            created.append(DailyStat(day=day, metric=metric, key=key, label=counts.labels.get(item, ''), value=value))
+        else:
+            row.value = value if replace else row.value + value
+            row.label = counts.labels.get(item, row.label)
+            updated.append(row)
+    DailyStat.objects.bulk_update(updated, ['value', 'label'], batch_size=500)
+    DailyStat.objects.bulk_create(created, batch_size=500)
+
+
+def _save_active(active):
+    """Record the active members and recount the touched days"""
+    if not active:
+        return
+    DailyActiveUser.objects.bulk_create(
+        [DailyActiveUser(day=day, user_id=user_id) for day, user_id in active], batch_size=500, ignore_conflicts=True
+    )
+    days = {day for day, _ in active}
+    totals = Counts()
+    for row in DailyActiveUser.objects.filter(day__in=days).values('day').annotate(n=Count('id')):
+        totals.add(row['day'], 'active_members', row['n'])
+    # Members active during a week, each counted once, filed under its Monday
+    for monday in {_monday(day) for day in days}:
+        members = DailyActiveUser.objects.filter(day__range=(monday, monday + timedelta(days=6))).aggregate(
+            n=Count('user_id', distinct=True)
+        )['n']
+        totals.add(monday, 'weekly_active_members', members)
+    _save(totals, replace=True)
+
+
+def count_new_rows(source, batch_size=5000, now=None):
+    """Count one batch of the source's rows after its watermark. Returns how many were counted."""
+    model, timestamp, fields, count = SOURCES[source]
+    settled = (now or timezone.now()) - SETTLE_DELAY
+    with transaction.atomic():
+        watermark, _ = RollupWatermark.objects.select_for_update().get_or_create(source=source)
+        rows = list(model.objects.filter(pk__gt=watermark.last_id).order_by('pk').values(
+            'id', timestamp, *fields
+        )[:batch_size])
+        # Stop at the first unsettled row: a lower id may still be on its way
+        for position, row in enumerate(rows):
+            if row[timestamp] > settled:
+                rows = rows[:position]
+                break
+        if not rows:
+            return 0
+
+        counts = Counts()
+        count(rows, counts)
+        _save(counts)
+        _save_active(counts.active)
+        watermark.last_id = rows[-1]['id']
+        watermark.save()
+    return len(rows)
+
+
+def recompute(days=None, now=None):
+    """Rebuild the metrics of mutable facts for the last `days` days (tool lending, event turnout)"""
+    days = settings.ROLLUP_RECOMPUTE_DAYS if days is None else days
+    now = now or timezone.now()
+    today = timezone.localdate(now)
+    first_day = today - timedelta(days=days)
+    start = timezone.make_aware(datetime.combine(first_day, time.min))
+
+    counts = Counts()
+
+    # Tool-days lent: each day a tool spent (or spends) with a borrower
+    borrows = ToolBorrow.objects.filter(status__in=LENT_STATUSES, start_date__lte=now).filter(
+        Q(actual_return_date__gte=start) | Q(actual_return_date__isnull=True, end_date__gte=start) |
+        Q(actual_return_date__isnull=True, status='BORROWED')
+    ).values_list('tool_id', 'status', 'start_date', 'end_date', 'actual_return_date')
+    lent = defaultdict(set)
+    for tool_id, status, borrowed, due, returned in borrows:
+        # A tool that is still out counts until today, even when it is overdue
+        until = returned or (now if status == 'BORROWED' else due)
+        day, last = max(_day(borrowed), first_day), min(_day(until), today)
+        while day <= last:
+            lent[day].add(tool_id)
+            day += timedelta(days=1)
+    for day, tools in lent.items():
+        counts.add(day, 'tool_days_lent', len(tools))
+
+    # Turnout of every occurrence held so far in the window (participants sign up for the whole series)
+    events = Event.objects.filter(is_active=True, event_date__lte=now).filter(
+        Q(recurrence='NONE', event_date__gte=start) |
+        (~Q(recurrence='NONE') & (Q(recurrence_end__isnull=True) | Q(recurrence_end__gte=start)))
+    ).annotate(turnout=Count('participants'))
+    for event in events:
+        for occurrence in event.iter_occurrences(start, now):
+            day = _day(occurrence)
+            counts.add(day, 'events_held')
+            counts.add(day, 'event_turnout', event.turnout, key=event.pk, label=event.title)
+
+    with transaction.atomic():
+        DailyStat.objects.filter(day__gte=first_day, metric__in=RECOMPUTED_METRICS).delete()
+        _save(counts)
+        # The size of the library is only known today, so each day keeps the snapshot it last got
+        snapshot = Counts()
+        snapshot.add(today, 'tools_listed', Tool.objects.count())
+        _save(snapshot, replace=True)
+
+
+def summary(weeks=12, today=None):
+    """The analytics of the last `weeks` weeks, read from the rollups only"""
+    today = today or timezone.localdate()
+    since = _monday(today) - timedelta(weeks=weeks - 1)
+
+    per_week = defaultdict(lambda: defaultdict(Decimal))
+    tools_listed = defaultdict(list)
+    for day, metric, value in DailyStat.objects.filter(day__gte=since).exclude(
+        metric='skill_listings'
+    ).values_list('day', 'metric', 'value'):
+        if metric == 'tools_listed':
+            tools_listed[_monday(day)].append(value)
+        else:
+            per_week[_monday(day)][metric] += value
+
+    rows = []
+    for number in range(weeks):
+        week = since + timedelta(weeks=number)
+        stats = per_week[week]
+        listed = tools_listed[week]
+        # Lent tool-days out of the tool-days the library had, averaged over the days with a snapshot
+        capacity = sum(listed) / len(listed) * 7 if listed else 0
+        rows.append({
+            'week': week,
+            'hours_exchanged': stats['hours_exchanged'],
+            'transactions': int(stats['transactions']),
+            'active_members': int(stats['weekly_active_members']),
+            'listings_created': int(stats['listings_created']),
+            'messages_sent': int(stats['messages_sent']),
+            'borrow_requests': int(stats['borrow_requests']),
+            'tool_days_lent': int(stats['tool_days_lent']),
+            'tool_utilization': round(float(stats['tool_days_lent'] / capacity), 3) if capacity else None,
+            'events_held': int(stats['events_held']),
+            'event_turnout': int(stats['event_turnout']),
+        })
+
+    top_skills = DailyStat.objects.filter(day__gte=since, metric='skill_listings').values('key').annotate(
+        skill=Max('label'), listings=Sum('value')
+    ).order_by('-listings', 'skill')[:10]
+    return {
+        'weeks': rows,
+        'top_skills': [{'skill': row['skill'], 'listings': int(row['listings'])} for row in top_skills],
+        'recent_events': [
+            {'event_id': int(key), 'title': label, 'day': day, 'turnout': int(value)}
+            for day, key, label, value in DailyStat.objects.filter(
+                day__gte=since, metric='event_turnout'
+            ).order_by('-day', 'label').values_list('day', 'key', 'label', 'value')[:10]
+        ],
+        'updated_at': max(RollupWatermark.objects.values_list('updated_at', flat=True), default=None),
+    }
@@ -0,0 +1,64 @@
+"""
+Read-replica routing.
+
+Reads go to the DATABASE_REPLICA_ALIAS database only when ReplicaRoutingMiddleware
+has marked the current request as read-only: a GET/HEAD/OPTIONS request from a
+visitor who has not written anything in the last REPLICA_PIN_SECONDS. As soon
+as a request writes, the rest of it reads from the primary, and the response
+pins the visitor to the primary for the pin window (read-your-writes).
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_replica_allowed = ContextVar('replica_allowed', default=False)
+_wrote_to_primary = ContextVar('wrote_to_primary', default=False)
+
+
+def replica_alias():
+    """The configured replica alias, or None when no replica is set up"""
+    alias = settings.DATABASE_REPLICA_ALIAS
+    return alias if alias in connections.settings else None
+
+
+@contextmanager
+def replica_reads(allowed=True):
+    """Allow (or forbid) replica reads for the enclosed code; yields a callable telling if it wrote"""
+    allowed_token = _replica_allowed.set(allowed)
+    wrote_token = _wrote_to_primary.set(False)
+    try:
+        yield _wrote_to_primary.get
+    finally:
+        _replica_allowed.reset(allowed_token)
+        _wrote_to_primary.reset(wrote_token)
+
+
+def wrote_to_primary():
+    """Whether the code running in this context has written (e.g. a task run in a copied context)"""
+    return _wrote_to_primary.get()
+
+
+def mark_wrote_to_primary():
+    """Count a write made in another context (e.g. on another thread) as this context's own"""
+    _wrote_to_primary.set(True)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = replica_alias()
+        if alias is None or not _replica_allowed.get() or _wrote_to_primary.get():
+            return DEFAULT_DB_ALIAS
+        # Reads inside a transaction must see that transaction's state
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        _wrote_to_primary.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same data as the primary
+        return True
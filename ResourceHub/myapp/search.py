@@ -0,0 +1,114 @@
+"""
+Per-user message search over an inverted index (MessageSearchTerm).
+
+Every message is split into lower-cased words, and each distinct word gets
+one row for the sender and one for the recipient. A search is then an
+indexed lookup on (user, term) that never touches the Message table, however
+large it grows. Results are ranked by how many of the query words a message
+contains, then by how often they occur, then newest first.
+
+Messages written with bulk_create skip Message.save(), so they are not indexed;
+code that bulk-creates them calls index_messages() afterwards, and
+`manage.py rebuild_message_index` indexes (or re-indexes) everything.
+"""
+import re
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import MessageSearchTerm
+
+WORD_RE = re.compile(r'\w+')
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 40
+MAX_QUERY_TERMS = 8
+SNIPPET_CONTEXT = 60  # characters either side of the first hit
+
+STOP_WORDS = frozenset('''
+    a an and are as at be but by for from has have i if in is it its me my no not of on or our so
+    that the their them then there they this to us was we were what when which who will with you your
+'''.split())
+
+
+def tokenize(text):
+    """The indexable words of text, with how often each occurs"""
+    return Counter(
+        word for word in WORD_RE.findall(text.lower())
+        if MIN_TERM_LENGTH <= len(word) <= MAX_TERM_LENGTH and word not in STOP_WORDS
+    )
+
+
+def search_terms_for(message):
+    """Unsaved MessageSearchTerm rows for one message (for bulk_create)"""
+    if message.conversation_id is None:
+        return []
+    terms = tokenize(message.body)
+    return [
+        MessageSearchTerm(user_id=user_id, term=term, message_id=message.pk,
+                          conversation_id=message.conversation_id, frequency=min(count, 32767))
+        for user_id in {message.sender_id, message.recipient_id}
+        for term, count in terms.items()
+    ]
+
+
+def index_message(message):
+    MessageSearchTerm.objects.bulk_create(search_terms_for(message), ignore_conflicts=True)
+
+
+def index_messages(messages, batch_size=2000):
+    """
+    Index a queryset of messages batch by batch, walking by primary key so memory stays flat
+    however many there are. Yields (messages indexed, index rows written) so far after each batch.
+    """
+    messages = messages.filter(conversation__isnull=False).only(
+        'id', 'body', 'sender_id', 'recipient_id', 'conversation_id'
+    ).order_by('id')
+    last_id, indexed, rows = 0, 0, 0
+    while True:
+        batch = list(messages.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        terms = [term for message in batch for term in search_terms_for(message)]
+        with transaction.atomic():
+            MessageSearchTerm.objects.bulk_create(terms, batch_size=5000, ignore_conflicts=True)
+        last_id = batch[-1].pk
+        indexed += len(batch)
+        rows += len(terms)
+        yield indexed, rows
+
+
+def query_terms(query):
+    return list(tokenize(query))[:MAX_QUERY_TERMS]
+
+
+def ranked_message_ids(user, terms, conversation=None):
+    """
+    Queryset of {'message_id', 'matched', 'weight'} for the user's messages containing
+    any of the terms, best first. Slice it (or hand it to a Paginator) to page.
+    """
+    hits = MessageSearchTerm.objects.filter(user=user, term__in=terms)
+    if conversation is not None:
+        hits = hits.filter(conversation=conversation)
+    return hits.values('message_id').annotate(
+        matched=Count('term'), weight=Sum('frequency')
+    ).order_by('-matched', '-weight', '-message_id')
+
+
+def snippet(body, terms):
+    """An escaped excerpt of body around the first matching word, with the matches in <mark>"""
+    if not terms:
+        return escape(body[:SNIPPET_CONTEXT * 2])
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(term) for term in terms) + r')\b', re.IGNORECASE)
+    first = pattern.search(body)
+    start = max(0, first.start() - SNIPPET_CONTEXT) if first else 0
+    end = min(len(body), (first.end() if first else 0) + SNIPPET_CONTEXT)
+
+    excerpt, parts, position = body[start:end], [], 0
+    for match in pattern.finditer(excerpt):
+        parts += [escape(excerpt[position:match.start()]), f'<mark>{escape(match.group(0))}</mark>']
+        position = match.end()
+    parts.append(escape(excerpt[position:]))
+    return mark_safe(('…' if start else '') + ''.join(parts) + ('…' if end < len(body) else ''))
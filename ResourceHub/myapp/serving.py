@@ -0,0 +1,130 @@
+"""
+File serving with HTTP caching.
+
+Content-addressed uploads (see myapp/storage.py) and their resized variants,
+whose names also carry the version of the variant settings (myapp/images.py),
+never change under a given name, so they are sent with a one-year `immutable` Cache-Control and their
+hash as the ETag. Older uploads still get an ETag so browsers can revalidate
+them cheaply. FileResponse hands the open file to the WSGI server's
+`wsgi.file_wrapper`, which uses sendfile(2) where available. With
+MEDIA_SENDFILE_HEADER set, a front-end server (nginx X-Accel-Redirect,
+Apache/lighttpd X-Sendfile) sends the bytes instead.
+
+Static files are served from STATIC_ROOT the same way. collectstatic names
+them by content hash and writes precompressed `.br`/`.gz` variants next to
+them, and serve_static sends the smallest one the browser accepts.
+"""
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+from .storage import content_digest
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'public, max-age=86400'
+
+# `<name>.<12 hex>.<ext>`, as ManifestStaticFilesStorage names the files it hashes
+HASHED_STATIC_RE = re.compile(r'\.(?P<digest>[0-9a-f]{12})(?P<suffix>\.\w+)$')
+
+# Preferred first: brotli is smaller than gzip
+STATIC_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _etag_matches(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    return etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+
+def _file_response(request, full_path, url_path, digest, cache_control):
+    """Validators, 304 handling and the (zero-copy) body shared by media and static serving"""
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404('File not found')
+    if not os.path.isfile(full_path):
+        raise Http404('File not found')
+
+    etag = f'"{digest}"' if digest else f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': cache_control,
+        'Last-Modified': http_date(stat.st_mtime),
+    }
+
+    if _etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    elif settings.MEDIA_SENDFILE_HEADER:
+        response = HttpResponse(content_type=mimetypes.guess_type(full_path)[0] or 'application/octet-stream')
+        if settings.MEDIA_SENDFILE_HEADER == 'X-Accel-Redirect':
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + url_path
+        else:
+            response[settings.MEDIA_SENDFILE_HEADER] = full_path
+    else:
+        response = FileResponse(open(full_path, 'rb'))
+
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    """Serve an uploaded file from MEDIA_ROOT"""
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('File not found')
+
+    digest = content_digest(path)
+    cache_control = IMMUTABLE_CACHE_CONTROL if digest else REVALIDATE_CACHE_CONTROL
+    return _file_response(request, full_path, settings.MEDIA_URL + path, digest, cache_control)
+
+
+def _accepted_encodings(request):
+    """Content codings the client accepts (those listed without q=0)"""
+    accepted = set()
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = item.partition(';')
+        quality = params.strip().removeprefix('q=')
+        try:
+            if quality and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+@require_safe
+def serve_static(request, path):
+    """Serve a collected static file from STATIC_ROOT, precompressed where the client accepts it"""
+    try:
+        full_path = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('File not found')
+
+    match = HASHED_STATIC_RE.search(path)
+    cache_control = IMMUTABLE_CACHE_CONTROL if match else REVALIDATE_CACHE_CONTROL
+
+    accepted = _accepted_encodings(request)
+    variants = [(coding, suffix) for coding, suffix in STATIC_ENCODINGS if os.path.isfile(full_path + suffix)]
+    encoding, suffix = next(((coding, suffix) for coding, suffix in variants if coding in accepted), (None, ''))
+
+    # The ETag names the encoding, as the variants are different bytes
+    digest = match['digest'] + match['suffix'] + suffix if match else None
+    response = _file_response(request, full_path + suffix, settings.STATIC_URL + path + suffix, digest, cache_control)
+    if encoding and response.status_code == 200:
+        response['Content-Type'] = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        response['Content-Encoding'] = encoding
+        response.headers.pop('Content-Disposition', None)
+    if variants:
+        patch_vary_headers(response, ['Accept-Encoding'])
+    return response
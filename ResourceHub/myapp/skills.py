@@ -0,0 +1,78 @@
+"""
+Skill registry: skill names to Skill ids without a query per skill.
+
+Names are matched case-insensitively with whitespace collapsed, so "Home
+Repair", "home  repair" and " HOME REPAIR" are all the same skill. Each worker
+process loads the whole (small) Skill table once, on first use, and then
+resolves known names from memory. Unknown names cost one lookup query, and
+genuinely new skills one bulk insert plus one query to read their ids back.
+
+Saving or deleting a Skill through the ORM (e.g. renaming, merging or
+deleting one in the admin) bumps the 'skills' cache namespace (myapp/cache.py).
+Every process checks that version, one cache read, before resolving names and
+reloads its registry when it has moved, so no worker keeps mapping a name to
+a deleted or renamed skill.
+"""
+import threading
+
+from django.db.models.functions import Lower
+
+from .cache import namespace_version
+from .models import Skill
+
+MAX_NAME_LENGTH = Skill._meta.get_field('name').max_length
+
+
+def normalize(name):
+    """The form a skill name is stored in: trimmed, inner whitespace collapsed, at most 50 characters"""
+    return ' '.join(name.split())[:MAX_NAME_LENGTH].strip()
+
+
+class SkillRegistry:
+    """Process-local cache of lower-cased skill name -> Skill id, reloaded when the 'skills' namespace moves on"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = None
+        self._version = None
+
+    def _load(self):
+        # Read before loading, so a change made during the load still triggers the next reload
+        version = namespace_version('skills')
+        with self._lock:
+            if self._ids is None or self._version != version:
+                self._ids = {name.lower(): pk for pk, name in Skill.objects.values_list('pk', 'name')}
+                self._version = version
+            return self._ids
+
+    def _remember(self, rows):
+        ids = self._load()
+        with self._lock:
+            for pk, name in rows:
+                ids.setdefault(name.lower(), pk)
+
+    def resolve(self, names):
+        """Ids of the named skills, in order and without duplicates, creating the ones that don't exist"""
+        wanted = {}
+        for name in map(normalize, names):
+            if name:
+                wanted.setdefault(name.lower(), name)
+
+        ids = self._load()
+        missing = [key for key in wanted if key not in ids]
+        if missing:
+            # Created by another process since this one loaded the table?
+            self._remember(Skill.objects.annotate(key=Lower('name')).filter(key__in=missing).values_list('pk', 'name'))
+            new = [wanted[key] for key in missing if key not in ids]
+            if new:
+                Skill.objects.bulk_create([Skill(name=name) for name in new], ignore_conflicts=True)
+                self._remember(Skill.objects.filter(name__in=new).values_list('pk', 'name'))
+
+        return [ids[key] for key in wanted if key in ids]
+
+    def clear(self):
+        with self._lock:
+            self._ids = None
+
+
+registry = SkillRegistry()
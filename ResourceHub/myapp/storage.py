@@ -0,0 +1,142 @@
+"""
+Content-addressed storage for user uploads.
+
+Uploads are stored under the SHA-256 of their bytes instead of the name the
+browser sent, e.g. `profiles/avatar.jpg` -> `profiles/3f/3fa9...c2.jpg`. Two
+identical uploads share one file, and since a name can never point at
+different content, the files can be cached by browsers forever.
+
+Static files get the same treatment at `manage.py collectstatic` time:
+CompressedManifestStaticFilesStorage writes each one under a name with its
+content hash (`css/site.css` -> `css/site.1f0c2b9ad3e4.css`) and, next to the
+text-based ones, gzip and (with the optional brotli package) brotli variants,
+so myapp/serving.py sends them without compressing anything per request.
+"""
+import gzip
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# `<dir>/<ab>/<ab...64 hex>.<ext>` plus the derived `<dir>/<ab>/variants/<ab...>.<variant>.<version>.<fmt>`
+CONTENT_ADDRESSED_RE = re.compile(
+    r'(?:^|/)(?P<prefix>[0-9a-f]{2})/(?:variants/)?(?P<digest>(?P=prefix)[0-9a-f]{62})(?P<suffix>(?:\.\w+)+)$'
+)
+
+
+def content_digest(name):
+    """The content hash encoded in a stored name (plus any variant suffix), or None"""
+    match = CONTENT_ADDRESSED_RE.search(name)
+    if match is None:
+        return None
+    return match['digest'] + match['suffix']
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    FileSystemStorage that names uploads by content hash and writes them atomically.
+
+    Files inside a `variants/` folder (see myapp/images.py) are derived from an
+    already hashed original and are written under the name they are given.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # The final name comes from the content in _save(), so there is nothing to make unique
+        return name
+
+    def _save(self, name, content):
+        directory, filename = posixpath.split(name)
+        derived = posixpath.basename(directory) == 'variants'
+
+        full_directory = self.path(directory)
+        os.makedirs(full_directory, exist_ok=True)
+
+        # Stream into a temp file in the target directory so the final rename is atomic
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=full_directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+
+            if derived:
+                final_name = name
+            else:
+                hexdigest = digest.hexdigest()
+                extension = posixpath.splitext(filename)[1].lower()
+                final_name = posixpath.join(directory, hexdigest[:2], hexdigest + extension)
+
+            final_path = self.path(final_name)
+            if not derived and os.path.exists(final_path):
+                # Identical content is already stored: reuse it
+                os.unlink(temp_path)
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.chmod(temp_path, self.file_permissions_mode or 0o644)
+                os.replace(temp_path, final_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+        return final_name.replace('\\', '/')
+
+
+# Only text compresses well; images, fonts and archives are compressed already
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.mjs', '.map', '.json', '.svg', '.txt', '.html', '.xml', '.ico'}
+COMPRESS_MIN_SIZE = 256
+
+
+def compressed_variants(content):
+    """{suffix: bytes} of the precompressed variants worth keeping for content"""
+    variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(content, quality=11)
+    return {suffix: data for suffix, data in variants.items() if len(data) < len(content)}
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    ManifestStaticFilesStorage that also writes `.gz` and `.br` variants of the
+    hashed text files, for serving.serve_static to pick by Accept-Encoding.
+
+    Until collectstatic has written a manifest (development, tests) names are
+    left unhashed and the staticfiles finders serve the source files.
+    """
+
+    def stored_name(self, name):
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        for hashed_name in set(self.hashed_files.values()):
+            if posixpath.splitext(hashed_name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            with self.open(hashed_name) as original:
+                content = original.read()
+            if len(content) < COMPRESS_MIN_SIZE:
+                continue
+            for suffix, data in compressed_variants(content).items():
+                if self.exists(hashed_name + suffix):
+                    # The same hash means the same bytes, so the variant is still current
+                    continue
+                self._save(hashed_name + suffix, ContentFile(data))
@@ -0,0 +1,63 @@
+import logging
+import os
+
+from django.template import TemplateDoesNotExist, TemplateSyntaxError, engines
+from django.template.autoreload import get_template_directories
+from django.template.backends.django import DjangoTemplates, Template
+
+from .metrics import rendering
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentedTemplate(Template):
+    def render(self, context=None, request=None):
+        with rendering(self.origin.template_name):
+            return super().render(context, request)
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """The Django template engine, with render time added to the request metrics (myapp/metrics.py)"""
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return InstrumentedTemplate(template.template, self)
+
+
+def template_names():
+    """Names of every template in the project's and the apps' template directories (Django's own excluded)"""
+    names = set()
+    for directory in get_template_directories():
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            names.update(
+                os.path.relpath(os.path.join(root, name), directory).replace(os.sep, '/')
+                for name in files if not name.startswith('.')
+            )
+    return sorted(names)
+
+
+def warm_templates():
+    """
+    Compile every template into the cached loader of this process, so the first
+    request to each page doesn't pay for reading and parsing it.
+    Returns (names compiled, {name: error} for the templates that failed).
+    """
+    compiled, errors = [], {}
+    for name in template_names():
+        try:
+            for engine in engines.all():
+                try:
+                    engine.get_template(name)
+                except TemplateDoesNotExist:
+                    # A directory of another engine
+                    continue
+        except TemplateSyntaxError as exc:
+            logger.error('Template %s does not compile: %s', name, exc)
+            errors[name] = exc
+        else:
+            compiled.append(name)
+    return compiled, errors
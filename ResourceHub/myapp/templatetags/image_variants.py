@@ -0,0 +1,30 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from myapp.images import has_variants, variant_name
+
+register = template.Library()
+
+
+@register.simple_tag
+def image_variant(image, variant, fmt='jpeg'):
+    """URL of a resized variant, falling back to the original until it has been generated"""
+    if not image:
+        return ''
+    if has_variants(image):
+        return image.storage.url(variant_name(image.name, variant, fmt))
+    return image.url
+
+
+@register.simple_tag
+def picture(image, variant, **attrs):
+    """<picture> element serving the WebP variant with a JPEG fallback"""
+    if not image:
+        return ''
+    attributes = format_html_join(' ', '{}="{}"', attrs.items())
+    return format_html(
+        '<picture><source srcset="{}" type="image/webp"><img src="{}" {}></picture>',
+        image_variant(image, variant, 'webp'),
+        image_variant(image, variant, 'jpeg'),
+        attributes,
+    )
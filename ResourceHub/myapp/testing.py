@@ -0,0 +1,36 @@
+"""
+Test helpers.
+
+QueryBudgetMixin.assertWithinQueryBudget() requests a URL and fails the test
+when its view issued more SQL queries than it declared with @query_budget
+(myapp/metrics.py), listing the queries it ran.
+"""
+from contextlib import ExitStack
+from urllib.parse import urlsplit
+
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+
+
+class QueryBudgetMixin:
+    """Mix into a TestCase to check views against their declared query budgets"""
+
+    def assertWithinQueryBudget(self, url, method='get', data=None, **extra):
+        match = resolve(urlsplit(url).path)
+        budget = getattr(match.func, 'query_budget', None)
+        if budget is None:
+            self.fail(f'{match.view_name} has no query budget; declare one with @query_budget(n)')
+
+        aliases = connections if self.databases == '__all__' else self.databases
+        with ExitStack() as stack:
+            captures = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in aliases]
+            response = getattr(self.client, method)(url, data, **extra)
+
+        queries = [query['sql'] for capture in captures for query in capture.captured_queries]
+        if len(queries) > budget:
+            self.fail(
+                f'{match.view_name} issued {len(queries)} queries, over its budget of {budget}:\n'
+                + '\n'.join(f'{number}. {sql}' for number, sql in enumerate(queries, 1))
+            )
+        return response
@@ -1,3 +1,1444 @@
-from django.test import TestCase
+import gzip
+import json
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from importlib import import_module
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.template import Context, Template
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+
+from ResourceHub.database import database_config
+
+from . import images, ratelimit, rollups
+from .admin import EstimatedCountPaginator, analyze_table
+from .auth_backends import forget_user
+from .cache import namespace_version
+from .form import ServiceListingForm, TransferForm
+from .images import generate_variants, has_variants, variant_name
+from .matching import refresh_all, rescore, send_match_alerts
+from .metrics import registry
+from .middleware import REPLICA_PIN_COOKIE
+from .outbox import drain, enqueue, notify
+from .ratelimit import stats as rate_limit_stats
+from .models import (Conversation, ConversationMember, DailyStat, Event, EventOccurrence, ListingMatch, Message,
+                     MessageSearchTerm, Notification, OutboxEvent, Profile, RollupWatermark, ServiceListing, Skill, Tool,
+                     ToolBorrow, Transaction)
+from .routers import ReplicaRouter, replica_reads
+from .search import tokenize
+from .skills import SkillRegistry, registry as skill_registry
+from .template_backends import warm_templates
+from .testing import QueryBudgetMixin
 
 # Create your tests here.
+
+@skipUnless('replica' in settings.DATABASES, 'These settings configure no replica for the test run')
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    The test primary and replica are two separate SQLite databases (settings.py adds the replica
+    for `manage.py test`) with no replication between them, so a row written to the primary is
+    only visible where reads went there.
+    TransactionTestCase keeps the primary out of a test-wide transaction, which the
+    router would otherwise (correctly) treat as a reason to read from the primary.
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='password123')
+        self.listing = ServiceListing.objects.create(
+            user=self.owner, title='Replica test listing', description='d', listing_type='OFFER'
+        )
+
+    def test_reads_use_replica_only_when_allowed(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(ServiceListing), 'default')
+        with replica_reads():
+            self.assertEqual(router.db_for_read(ServiceListing), 'replica')
+        with replica_reads(allowed=False):
+            self.assertEqual(router.db_for_read(ServiceListing), 'default')
+
+    def test_reads_after_a_write_use_primary(self):
+        router = ReplicaRouter()
+        with replica_reads() as wrote_to_primary:
+            self.assertEqual(router.db_for_write(ServiceListing), 'default')
+            self.assertTrue(wrote_to_primary())
+            self.assertEqual(router.db_for_read(ServiceListing), 'default')
+
+    def test_writes_always_use_primary(self):
+        self.assertEqual(self.listing._state.db, 'default')
+        self.assertFalse(ServiceListing.objects.using('replica').filter(pk=self.listing.pk).exists())
+
+    def test_get_request_reads_from_replica(self):
+        response = self.client.get('/listings/')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'Replica test listing')
+
+    def test_pinned_visitor_reads_from_primary(self):
+        self.client.cookies[REPLICA_PIN_COOKIE] = '1'
+        response = self.client.get('/listings/')
+        self.assertContains(response, 'Replica test listing')
+
+    def test_write_pins_visitor_to_primary(self):
+        # Logging in writes last_login and the session, so the response pins the visitor
+        response = self.client.post('/login/', {'username': 'owner', 'password': 'password123'})
+        self.assertIn(REPLICA_PIN_COOKIE, response.cookies)
+        self.assertEqual(response.cookies[REPLICA_PIN_COOKIE]['max-age'], settings.REPLICA_PIN_SECONDS)
+
+        response = self.client.get('/listings/')
+        self.assertContains(response, 'Replica test listing')
+
+    def batch(self, *requests):
+        return self.client.post('/api/v1/batch/', json.dumps({'requests': list(requests)}),
+                                content_type='application/json')
+
+    def titles(self, response):
+        return [[row['title'] for row in entry['body']['data']] for entry in response.json()['responses']]
+
+    def test_batched_reads_use_replica_until_a_write(self):
+        self.client.force_login(self.owner)
+        reads = [{'path': '/api/v1/listings/?fields=title'}, {'path': '/api/v1/listings/?fields=title&limit=5'}]
+        response = self.batch(*reads)
+        self.assertEqual(self.titles(response), [[], []])
+        self.assertNotIn(REPLICA_PIN_COOKIE, response.cookies)
+
+        response = self.batch(
+            reads[0],
+            {'method': 'POST', 'path': '/api/v1/listings/', 'body': {'title': 'Soup', 'description': 'd', 'type': 'OFFER'}},
+            *reads,
+        )
+        before, created, *after = response.json()['responses']
+        self.assertEqual(before['body']['data'], [])
+        self.assertEqual(created['status'], 201)
+        self.assertEqual([[row['title'] for row in entry['body']['data']] for entry in after],
+                         [['Soup', 'Replica test listing']] * 2)
+        self.assertIn(REPLICA_PIN_COOKIE, response.cookies)
+
+        self.client.cookies[REPLICA_PIN_COOKIE] = '1'
+        self.assertEqual(self.titles(self.batch(*reads)), [['Soup', 'Replica test listing']] * 2)
+
+    def test_batched_read_that_writes_pins_visitor(self):
+        cache.clear()
+
+        def markers():
+            Skill.objects.create(name='Written while reading')
+            return {'users': [], 'services': [], 'tools': [], 'events': []}
+
+        with mock.patch('myapp.views._map_markers', side_effect=markers):
+            response = self.batch({'path': '/api/map-data/'}, {'path': '/api/v1/listings/?fields=title'})
+        self.assertEqual([entry['status'] for entry in response.json()['responses']], [200, 200])
+        self.assertIn(REPLICA_PIN_COOKIE, response.cookies)
+
+
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    """The busiest pages must stay within their @query_budget however much data they show"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('member', password='password123')
+        Profile.objects.create(user=cls.user, location='Town', latitude=52.37, longitude=4.89)
+        gardening, cooking, repairs = (Skill.objects.create(name=name) for name in ('Gardening', 'Cooking', 'Repairs'))
+
+        for kind in ('OFFER', 'REQUEST'):
+            listing = ServiceListing.objects.create(user=cls.user, title=f'My {kind}', description='d', listing_type=kind)
+            listing.skills.set([gardening, cooking])
+
+        for number in range(5):
+            neighbour = User.objects.create_user(f'neighbour{number}', password='password123')
+            Profile.objects.create(user=neighbour, location='Town', latitude=52.36 + number / 100, longitude=4.9)
+            for kind in ('OFFER', 'REQUEST'):
+                listing = ServiceListing.objects.create(user=neighbour, title=f'{kind} {number}', description='d', listing_type=kind)
+                listing.skills.set([gardening, repairs])
+            Tool.objects.create(owner=neighbour, name=f'Drill {number}', description='d')
+            event = Event.objects.create(
+                organizer=neighbour, title=f'Meetup {number}', description='d', event_type='GATHERING',
+                location='Park', event_date=timezone.now() + timedelta(days=number + 1), recurrence='WEEKLY',
+            )
+            event.participants.add(cls.user)
+            event.materialize_occurrences()
+
+            conversation = Conversation.objects.create(participant1=cls.user, participant2=neighbour, listing=listing)
+            for _ in range(3):
+                Message.objects.create(conversation=conversation, sender=neighbour, recipient=cls.user, body='Hello')
+
+        refresh_all()
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_pages_within_budget(self):
+        for url in ('/', '/listings/', '/listings/?q=garden', '/tools/', '/events/', '/matches/', '/messages/', '/api/map-data/'):
+            with self.subTest(url=url):
+                response = self.assertWithinQueryBudget(url)
+                self.assertEqual(response.status_code, 200)
+
+    @override_settings(SERVER_TIMING=True)
+    def test_server_timing_header(self):
+        response = self.client.get('/listings/')
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", tpl;dur=[\d.]+;desc="Templates", total;dur=[\d.]+$')
+
+    @override_settings(SERVER_TIMING=False)
+    def test_server_timing_header_can_be_left_out(self):
+        self.assertNotIn('Server-Timing', self.client.get('/listings/'))
+
+    def test_metrics_endpoint_is_staff_only(self):
+        registry.reset()
+        self.client.get('/tools/')
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 302)
+
+        self.user.is_staff = True
+        self.user.save()
+        summary = self.client.get('/api/metrics/').json()['views']
+        self.assertEqual(summary['tool_browse']['requests'], 1)
+        self.assertEqual(summary['tool_browse']['query_budget'], 6)
+
+
+@override_settings(TIME_ZONE='Europe/Amsterdam')
+class EventRecurrenceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.organizer = User.objects.create_user('organizer', password='password123')
+
+    def event(self, event_date, recurrence, **fields):
+        return Event.objects.create(organizer=self.organizer, title='Repair cafe', description='d', event_type='GATHERING',
+                                    location='Library', event_date=event_date, recurrence=recurrence, **fields)
+
+    def local(self, *args):
+        return timezone.make_aware(datetime(*args))
+
+    def local_times(self, starts):
+        return [timezone.localtime(start).strftime('%Y-%m-%d %H:%M') for start in starts]
+
+    def test_weekly_event_keeps_its_local_time_across_dst(self):
+        # Summer time starts on 29 March 2026 and ends on 25 October 2026
+        event = self.event(self.local(2026, 3, 22, 19, 0), 'WEEKLY')
+        starts = list(event.iter_occurrences(self.local(2026, 3, 1), self.local(2026, 4, 6)))
+        self.assertEqual(self.local_times(starts), ['2026-03-22 19:00', '2026-03-29 19:00', '2026-04-05 19:00'])
+        # An hour less than a week has passed, in absolute time
+        self.assertEqual(starts[1].astimezone(dt_timezone.utc) - starts[0], timedelta(days=7, hours=-1))
+
+        starts = list(event.iter_occurrences(self.local(2026, 10, 20), self.local(2026, 11, 2)))
+        self.assertEqual(self.local_times(starts), ['2026-10-25 19:00', '2026-11-01 19:00'])
+
+    def test_daily_event_found_from_a_start_after_dst(self):
+        event = self.event(self.local(2026, 1, 1, 0, 30), 'DAILY')
+        starts = list(event.iter_occurrences(self.local(2026, 6, 1, 0, 15), self.local(2026, 6, 2, 0, 45)))
+        self.assertEqual(self.local_times(starts), ['2026-06-01 00:30', '2026-06-02 00:30'])
+
+    def test_failed_rebuild_keeps_the_old_occurrences(self):
+        event = self.event(timezone.now() + timedelta(days=1), 'WEEKLY')
+        event.materialize_occurrences()
+        stored = list(event.occurrences.values_list('start', flat=True))
+        self.assertTrue(stored)
+        with mock.patch.object(EventOccurrence.objects, 'bulk_create', side_effect=IntegrityError), \
+                self.assertRaises(IntegrityError):
+            event.materialize_occurrences()
+        self.assertEqual(list(event.occurrences.values_list('start', flat=True)), stored)
+
+    def test_monthly_event_is_clamped_to_short_months(self):
+        event = self.event(self.local(2026, 1, 31, 10, 0), 'MONTHLY')
+        starts = list(event.iter_occurrences(self.local(2026, 1, 1), self.local(2026, 5, 1)))
+        self.assertEqual(self.local_times(starts),
+                         ['2026-01-31 10:00', '2026-02-28 10:00', '2026-03-31 10:00', '2026-04-30 10:00'])
+
+    def test_series_stops_at_recurrence_end(self):
+        event = self.event(self.local(2026, 3, 22, 19, 0), 'WEEKLY', recurrence_end=self.local(2026, 4, 5, 19, 0))
+        starts = list(event.iter_occurrences(self.local(2026, 3, 1), self.local(2026, 6, 1)))
+        self.assertEqual(self.local_times(starts), ['2026-03-22 19:00', '2026-03-29 19:00', '2026-04-05 19:00'])
+
+    def test_materialize_occurrences(self):
+        now = timezone.now()
+        event = self.event(now + timedelta(days=1), 'WEEKLY', recurrence_end=now + timedelta(days=16))
+        self.assertEqual(event.materialize_occurrences(weeks=4), 3)
+        self.assertEqual(list(event.occurrences.values_list('start', flat=True)),
+                         list(event.iter_occurrences(now, now + timedelta(weeks=4))))
+
+        event.recurrence_end = None
+        self.assertEqual(event.materialize_occurrences(weeks=4), 4)
+        event.is_active = False
+        self.assertEqual(event.materialize_occurrences(weeks=4), 0)
+        self.assertFalse(event.occurrences.exists())
+
+    def test_dashboard_lists_the_next_date_of_a_joined_series(self):
+        event = self.event(timezone.now() - timedelta(days=3), 'WEEKLY')
+        event.participants.add(self.organizer)
+        event.materialize_occurrences()
+        self.client.force_login(self.organizer)
+        response = self.client.get('/dashboard/')
+        self.assertEqual(list(response.context['joined_events']), [event])
+        self.assertEqual(response.context['joined_events'][0].next_start, event.occurrences.first().start)
+
+
+@override_settings(CONVERSATION_PAGE_SIZE=5)
+class ConversationHistoryTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password123')
+        cls.bob = User.objects.create_user('bob', password='password123')
+        cls.conversation = Conversation.objects.create(participant1=cls.alice, participant2=cls.bob)
+        cls.thread = [
+            Message.objects.create(conversation=cls.conversation, sender=cls.bob, recipient=cls.alice, body=f'Message {n}')
+            for n in range(12)
+        ]
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+        self.url = f'/messages/conversation/{self.conversation.pk}/'
+
+    def ids(self, html):
+        return [int(part.split('"')[0]) for part in html.split('data-message-id="')[1:]]
+
+    def test_detail_renders_latest_page_only(self):
+        response = self.assertWithinQueryBudget(self.url)
+        self.assertEqual([m.pk for m in response.context['thread_messages']], [m.pk for m in self.thread[-5:]])
+        self.assertTrue(response.context['has_older'])
+        self.assertFalse(Message.objects.filter(recipient=self.alice, is_read=False).exists())
+
+    def test_history_pages_back_with_before_id(self):
+        data = self.assertWithinQueryBudget(f'{self.url}history/?before_id={self.thread[7].pk}').json()
+        self.assertEqual(self.ids(data['html']), [m.pk for m in self.thread[2:7]])
+        self.assertTrue(data['has_more'])
+
+        data = self.client.get(f'{self.url}history/?before_id={data["first_id"]}').json()
+        self.assertEqual(self.ids(data['html']), [m.pk for m in self.thread[:2]])
+        self.assertFalse(data['has_more'])
+
+    def test_history_returns_newer_with_after_id(self):
+        data = self.client.get(f'{self.url}history/?after_id={self.thread[-3].pk}').json()
+        self.assertEqual(self.ids(data['html']), [m.pk for m in self.thread[-2:]])
+        self.assertEqual(data['last_id'], self.thread[-1].pk)
+
+    def test_history_marks_only_the_returned_messages_read(self):
+        # Seven new messages: a page of five, then the remaining two
+        after_id = self.thread[4].pk
+        data = self.client.get(f'{self.url}history/?after_id={after_id}').json()
+        self.assertEqual(self.ids(data['html']), [m.pk for m in self.thread[5:10]])
+        self.assertTrue(data['has_more'])
+        unread = Message.objects.filter(recipient=self.alice, is_read=False, pk__gt=after_id)
+        self.assertEqual(list(unread.values_list('pk', flat=True)), [m.pk for m in self.thread[10:]])
+
+        data = self.client.get(f'{self.url}history/?after_id={data["last_id"]}').json()
+        self.assertFalse(data['has_more'])
+        self.assertFalse(unread.exists())
+
+    def test_send_returns_only_the_delta(self):
+        reply = Message.objects.create(conversation=self.conversation, sender=self.bob, recipient=self.alice, body='Are you there?')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.assertWithinQueryBudget(f'{self.url}send/', method='post',
+                                                    data={'body': 'Hello Bob', 'after_id': self.thread[-1].pk})
+        sent = Message.objects.get(body='Hello Bob')
+        self.assertEqual(self.ids(response.json()['html']), [reply.pk, sent.pk])
+        self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).updated_at, sent.created_at)
+        self.assertTrue(Notification.objects.filter(user=self.bob, notification_type='MESSAGE').exists())
+
+    def test_send_rejects_outsiders_and_blank_messages(self):
+        self.assertEqual(self.client.post(f'{self.url}send/', {'body': ''}).status_code, 400)
+        self.client.force_login(User.objects.create_user('mallory', password='password123'))
+        self.assertEqual(self.client.post(f'{self.url}send/', {'body': 'Hi'}).status_code, 403)
+        self.assertFalse(Message.objects.filter(body='Hi').exists())
+
+    def test_history_is_private(self):
+        self.client.force_login(User.objects.create_user('mallory', password='password123'))
+        self.assertEqual(self.client.get(f'{self.url}history/').status_code, 403)
+
+
+class MessageSearchTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password123')
+        cls.bob = User.objects.create_user('bob', password='password123')
+        cls.carol = User.objects.create_user('carol', password='password123')
+        cls.with_bob = Conversation.objects.create(participant1=cls.alice, participant2=cls.bob)
+        cls.with_carol = Conversation.objects.create(participant1=cls.carol, participant2=cls.bob)
+
+        def send(conversation, sender, recipient, body):
+            return Message.objects.create(conversation=conversation, sender=sender, recipient=recipient, body=body)
+
+        cls.both = send(cls.with_bob, cls.bob, cls.alice, 'Can you fix my bike? The bike chain is broken')
+        cls.one = send(cls.with_bob, cls.alice, cls.bob, 'Sure, I can look at the bike tomorrow')
+        cls.private = send(cls.with_carol, cls.carol, cls.bob, 'Bike chain for sale <b>cheap</b>')
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def test_new_messages_are_indexed_for_both_participants(self):
+        self.assertEqual(
+            set(MessageSearchTerm.objects.filter(message=self.one, term='bike').values_list('user__username', flat=True)),
+            {'alice', 'bob'},
+        )
+        self.assertFalse(MessageSearchTerm.objects.filter(message=self.one, term='the').exists())
+
+    def test_results_ranked_and_private(self):
+        response = self.assertWithinQueryBudget('/messages/search/?q=Bike+chain')
+        self.assertEqual([result['message'] for result in response.context['results']], [self.both, self.one])
+        self.assertContains(response, '<mark>bike</mark>', html=False)
+        self.assertNotContains(response, 'for sale')
+
+    def test_snippet_is_escaped(self):
+        self.client.force_login(self.carol)
+        response = self.client.get('/messages/search/?q=cheap')
+        self.assertContains(response, '&lt;b&gt;<mark>cheap</mark>&lt;/b&gt;', html=False)
+
+    def test_benchmark_data_is_searchable(self):
+        def generate(**options):
+            call_command('generate_benchmark_data', users=4, listings_per_user=1, conversations_per_user=1,
+                         messages_per_conversation=3, notifications_per_user=1, transactions=2, tools_per_user=1,
+                         events=1, stdout=StringIO(), **options)
+            return MessageSearchTerm.objects.count()
+
+        terms = generate()
+        messages = Message.objects.filter(sender__username__startswith='bench_')
+        self.assertTrue(messages.exists())
+        self.assertFalse(messages.filter(search_terms__isnull=True).exists())
+        # Clearing takes the old messages' search terms with them
+        self.assertEqual(generate(clear=True), terms)
+
+        message = messages.first()
+        self.client.force_login(message.recipient)
+        response = self.client.get(f'/messages/search/?q={next(iter(tokenize(message.body)))}')
+        self.assertIn(message, [result['message'] for result in response.context['results']])
+
+    def test_rebuild_command_restores_the_index(self):
+        MessageSearchTerm.objects.all().delete()
+        call_command('rebuild_message_index', stdout=StringIO())
+        response = self.client.get('/messages/search/?q=tomorrow')
+        self.assertEqual([result['message'] for result in response.context['results']], [self.one])
+
+
+class ConversationPairKeyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password123')
+        cls.bob = User.objects.create_user('bob', password='password123')
+        cls.listing = ServiceListing.objects.create(user=cls.bob, title='Bike repair', description='d', listing_type='OFFER')
+
+    def test_either_direction_reuses_the_thread(self):
+        self.client.force_login(self.alice)
+        first = self.client.get('/messages/start/bob/')
+        self.client.force_login(self.bob)
+        second = self.client.get('/messages/start/alice/')
+        self.assertEqual(first.url, second.url)
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.pair_key, f'{self.alice.pk}:{self.bob.pk}:')
+        self.assertEqual(set(conversation.members.values_list('user__username', flat=True)), {'alice', 'bob'})
+
+    def test_listing_threads_are_separate(self):
+        direct, _ = Conversation.get_or_create_between(self.alice, self.bob)
+        about_listing, created = Conversation.get_or_create_between(self.bob, self.alice, self.listing)
+        self.assertTrue(created)
+        self.assertNotEqual(direct, about_listing)
+        self.assertEqual(Conversation.get_or_create_between(self.alice, self.bob, self.listing), (about_listing, False))
+
+    def test_unique_index_rejects_reversed_duplicate(self):
+        Conversation.objects.create(participant1=self.alice, participant2=self.bob)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Conversation.objects.create(participant1=self.bob, participant2=self.alice)
+
+    def test_inbox_lists_member_conversations(self):
+        carol = User.objects.create_user('carol', password='password123')
+        mine, _ = Conversation.get_or_create_between(self.alice, self.bob)
+        Conversation.get_or_create_between(self.bob, carol)
+        Message.objects.create(conversation=mine, sender=self.bob, recipient=self.alice, body='First')
+        latest = Message.objects.create(conversation=mine, sender=self.bob, recipient=self.alice, body='Latest')
+
+        self.client.force_login(self.alice)
+        conversations = self.client.get('/messages/').context['conversations']
+        self.assertEqual([c['conversation'] for c in conversations], [mine])
+        self.assertEqual(conversations[0]['last_message'], latest)
+
+    def test_migration_merges_duplicate_threads(self):
+        # Legacy rows: A→B and B→A threads created before the pair key existed
+        legacy = Conversation.objects.bulk_create([
+            Conversation(participant1=self.alice, participant2=self.bob, pair_key='legacy-1'),
+            Conversation(participant1=self.bob, participant2=self.alice, pair_key='legacy-2'),
+        ])
+        for conversation in legacy:
+            Message.objects.create(conversation=conversation, sender=self.alice, recipient=self.bob, body='Hi')
+
+        import_module('myapp.migrations.0011_merge_duplicate_conversations').merge_duplicates(apps, None)
+
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.pk, legacy[0].pk)
+        self.assertEqual(conversation.pair_key, f'{self.alice.pk}:{self.bob.pk}:')
+        self.assertEqual(conversation.messages.count(), 2)
+        self.assertEqual(ConversationMember.objects.filter(conversation=conversation).count(), 2)
+
+
+@override_settings(CONVERSATION_PAGE_SIZE=5)
+class MessageArchiveTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password123')
+        cls.bob = User.objects.create_user('bob', password='password123')
+        cls.conversation = Conversation.objects.create(participant1=cls.alice, participant2=cls.bob)
+        cls.thread = [
+            Message.objects.create(conversation=cls.conversation, sender=cls.bob, recipient=cls.alice,
+                                   body=f'Message {n}', is_read=True)
+            for n in range(20)
+        ]
+        cls.pending = cls.thread[6]
+        Message.objects.filter(pk=cls.pending.pk).update(requires_response=True, response_status='PENDING')
+        Message.objects.filter(pk__in=[m.pk for m in cls.thread[:16]]).update(
+            created_at=timezone.now() - timedelta(days=400)
+        )
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+        self.url = f'/messages/conversation/{self.conversation.pk}/'
+
+    def archive(self):
+        call_command('archive_messages', '--segment-size', '4', stdout=StringIO())
+        self.conversation.refresh_from_db()
+
+    def test_old_messages_move_into_segments(self):
+        self.archive()
+        live = set(self.conversation.messages.values_list('pk', flat=True))
+        self.assertEqual(live, {self.pending.pk} | {m.pk for m in self.thread[16:]})
+        self.assertEqual(self.conversation.archive_segments.count(), 4)
+        self.assertEqual(sum(s.message_count for s in self.conversation.archive_segments.all()), 15)
+        self.assertEqual(self.conversation.archived_up_to, self.thread[15].pk)
+        self.assertFalse(MessageSearchTerm.objects.filter(message_id=self.thread[0].pk).exists())
+
+    def test_latest_message_stays_live(self):
+        Message.objects.filter(conversation=self.conversation).update(created_at=timezone.now() - timedelta(days=400))
+        self.archive()
+        self.assertIn(self.thread[-1].pk, self.conversation.messages.values_list('pk', flat=True))
+
+    def test_scrolling_back_reads_through_the_archive(self):
+        self.archive()
+        response = self.assertWithinQueryBudget(self.url)
+        self.assertEqual([m.pk for m in response.context['thread_messages']], [m.pk for m in self.thread[15:]])
+
+        before_id, seen = response.context['thread_messages'][0].pk, []
+        while True:
+            data = self.assertWithinQueryBudget(f'{self.url}history/?before_id={before_id}').json()
+            seen = [int(part.split('"')[0]) for part in data['html'].split('data-message-id="')[1:]] + seen
+            if not data['has_more']:
+                break
+            before_id = data['first_id']
+        self.assertEqual(seen, [m.pk for m in self.thread[:15]])
+        self.assertContains(self.client.get(f'{self.url}history/?before_id={self.thread[3].pk}'), 'Message 2')
+
+    def test_dry_run_changes_nothing(self):
+        out = StringIO()
+        call_command('archive_messages', '--dry-run', stdout=out)
+        self.assertIn('Would archive 15 messages', out.getvalue())
+        self.assertEqual(self.conversation.messages.count(), 20)
+
+
+@override_settings(OUTBOX_DRAIN_ON_COMMIT=False)
+class OutboxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password123')
+        cls.bob = User.objects.create_user('bob', password='password123')
+        Profile.objects.bulk_create([Profile(user=cls.alice, time_credits=10), Profile(user=cls.bob, time_credits=10)])
+        cls.conversation = Conversation.objects.create(participant1=cls.alice, participant2=cls.bob)
+
+    def credit_request(self, amount='3'):
+        return Message.objects.create(conversation=self.conversation, sender=self.alice, recipient=self.bob,
+                                      body='For the bike repair', is_credit_request=True,
+                                      credit_amount=Decimal(amount), credit_status='PENDING')
+
+    def test_accepting_a_credit_request_pays_once(self):
+        request = self.credit_request()
+        self.client.force_login(self.bob)
+        url = f'/messages/credit/{request.pk}/respond/accept/'
+        self.client.get(url)
+        self.client.get(url)
+
+        self.assertEqual(Transaction.objects.filter(sender=self.bob, receiver=self.alice).count(), 1)
+        self.assertEqual(Profile.objects.get(user=self.bob).time_credits, 7)
+        self.assertEqual(Profile.objects.get(user=self.alice).time_credits, 13)
+
+        # The confirmation and notification wait in the outbox until it is drained
+        self.assertFalse(Notification.objects.exists())
+        self.assertEqual(OutboxEvent.objects.filter(processed_at__isnull=True).count(), 2)
+        call_command('drain_outbox', stdout=StringIO())
+        call_command('drain_outbox', stdout=StringIO())
+        self.assertEqual(Notification.objects.filter(user=self.alice, notification_type='CREDIT_RECEIVED').count(), 1)
+        self.assertEqual(self.conversation.messages.filter(sender=self.bob).count(), 1)
+
+    def test_accepted_credit_request_refreshes_cached_balances(self):
+        request = self.credit_request()
+        self.client.force_login(self.bob)
+        version = namespace_version('map')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(f'/messages/credit/{request.pk}/respond/accept/')
+        self.assertGreater(namespace_version('map'), version)
+        self.assertEqual(Transaction.objects.get(sender=self.bob).description, 'For the bike repair')
+
+    def test_side_effects_roll_back_with_the_change(self):
+        request = self.credit_request(amount='50')
+        self.client.force_login(self.bob)
+        self.client.get(f'/messages/credit/{request.pk}/respond/accept/')
+        self.assertEqual(Message.objects.get(pk=request.pk).credit_status, 'PENDING')
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_borrow_response_notifies_borrower(self):
+        tool = Tool.objects.create(owner=self.bob, name='Ladder', description='d')
+        borrow = ToolBorrow.objects.create(tool=tool, borrower=self.alice, start_date=timezone.now(),
+                                           end_date=timezone.now() + timedelta(days=2))
+        self.client.force_login(self.bob)
+        self.client.get(f'/notifications/borrow/{borrow.pk}/respond/accept/')
+        self.assertFalse(Tool.objects.get(pk=tool.pk).is_available)
+
+        drain()
+        self.assertTrue(Notification.objects.filter(user=self.alice, notification_type='TOOL_APPROVED').exists())
+
+    def test_failed_events_are_retried_without_blocking_others(self):
+        enqueue('notification', user_id=self.alice.pk)  # missing fields
+        notify(self.bob, 'MESSAGE', 'Hello')
+        with self.assertLogs('myapp.outbox', 'ERROR'):
+            self.assertEqual(drain(), (1, 1))
+        broken = OutboxEvent.objects.get(processed_at__isnull=True)
+        self.assertEqual(broken.attempts, 1)
+        self.assertIn('TypeError', broken.last_error)
+        self.assertTrue(Notification.objects.filter(user=self.bob).exists())
+
+    @override_settings(OUTBOX_DRAIN_ON_COMMIT=True)
+    def test_drains_after_commit_in_development(self):
+        request = Message.objects.create(conversation=self.conversation, sender=self.alice, recipient=self.bob,
+                                         body='Can you help?', requires_response=True, response_status='PENDING')
+        self.client.force_login(self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(f'/messages/{request.pk}/respond/decline/')
+        self.assertEqual(Message.objects.get(pk=request.pk).response_status, 'DECLINED')
+        self.assertTrue(Notification.objects.filter(user=self.alice, message='bob declined your request').exists())
+        self.assertFalse(OutboxEvent.objects.filter(processed_at__isnull=True).exists())
+
+
+class SkillRegistryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password='password123')
+        Skill.objects.create(name='Cooking')
+
+    def setUp(self):
+        skill_registry.clear()
+        self.client.force_login(self.user)
+
+    def test_resolves_case_insensitively_and_creates_new_skills(self):
+        ids = skill_registry.resolve(['cooking', '  Bike   repair ', 'BIKE REPAIR', '', 'Cooking'])
+        self.assertEqual(ids, list(Skill.objects.filter(name__in=['Cooking', 'Bike repair']).order_by('name').values_list('pk', flat=True)[::-1]))
+        self.assertEqual(Skill.objects.count(), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(skill_registry.resolve(['bike repair', 'COOKING']), ids[::-1])
+
+    def test_create_saves_skills(self):
+        self.client.post('/listings/create/', {
+            'title': 'Dinners', 'description': 'd', 'listing_type': 'OFFER',
+            'skills': ['Cooking', 'Baking'], 'other_skills': 'baking, Meal prep',
+        })
+        listing = ServiceListing.objects.get(title='Dinners')
+        self.assertEqual(sorted(listing.skills.values_list('name', flat=True)), ['Baking', 'Cooking', 'Meal prep'])
+
+    def test_edit_applies_only_the_difference(self):
+        listing = ServiceListing.objects.create(user=self.user, title='Dinners', description='d', listing_type='OFFER')
+        listing.skills.set(skill_registry.resolve(['Cooking', 'Baking']))
+        skill_registry.resolve(['Meal prep'])
+
+        data = {'title': 'Dinners', 'description': 'd', 'listing_type': 'OFFER', 'skills': ['Cooking'], 'other_skills': 'Meal prep'}
+        form = ServiceListingForm(data, instance=listing)
+        self.assertTrue(form.is_valid())
+        # UPDATE the listing, read its current skills, delete Baking, check and insert Meal prep,
+        # plus a match rescore queued for each of the three changes
+        with self.assertNumQueries(8):
+            form.save()
+        self.assertEqual(sorted(listing.skills.values_list('name', flat=True)), ['Cooking', 'Meal prep'])
+
+    def test_other_processes_see_renames_and_deletes(self):
+        other_process = SkillRegistry()
+        cooking, = other_process.resolve(['Cooking'])
+        baking, = other_process.resolve(['Baking'])
+
+        # Changed through this process (e.g. in the admin); the other process only shares the cache
+        Skill.objects.filter(pk=cooking).get().delete()
+        renamed = Skill.objects.get(pk=baking)
+        renamed.name = 'Bread baking'
+        renamed.save()
+
+        new_cooking, = other_process.resolve(['Cooking'])
+        self.assertNotEqual(new_cooking, cooking)
+        self.assertEqual(other_process.resolve(['bread baking']), [baking])
+        self.assertNotEqual(other_process.resolve(['Baking']), [baking])
+
+        listing = ServiceListing.objects.create(user=self.user, title='Bread', description='d', listing_type='OFFER')
+        listing.skills.set(other_process.resolve(['Cooking', 'Bread baking']))
+        self.assertEqual(sorted(listing.skills.values_list('name', flat=True)), ['Bread baking', 'Cooking'])
+
+
+class UserSearchTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password123', first_name='Alice', last_name='Smith')
+        cls.bob = User.objects.create_user('bob', password='password123', first_name='Bob', last_name='Smithers')
+        User.objects.create_user('smitty', password='password123')
+        User.objects.create_user('smith_gone', password='password123', is_active=False)
+        for number in range(12):
+            User.objects.create_user(f'member{number:02}', password='password123')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.alice)
+
+    def search(self, query):
+        return [result['username'] for result in self.assertWithinQueryBudget(f'/api/users/search/?q={query}').json()['results']]
+
+    def test_matches_username_and_name_prefixes(self):
+        self.assertEqual(self.search('SMIT'), ['bob', 'smitty'])
+        self.assertEqual(self.search('bob sm'), ['bob'])
+        self.assertEqual(self.search('b'), [])
+
+    def test_results_are_limited(self):
+        self.assertEqual(self.search('member'), [f'member{number:02}' for number in range(10)])
+
+    def test_logins_and_transfers_keep_the_cached_results(self):
+        self.search('smit')
+        version = namespace_version('users')
+        self.client.login(username='bob', password='password123')
+        Profile.objects.create(user=self.alice, time_credits=5)
+        Profile.objects.create(user=self.bob)
+        self.client.force_login(self.alice)
+        self.client.post('/transfer/', {'receiver': self.bob.pk, 'receiver_name': 'bob', 'amount': '2', 'description': 'Soup'})
+        self.assertEqual(namespace_version('users'), version)
+
+        self.bob.first_name = 'Robert'
+        self.bob.save()
+        self.assertGreater(namespace_version('users'), version)
+
+    def test_transfer_page_does_not_list_members(self):
+        response = self.client.get('/transfer/')
+        self.assertNotContains(response, 'member05')
+
+    def test_transfer_page_moves_credits(self):
+        Profile.objects.create(user=self.alice, time_credits=5)
+        Profile.objects.create(user=self.bob)
+        data = {'receiver': self.bob.pk, 'receiver_name': 'bob', 'amount': '2', 'description': 'Soup'}
+        self.client.post('/transfer/', data)
+        self.assertEqual(Profile.objects.get(user=self.alice).time_credits, 3)
+        self.assertEqual(Profile.objects.get(user=self.bob).time_credits, 2)
+
+        self.client.post('/transfer/', dict(data, amount='4'))
+        self.assertEqual(Profile.objects.get(user=self.alice).time_credits, 3)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_receiver_is_validated_by_id(self):
+        Profile.objects.create(user=self.alice, time_credits=5)
+        form = TransferForm({'receiver': self.bob.pk, 'receiver_name': 'bob', 'amount': '1', 'description': 'Help'})
+        # The field's primary-key lookup, then the model's own foreign-key check
+        with self.assertNumQueries(2):
+            self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['receiver'], self.bob)
+
+    def test_typed_username_works_without_javascript(self):
+        form = TransferForm({'receiver': '', 'receiver_name': 'Bob ', 'amount': '1', 'description': 'Help'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.instance.receiver, self.bob)
+        form = TransferForm({'receiver': '', 'receiver_name': 'nobody', 'amount': '1', 'description': 'Help'})
+        self.assertFalse(form.is_valid())
+        self.assertIn('receiver_name', form.errors)
+
+
+class MatchingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password123')
+        cls.bob = User.objects.create_user('bob', password='password123')
+        Profile.objects.bulk_create([
+            Profile(user=cls.alice, latitude=52.37, longitude=4.89),
+            Profile(user=cls.bob, latitude=52.38, longitude=4.90),
+        ])
+        cls.skills = [Skill.objects.create(name=name) for name in ('Gardening', 'Cooking', 'Repairs')]
+        cls.request = ServiceListing.objects.create(user=cls.alice, title='Help in the garden', description='d',
+                                                    listing_type='REQUEST')
+        cls.request.skills.set(cls.skills[:2])
+
+    def offer(self, skills):
+        offer = ServiceListing.objects.create(user=self.bob, title='Green fingers', description='d', listing_type='OFFER')
+        offer.skills.set(skills)
+        rescore(offer.pk)
+        return offer
+
+    def test_rescore_stores_matches_on_both_sides(self):
+        offer = self.offer(self.skills)
+        self.assertEqual(
+            list(ListingMatch.objects.values_list('listing_id', 'matched_listing_id', 'score').order_by('listing_id')),
+            [(self.request.pk, offer.pk, 2), (offer.pk, self.request.pk, 2)],
+        )
+        self.assertAlmostEqual(ListingMatch.objects.get(listing=offer).distance_km, 1.3, places=1)
+
+    def test_alerts_are_batched_per_owner(self):
+        self.offer(self.skills)
+        self.offer(self.skills[1:])   # shares only Cooking with the request
+        self.offer(self.skills[:2])
+        # Only the counterparts' owner hears about them, and not about the weak match
+        self.assertEqual(ListingMatch.objects.filter(alert_pending=True, listing=self.request).count(), 2)
+        self.assertEqual(send_match_alerts(), 1)
+        self.assertEqual(send_match_alerts(), 0)
+        self.assertEqual(list(Notification.objects.values_list('user_id', 'message')),
+                         [(self.alice.pk, '2 new matches for your listings')])
+
+    def test_deactivated_listing_drops_out(self):
+        offer = self.offer(self.skills)
+        offer.is_active = False
+        offer.save()
+        rescore(offer.pk)
+        self.assertFalse(ListingMatch.objects.exists())
+
+    def test_changes_queue_a_rescore(self):
+        offer = self.offer(self.skills)
+        OutboxEvent.objects.all().delete()
+        offer.skills.remove(self.skills[0])
+        self.assertEqual(list(OutboxEvent.objects.values_list('kind', 'payload')),
+                         [('rescore_listing', {'listing_id': offer.pk})])
+        drain()
+        self.assertEqual(ListingMatch.objects.get(listing=self.request).score, 1)
+
+    def test_page_reads_stored_matches(self):
+        offer = self.offer(self.skills)
+        self.client.force_login(self.alice)
+        with self.assertNumQueries(4):
+            response = self.client.get('/matches/')
+        self.assertEqual([(match['offer'], match['request']) for match in response.context['matching_offers']],
+                         [(offer, self.request)])
+        self.assertContains(response, '1.3 km')
+
+
+class RollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password123', is_staff=True)
+        cls.bob = User.objects.create_user('bob', password='password123')
+        Profile.objects.bulk_create([Profile(user=cls.alice), Profile(user=cls.bob)])
+
+    def setUp(self):
+        self.later = timezone.now() + rollups.SETTLE_DELAY * 2
+
+    def update(self):
+        for source in rollups.SOURCES:
+            while rollups.count_new_rows(source, batch_size=2, now=self.later):
+                pass
+        rollups.recompute(now=self.later)
+
+    def stat(self, metric, key=''):
+        return DailyStat.objects.get(day=timezone.localdate(), metric=metric, key=key).value
+
+    def test_new_rows_are_counted_once(self):
+        for amount in ('1.5', '2', '3'):
+            Transaction.objects.create(sender=self.alice, receiver=self.bob, amount=Decimal(amount), description='d')
+        # Too fresh: a transaction with a lower id may still be committing
+        self.assertEqual(rollups.count_new_rows('transactions'), 0)
+
+        self.update()
+        self.update()
+        self.assertEqual(self.stat('hours_exchanged'), Decimal('6.5'))
+        self.assertEqual(self.stat('transactions'), 3)
+        self.assertEqual(self.stat('active_members'), 2)
+        self.assertEqual(RollupWatermark.objects.get(source='transactions').last_id, Transaction.objects.latest('pk').pk)
+
+    def test_summary_reads_the_rollups(self):
+        listing = ServiceListing.objects.create(user=self.bob, title='Soup', description='d', listing_type='OFFER')
+        listing.skills.set([Skill.objects.create(name='Cooking')])
+        tool = Tool.objects.create(owner=self.alice, name='Ladder', description='d')
+        ToolBorrow.objects.create(tool=tool, borrower=self.bob, status='BORROWED',
+                                  start_date=timezone.now() - timedelta(days=3), end_date=timezone.now() - timedelta(days=1))
+        event = Event.objects.create(organizer=self.alice, title='Repair cafe', description='d', event_type='WORKSHOP',
+                                     location='Library', event_date=timezone.now() - timedelta(hours=1))
+        event.participants.add(self.alice, self.bob)
+        self.update()
+
+        self.client.force_login(self.alice)
+        with self.assertNumQueries(5):
+            data = self.client.get('/api/analytics/?weeks=4').json()
+        this_week = data['weeks'][-1]
+        self.assertEqual(len(data['weeks']), 4)
+        self.assertEqual((this_week['listings_created'], this_week['borrow_requests'], this_week['events_held'],
+                          this_week['event_turnout']), (1, 1, 1, 2))
+        # Still out, though overdue: lent for the last four days
+        self.assertEqual(this_week['tool_days_lent'], min(4, timezone.localdate().weekday() + 1))
+        self.assertEqual(data['top_skills'], [{'skill': 'Cooking', 'listings': 1}])
+        self.assertEqual(data['recent_events'][0]['title'], 'Repair cafe')
+
+        response = self.client.get('/analytics/')
+        self.assertContains(response, 'Repair cafe')
+
+    def test_analytics_are_staff_only(self):
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get('/api/analytics/').status_code, 302)
+        self.assertEqual(self.client.get('/analytics/').status_code, 302)
+
+
+class AdminChangelistTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='password123')
+        cls.alice = User.objects.create_user('Alice', password='password123')
+        cls.bob = User.objects.create_user('bob', password='password123')
+        conversation = Conversation.objects.create(participant1=cls.alice, participant2=cls.bob)
+        Message.objects.bulk_create([
+            Message(conversation=conversation, sender=sender, recipient=recipient, body='Hello')
+            for sender, recipient in [(cls.alice, cls.bob), (cls.bob, cls.alice)] * 20
+        ])
+        cls.tool = Tool.objects.create(owner=cls.alice, name='Ladder', description='d')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def borrow(self, status='PENDING'):
+        return ToolBorrow.objects.create(tool=self.tool, borrower=self.bob, status=status, start_date=timezone.now(),
+                                         end_date=timezone.now() + timedelta(days=2))
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        # User (the session comes from the cache), size estimate, exact count (the table is
+        # small), one page of rows with senders, recipients and conversations joined
+        with self.assertNumQueries(4):
+            response = self.client.get('/admin/myapp/message/')
+        self.assertEqual(response.context['cl'].result_count, 40)
+
+    def test_search_by_username_ignores_case(self):
+        response = self.client.get('/admin/myapp/message/', {'q': 'ALICE '})
+        self.assertEqual(response.context['cl'].result_count, 40)
+        response = self.client.get('/admin/myapp/notification/', {'q': 'alice'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_unfiltered_count_is_estimated_on_large_tables(self):
+        with mock.patch('myapp.admin.ESTIMATE_COUNT_ABOVE', 0):
+            # Without statistics the rows are counted
+            self.assertEqual(EstimatedCountPaginator(Message.objects.all(), 10).count, 40)
+
+            # Archiving deletes messages in bulk; the refreshed statistics follow
+            Message.objects.filter(pk__in=Message.objects.order_by('pk').values('pk')[:10]).delete()
+            analyze_table(Message)
+            Message.objects.bulk_create([
+                Message(conversation=Conversation.objects.get(), sender=self.bob, recipient=self.alice, body='Hi')
+            ])
+            with self.assertNumQueries(2):
+                estimate = EstimatedCountPaginator(Message.objects.all(), 10).count
+            self.assertEqual(estimate, 30)
+            self.assertAlmostEqual(estimate, Message.objects.count(), delta=1)
+
+            self.assertEqual(EstimatedCountPaginator(Message.objects.filter(sender=self.bob), 10).count,
+                             Message.objects.filter(sender=self.bob).count())
+
+    def test_approving_borrows_updates_tools_and_notifies_in_one_batch(self):
+        borrows = [self.borrow(), self.borrow()]
+        # User, changelist counts, then a savepoint around one read, two UPDATEs and one INSERT
+        with self.assertNumQueries(9):
+            self.client.post('/admin/myapp/toolborrow/', {
+                'action': 'approve_requests', '_selected_action': [borrow.pk for borrow in borrows],
+            })
+        self.assertEqual(ToolBorrow.objects.filter(status='APPROVED').count(), 2)
+        self.assertFalse(Tool.objects.get(pk=self.tool.pk).is_available)
+
+        drain()
+        self.assertEqual(Notification.objects.filter(user=self.bob, notification_type='TOOL_APPROVED').count(), 2)
+
+    def test_tool_stays_out_while_another_borrow_is_running(self):
+        returned, running = self.borrow('APPROVED'), self.borrow('BORROWED')
+        Tool.objects.filter(pk=self.tool.pk).update(is_available=False)
+        self.client.post('/admin/myapp/toolborrow/', {'action': 'mark_returned', '_selected_action': [returned.pk]})
+        self.assertFalse(Tool.objects.get(pk=self.tool.pk).is_available)
+
+        self.client.post('/admin/myapp/toolborrow/', {'action': 'mark_returned', '_selected_action': [running.pk]})
+        self.assertTrue(Tool.objects.get(pk=self.tool.pk).is_available)
+        self.assertIsNotNone(ToolBorrow.objects.get(pk=running.pk).actual_return_date)
+        drain()
+        self.assertEqual(Notification.objects.filter(user=self.alice, notification_type='TOOL_RETURNED').count(), 2)
+
+    def test_listing_actions_queue_match_rescores(self):
+        listing = ServiceListing.objects.create(user=self.alice, title='Soup', description='d', listing_type='OFFER')
+        OutboxEvent.objects.all().delete()
+        self.client.post('/admin/myapp/servicelisting/', {'action': 'deactivate_listings', '_selected_action': [listing.pk]})
+        self.assertFalse(ServiceListing.objects.get(pk=listing.pk).is_active)
+        self.assertEqual(list(OutboxEvent.objects.values_list('kind', 'payload')),
+                         [('rescore_listing', {'listing_id': listing.pk})])
+
+
+class CachedAuthTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password='password123')
+        Profile.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client.login(username='alice', password='password123')
+        self.client.get('/api/check-updates/')
+
+    def test_authenticated_requests_skip_session_and_user_queries(self):
+        # Only the view's own four queries: the session and the user come from the cache
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/check-updates/')
+        self.assertEqual(response.wsgi_request.user, self.user)
+
+    def test_password_change_logs_out_other_sessions(self):
+        other = self.client_class()
+        other.login(username='alice', password='password123')
+        user = User.objects.get(pk=self.user.pk)
+        user.set_password('new-password456')
+        user.save()
+        self.assertEqual(self.client.get('/api/check-updates/').status_code, 302)
+
+    def test_own_password_change_keeps_the_session(self):
+        other = self.client_class()
+        other.login(username='alice', password='password123')
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        forget_user(self.user.pk)
+        # Cache the user again, so the password is changed through a cached request.user
+        self.client.get('/api/check-updates/')
+
+        # The admin's PasswordChangeView, which calls update_session_auth_hash() with request.user
+        response = self.client.post('/admin/password_change/', {
+            'old_password': 'password123', 'new_password1': 'new-password456', 'new_password2': 'new-password456',
+        })
+        self.assertRedirects(response, '/admin/password_change/done/')
+        self.assertEqual(self.client.get('/api/check-updates/').status_code, 200)
+        self.assertEqual(other.get('/api/check-updates/').status_code, 302)
+
+    def test_password_hash_is_not_cached(self):
+        copy = cache.get(f'auth:user:v2:{self.user.pk}')
+        self.assertNotIn('password', copy['fields'])
+        self.assertNotIn(self.user.password, repr(copy))
+        user = self.client.get('/api/check-updates/').wsgi_request.user
+        self.assertTrue(user.check_password('password123'))
+
+    def test_deactivated_user_is_logged_out(self):
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        forget_user(self.user.pk)
+        self.assertEqual(self.client.get('/api/check-updates/').status_code, 302)
+
+    def test_logout_forgets_the_cached_user(self):
+        self.client.post('/logout/')
+        self.assertIsNone(cache.get(f'auth:user:v2:{self.user.pk}'))
+
+
+class TemplateMetricsTests(TestCase):
+    def test_render_time_is_kept_per_page_template(self):
+        user = User.objects.create_user('member', password='password123', is_staff=True)
+        Profile.objects.create(user=user)
+        self.client.force_login(user)
+        registry.reset()
+        self.client.get('/tools/')
+        self.client.get('/tools/')
+
+        templates = self.client.get('/api/metrics/').json()['templates']
+        self.assertEqual(templates['tools/browse.html']['renders'], 2)
+        # The parent and the includes are part of the page's render
+        self.assertNotIn('base.html', templates)
+
+    def test_warm_templates_compiles_every_template(self):
+        compiled, errors = warm_templates()
+        self.assertEqual(errors, {})
+        self.assertIn('messages/inbox.html', compiled)
+        self.assertIn('listings/browse.html', compiled)
+
+        out = StringIO()
+        call_command('warm_templates', stdout=out)
+        self.assertIn(f'Compiled {len(compiled)} templates', out.getvalue())
+
+
+class ApiTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='password123')
+        cls.bob = User.objects.create_user('bob', password='password123')
+        Profile.objects.bulk_create([Profile(user=cls.alice, time_credits=5), Profile(user=cls.bob, location='Town')])
+        cooking = Skill.objects.create(name='Cooking')
+        for number in range(5):
+            listing = ServiceListing.objects.create(user=cls.bob, title=f'Listing {number}', description='d', listing_type='OFFER')
+            listing.skills.add(cooking)
+        cls.conversation = Conversation.objects.create(participant1=cls.alice, participant2=cls.bob)
+        for number in range(3):
+            Message.objects.create(conversation=cls.conversation, sender=cls.bob, recipient=cls.alice, body=f'Hi {number}')
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def send(self, method, url, data):
+        return getattr(self.client, method)(url, json.dumps(data), content_type='application/json')
+
+    def test_sparse_fields_and_includes_in_constant_queries(self):
+        url = '/api/v1/listings/?fields=title&include=user,skills'
+        response = self.assertWithinQueryBudget(url)
+        first = response.json()['data'][0]
+        self.assertEqual(first, {'title': 'Listing 4', 'skills': ['Cooking'],
+                                 'user': {'id': self.bob.pk, 'username': 'bob', 'name': '', 'location': 'Town'}})
+        # The same three queries for a page of one as for all five
+        with self.assertNumQueries(3):
+            self.client.get(url + '&limit=1')
+        self.assertEqual(self.client.get('/api/v1/listings/?include=owner').status_code, 400)
+
+    def test_keyset_pages(self):
+        titles, url = [], '/api/v1/listings/?limit=2&fields=title'
+        while url:
+            page = self.client.get(url).json()
+            titles += [row['title'] for row in page['data']]
+            url = page['next']
+        self.assertEqual(titles, [f'Listing {number}' for number in range(4, -1, -1)])
+
+        newest = ServiceListing.objects.latest('pk').pk
+        self.assertEqual(self.client.get(f'/api/v1/listings/?after_id={newest - 2}&fields=id').json()['data'],
+                         [{'id': newest - 1}, {'id': newest}])
+
+    def test_conditional_get(self):
+        response = self.client.get('/api/v1/listings/')
+        self.assertEqual(self.client.get('/api/v1/listings/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        ServiceListing.objects.filter(title='Listing 4').update(title='Changed')
+        self.assertEqual(self.client.get('/api/v1/listings/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_private_resources_need_a_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/v1/listings/').status_code, 200)
+        self.assertEqual(self.client.get('/api/v1/conversations/').status_code, 401)
+        self.assertEqual(self.send('post', '/api/v1/listings/', {'title': 'x'}).status_code, 401)
+
+    def test_listing_writes_go_through_the_form(self):
+        response = self.send('post', '/api/v1/listings/?include=skills', {
+            'title': 'Soup', 'description': 'Hot soup', 'type': 'OFFER', 'skills': ['cooking', 'Baking'],
+        })
+        self.assertEqual(response.status_code, 201)
+        created = response.json()['data']
+        self.assertEqual((created['user_id'], created['skills']), (self.alice.pk, ['Baking', 'Cooking']))
+
+        url = f"/api/v1/listings/{created['id']}/?include=skills"
+        changed = self.send('patch', url, {'title': 'Stew'}).json()['data']
+        self.assertEqual((changed['title'], changed['skills']), ('Stew', ['Baking', 'Cooking']))
+        self.assertEqual(self.send('patch', url, {'type': 'NEITHER'}).json()['errors'], {
+            'listing_type': ['Select a valid choice. NEITHER is not one of the available choices.'],
+        })
+
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertFalse(ServiceListing.objects.get(pk=created['id']).is_active)
+        bobs = ServiceListing.objects.filter(user=self.bob).first()
+        self.assertEqual(self.send('patch', f'/api/v1/listings/{bobs.pk}/', {'title': 'Mine'}).status_code, 404)
+
+    def test_messages_of_own_conversations_only(self):
+        url = f'/api/v1/conversations/{self.conversation.pk}/messages/'
+        response = self.send('post', url, {'body': 'Hello Bob'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['data']['recipient_id'], self.bob.pk)
+        bodies = [row['body'] for row in self.client.get(url + '?fields=body').json()['data']]
+        self.assertEqual(bodies, ['Hello Bob', 'Hi 2', 'Hi 1', 'Hi 0'])
+
+        carol = User.objects.create_user('carol', password='password123')
+        self.client.force_login(carol)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_transfer_moves_credits(self):
+        response = self.send('post', '/api/v1/transactions/', {'receiver': self.bob.pk, 'amount': '2', 'description': 'Soup'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Profile.objects.get(user=self.alice).time_credits, 3)
+        self.assertEqual(Profile.objects.get(user=self.bob).time_credits, 2)
+
+        response = self.send('post', '/api/v1/transactions/', {'receiver': self.bob.pk, 'amount': '4', 'description': 'More'})
+        self.assertEqual(response.json(), {'error': 'Insufficient time credits.'})
+        self.assertEqual(Transaction.objects.count(), 1)
+
+
+
+@override_settings(DATABASE_REPLICA_ALIAS=None)
+class BatchTests(TransactionTestCase):
+    """
+    TransactionTestCase, so the rows are committed where the batch's worker threads can read them.
+    Replica routing is off; ReplicaRoutingTests covers batches on the replica.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='password123')
+        self.bob = User.objects.create_user('bob', password='password123')
+        Profile.objects.bulk_create([Profile(user=self.alice, time_credits=5), Profile(user=self.bob)])
+        self.conversation = Conversation.objects.create(participant1=self.alice, participant2=self.bob)
+        Message.objects.create(conversation=self.conversation, sender=self.bob, recipient=self.alice, body='Hi')
+        self.client.force_login(self.alice)
+
+    def batch(self, *requests):
+        response = self.client.post('/api/v1/batch/', json.dumps({'requests': list(requests)}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['responses']
+
+    def test_reads_answered_in_order(self):
+        updates, listings, page, missing, transactions = self.batch(
+            {'path': '/api/check-updates/'},
+            {'path': '/api/v1/listings/'},
+            {'path': '/dashboard/'},
+            {'path': '/api/v1/listings/12345/'},
+            {'path': '/api/v1/transactions/'},
+        )
+        self.assertEqual((updates['status'], updates['body']['unread_messages']), (200, 1))
+        self.assertEqual(listings['body']['data'], [])
+        self.assertIn('ETag', listings['headers'])
+        self.assertEqual(page, {'status': 400, 'headers': {}, 'body': {'error': 'Only /api/ endpoints can be batched.'}})
+        self.assertEqual(missing['status'], 404)
+        self.assertEqual(transactions['status'], 200)
+
+    def test_reads_after_a_write_see_it(self):
+        url = f'/api/v1/conversations/{self.conversation.pk}/messages/'
+        sent, refused, messages = self.batch(
+            {'method': 'POST', 'path': url, 'body': {'body': 'Hello Bob'}},
+            {'method': 'POST', 'path': '/api/v1/transactions/', 'body': {'receiver': self.bob.pk, 'amount': '9'}},
+            {'path': url + '?fields=body'},
+        )
+        self.assertEqual(sent['status'], 201)
+        self.assertEqual(refused['status'], 400)
+        self.assertEqual([row['body'] for row in messages['body']['data']], ['Hello Bob', 'Hi'])
+
+    def test_failure_stays_in_its_sub_request(self):
+        with mock.patch('myapp.views._map_markers', side_effect=RuntimeError('boom')), \
+                self.assertLogs('myapp.batch', 'ERROR'):
+            markers, updates = self.batch({'path': '/api/map-data/'}, {'path': '/api/check-updates/'})
+        self.assertEqual(markers, {'status': 500, 'headers': {}, 'body': {'error': 'Internal error.'}})
+        self.assertEqual(updates['status'], 200)
+
+    @override_settings(API_BATCH_MAX_REQUESTS=2)
+    def test_limits(self):
+        response = self.client.post('/api/v1/batch/', json.dumps({'requests': [{'path': '/api/map-data/'}] * 3}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/batch/').status_code, 405)
+        nested, = self.batch({'method': 'POST', 'path': '/api/v1/batch/', 'body': {'requests': []}})
+        self.assertEqual(nested['status'], 400)
+
+
+@override_settings(RATE_LIMITS={'updates': '2/m', 'map': '3/m', 'transfers': '1/m'})
+class RateLimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        rate_limit_stats.reset()
+        self.alice = User.objects.create_user('alice', password='password123')
+        Profile.objects.create(user=self.alice, time_credits=5)
+        self.client.force_login(self.alice)
+
+    def test_sliding_window(self):
+        start = 6000  # the start of a window of a minute
+        self.assertEqual([ratelimit.hit('test', 'a', '3/m', now=start + second)[0] for second in range(4)],
+                         [True, True, True, False])
+        # Half a minute into the next window, half of the previous window's 4 hits still count
+        self.assertEqual(ratelimit.hit('test', 'a', '3/m', now=start + 90), (True, 0))
+        allowed, retry_after = ratelimit.hit('test', 'a', '3/m', now=start + 91)
+        self.assertFalse(allowed)
+        self.assertIn(retry_after, (29, 30))
+        self.assertEqual(ratelimit.hit('test', 'b', '3/m', now=start + 91), (True, 0))
+
+    def test_over_the_limit_gets_429(self):
+        self.assertEqual([self.client.get('/api/check-updates/').status_code for _ in range(3)], [200, 200, 429])
+        response = self.client.get('/api/check-updates/')
+        self.assertEqual(response.json(), {'error': 'Too many requests. Please wait a moment and try again.'})
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+
+        # Logged out visitors are counted by address
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/map-data/').status_code, 200)
+        self.assertEqual(self.client.get('/api/map-data/', REMOTE_ADDR='10.0.0.2').status_code, 200)
+
+        self.client.force_login(User.objects.create_superuser('staff', password='password123'))
+        rate_limits = {row['scope']: row for row in self.client.get('/api/metrics/').json()['rate_limits']}
+        self.assertEqual(rate_limits['updates'], {'scope': 'updates', 'rate': '2/m', 'allowed': 2, 'limited': 2})
+        self.assertEqual((rate_limits['map']['allowed'], rate_limits['map']['limited']), (2, 0))
+
+    def test_only_limited_methods_count(self):
+        for _ in range(3):
+            self.assertEqual(self.client.get('/transfer/').status_code, 200)
+        response = self.client.post('/api/v1/transactions/', '{}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/transfer/', {}, HTTP_ACCEPT='text/html')
+        self.assertEqual((response.status_code, response['Content-Type']), (429, 'text/plain; charset=utf-8'))
+
+    @override_settings(RATE_LIMITS={'messages': '1/m'})
+    def test_send_over_the_limit_keeps_the_page(self):
+        bob = User.objects.create_user('bob', password='password123')
+        conversation = Conversation.objects.create(participant1=self.alice, participant2=bob)
+        url = f'/messages/conversation/{conversation.pk}/'
+        self.assertEqual(self.client.post(f'{url}send/', {'body': 'One'}).status_code, 200)
+        # The page's script reads the JSON answer and Retry-After instead of posting the form again
+        response = self.client.post(f'{url}send/', {'body': 'Two'}, HTTP_ACCEPT='*/*')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('error', response.json())
+        self.assertIn('Retry-After', response)
+        self.assertContains(self.client.get(url), 'id="sendNotice"')
+
+    def test_benchmark_harness_is_not_limited(self):
+        output = tempfile.NamedTemporaryFile(suffix='.json')
+        self.addCleanup(output.close)
+        call_command('benchmark_views', user='alice', only=['map_data', 'check_updates'], requests=5, warmup=0,
+                     host='testserver', json_path=output.name, stdout=StringIO())
+        with open(output.name) as results:
+            endpoints = json.load(results)['endpoints']
+        self.assertEqual({name: result['status'] for name, result in endpoints.items()},
+                         {'map_data': [200], 'check_updates': [200]})
+
+    def test_memory_fallback_when_the_cache_fails(self):
+        with mock.patch('myapp.ratelimit.cache.add', side_effect=ConnectionError), \
+                self.assertLogs('myapp.ratelimit', 'WARNING'):
+            codes = [self.client.get('/api/check-updates/').status_code for _ in range(3)]
+        self.assertEqual(codes, [200, 200, 429])
+
+class DatabaseConfigTests(SimpleTestCase):
+    def test_sqlite_connections_are_tuned(self):
+        config = database_config(Path('/srv/hub'), env={'DB_BUSY_TIMEOUT_MS': '2000'})
+        self.assertEqual(config['ENGINE'], 'django.db.backends.sqlite3')
+        self.assertEqual(config['NAME'], Path('/srv/hub/db.sqlite3'))
+        self.assertEqual(config['OPTIONS']['timeout'], 2)
+        self.assertEqual(config['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        self.assertEqual(config['OPTIONS']['init_command'].split(';'), [
+            'PRAGMA journal_mode=WAL', 'PRAGMA busy_timeout=2000', 'PRAGMA synchronous=NORMAL',
+            f'PRAGMA mmap_size={256 * 1024 * 1024}', 'PRAGMA temp_store=MEMORY',
+        ])
+
+    def test_sqlite_tuning_can_be_turned_off(self):
+        config = database_config(Path('/srv/hub'), env={'DB_NAME': 'plain.sqlite3', 'DB_SQLITE_TUNING': '0'})
+        self.assertEqual(config['NAME'], 'plain.sqlite3')
+        self.assertEqual(config['OPTIONS'], {'timeout': 5})
+
+    def test_postgresql_keeps_connections_or_pools_them(self):
+        config = database_config(Path('/srv/hub'), env={'DB_ENGINE': 'postgres', 'DB_HOST': 'db', 'DB_TEST_NAME': 'hub_test'})
+        self.assertEqual((config['NAME'], config['HOST'], config['CONN_MAX_AGE']), ('resourcehub', 'db', 60))
+        self.assertTrue(config['CONN_HEALTH_CHECKS'])
+        self.assertEqual(config['TEST'], {'NAME': 'hub_test'})
+
+        config = database_config(Path('/srv/hub'), env={'DB_ENGINE': 'postgresql', 'DB_POOL_MAX_SIZE': '20'})
+        self.assertEqual(config['CONN_MAX_AGE'], 0)
+        self.assertEqual(config['OPTIONS']['pool'], {'min_size': 2, 'max_size': 20, 'timeout': 10})
+
+    def test_replica_settings_use_their_own_prefix(self):
+        env = {'DB_ENGINE': 'postgresql', 'DB_NAME': 'primary', 'DB_REPLICA_NAME': 'replica', 'DB_POOL_MAX_SIZE': '20'}
+        config = database_config(Path('/srv/hub'), env=env, prefix='DB_REPLICA_')
+        self.assertEqual((config['ENGINE'], config['NAME']), ('django.db.backends.postgresql', 'replica'))
+        self.assertNotIn('pool', config['OPTIONS'])
+
+    def test_unknown_engine_is_refused(self):
+        with self.assertRaisesMessage(ValueError, "Unsupported DB_ENGINE 'mysql'"):
+            database_config(Path('/srv/hub'), env={'DB_ENGINE': 'mysql'})
+
+
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.tool = Tool.objects.create(owner=User.objects.create_user('alice'), name='Drill', description='Cordless')
+        buffer = BytesIO()
+        Image.new('RGB', (800, 600), 'red').save(buffer, 'PNG')
+        self.tool.image.save('drill.png', ContentFile(buffer.getvalue()))
+
+    def test_variants_are_served_immutable_under_a_versioned_name(self):
+        names = generate_variants(self.tool.image)
+        card = variant_name(self.tool.image.name, 'card', 'webp')
+        self.assertIn(card, names)
+        self.assertTrue(card.endswith(f'.card.{images.VARIANTS_VERSION}.webp'))
+        response = self.client.get(self.tool.image.storage.url(card))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+
+    def test_new_variant_settings_get_new_names(self):
+        before = variant_name(self.tool.image.name, 'card', 'webp')
+        with mock.patch.object(images, 'VARIANTS_VERSION', 'feedf00d'):
+            self.assertNotEqual(variant_name(self.tool.image.name, 'card', 'webp'), before)
+
+    def test_generate_variants_writes_every_size_and_records_them(self):
+        self.assertFalse(has_variants(self.tool.image))
+        names = generate_variants(self.tool.image)
+        self.assertEqual(len(names), len(images.VARIANTS) * len(images.FORMATS))
+        storage = self.tool.image.storage
+        with storage.open(variant_name(self.tool.image.name, 'avatar', 'jpeg')) as avatar:
+            self.assertEqual(Image.open(avatar).size, (96, 96))
+        with storage.open(variant_name(self.tool.image.name, 'card', 'webp')) as card:
+            self.assertEqual(Image.open(card).size, (640, 480))
+
+        tool = Tool.objects.get(pk=self.tool.pk)
+        self.assertTrue(has_variants(tool.image))
+
+    def test_regenerating_replaces_variants_under_the_same_names(self):
+        names = generate_variants(self.tool.image)
+        with mock.patch('myapp.storage.ContentAddressedStorage.delete') as delete:
+            self.assertEqual(generate_variants(self.tool.image), names)
+        delete.assert_not_called()
+
+    def render_picture(self, tool):
+        template = Template("{% load image_variants %}{% picture tool.image 'card' alt='Drill' %}")
+        with mock.patch('myapp.storage.ContentAddressedStorage.exists') as exists:
+            html = template.render(Context({'tool': tool}))
+        exists.assert_not_called()
+        return html
+
+    def test_picture_falls_back_to_the_original_until_the_variants_exist(self):
+        original = self.tool.image.url
+        self.assertEqual(self.render_picture(self.tool),
+                         f'<picture><source srcset="{original}" type="image/webp"><img src="{original}" alt="Drill"></picture>')
+
+        generate_variants(self.tool.image)
+        html = self.render_picture(Tool.objects.get(pk=self.tool.pk))
+        storage = self.tool.image.storage
+        self.assertIn(f'srcset="{storage.url(variant_name(self.tool.image.name, "card", "webp"))}"', html)
+        self.assertIn(f'src="{storage.url(variant_name(self.tool.image.name, "card", "jpeg"))}"', html)
+
+    def test_replaced_image_shows_the_original_until_its_variants_exist(self):
+        generate_variants(self.tool.image)
+        buffer = BytesIO()
+        Image.new('RGB', (800, 600), 'blue').save(buffer, 'PNG')
+        self.tool.image.save('drill.png', ContentFile(buffer.getvalue()))
+        tool = Tool.objects.get(pk=self.tool.pk)
+        self.assertIn(f'src="{tool.image.url}"', self.render_picture(tool))
+
+
+class StaticAssetTests(TestCase):
+    def setUp(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        settings_override = override_settings(STATIC_ROOT=static_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+        self.url = staticfiles_storage.url('js/updates.js')
+
+    def test_collectstatic_writes_hashed_gzip_variants(self):
+        self.assertRegex(self.url, r'^/static/js/updates\.[0-9a-f]{12}\.js$')
+        name = self.url.removeprefix(settings.STATIC_URL)
+        with staticfiles_storage.open(name) as original, staticfiles_storage.open(name + '.gz') as variant:
+            self.assertEqual(gzip.decompress(variant.read()), original.read())
+
+    def test_serves_the_variant_the_client_accepts(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/javascript')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+        for accept_encoding in ('', 'gzip;q=0, identity'):
+            response = self.client.get(self.url, HTTP_ACCEPT_ENCODING=accept_encoding)
+            self.assertNotIn('Content-Encoding', response)
+            self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_revalidation_per_encoding(self):
+        etag = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_unhashed_names_are_revalidated(self):
+        response = self.client.get('/static/js/updates.js')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=86400')
+
+    def test_pages_link_the_hashed_bundle(self):
+        user = User.objects.create_user('alice', password='password123')
+        Profile.objects.create(user=user)
+        self.client.login(username='alice', password='password123')
+        response = self.client.get('/notifications/')
+        self.assertContains(response, f'src="{self.url}"')
+        self.assertContains(response, staticfiles_storage.url('css/site.css'))
+
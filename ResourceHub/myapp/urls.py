@@ -1,5 +1,5 @@
 from django.urls import path
-from myapp import views
+from myapp import api, batch, views
 
 urlpatterns = [
     # Home & Dashboard
@@ -52,10 +52,33 @@ urlpatterns = [
     path('map/', views.map_view, name='map_view'),
     path('api/map-data/', views.map_data, name='map_data'),
     path('api/check-updates/', views.check_updates, name='check_updates'),
+    path('api/users/search/', views.user_search, name='user_search'),
+    path('api/metrics/', views.metrics_summary, name='metrics_summary'),
+    
+    # Analytics (staff)
+    path('analytics/', views.analytics, name='analytics'),
+    path('api/analytics/', views.analytics_data, name='analytics_data'),
+    
+    # JSON API v1 (see myapp/api.py)
+    path('api/v1/listings/', api.listings, name='api_listings'),
+    path('api/v1/listings/<int:pk>/', api.listing, name='api_listing'),
+    path('api/v1/tools/', api.tools, name='api_tools'),
+    path('api/v1/tools/<int:pk>/', api.tool, name='api_tool'),
+    path('api/v1/events/', api.events, name='api_events'),
+    path('api/v1/events/<int:pk>/', api.event, name='api_event'),
+    path('api/v1/conversations/', api.conversations, name='api_conversations'),
+    path('api/v1/conversations/<int:pk>/', api.conversation, name='api_conversation'),
+    path('api/v1/conversations/<int:conversation_pk>/messages/', api.conversation_messages, name='api_messages'),
+    path('api/v1/transactions/', api.transactions, name='api_transactions'),
+    path('api/v1/transactions/<int:pk>/', api.transaction_detail, name='api_transaction'),
+    path('api/v1/batch/', batch.batch, name='api_batch'),
     
     # Messages & Notifications
     path('messages/', views.inbox, name='inbox'),
+    path('messages/search/', views.message_search, name='message_search'),
     path('messages/conversation/<int:pk>/', views.conversation_detail, name='conversation_detail'),
+    path('messages/conversation/<int:pk>/history/', views.conversation_history, name='conversation_history'),
+    path('messages/conversation/<int:pk>/send/', views.conversation_send, name='conversation_send'),
     path('messages/start/<str:username>/', views.start_conversation, name='start_conversation'),
     path('messages/start/listing/<int:listing_id>/', views.start_conversation, name='start_conversation_listing'),
     path('messages/<int:pk>/respond/<str:action>/', views.respond_to_message, name='respond_to_message'),
@@ -1,25 +1,48 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.core.paginator import Paginator
+from django.template.loader import render_to_string
+from django.views.decorators.http import require_POST
 from django.contrib import messages
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.db.models import Q, Count, Avg
+from django.db import transaction
+from django.db.models import Q, F, Count, Avg, Exists, OuterRef, Subquery
+from django.db.models.functions import Lower
+from django.conf import settings
 from django.utils import timezone
+from django.contrib.admin.views.decorators import staff_member_required
 from django.http import JsonResponse
+import hashlib
+from datetime import timedelta
 from decimal import Decimal
-from math import radians, cos, sin, asin, sqrt
+from functools import partial
+from operator import attrgetter
+from itertools import islice
 from .form import (TransferForm, ServiceListingForm, ToolForm, EventForm, 
                    ReviewForm, UserRegistrationForm, ProfileForm, ToolBorrowForm, MessageForm, CreditRequestForm)
-from .models import (ServiceListing, Tool, Transaction, Event, Review, 
+from .archive import archived_messages
+from .cache import bump_model, cached
+from .images import schedule_variants
+from .metrics import query_budget, registry
+from .ratelimit import rate_limit, stats as rate_limit_stats
+from . import rollups
+from .outbox import notify, post_message
+from .search import query_terms, ranked_message_ids, snippet
+from .models import (ServiceListing, ListingMatch, Tool, Transaction, Event, EventOccurrence, Review, 
                      Profile, Skill, ToolBorrow, Conversation, Message, Notification)
 
 # ============== HOME & DASHBOARD ==============
+@query_budget(8)
 def index(request):
     """Homepage showing latest listings, tools, and events"""
-    offers = ServiceListing.objects.filter(listing_type='OFFER', is_active=True)[:6]
-    requests = ServiceListing.objects.filter(listing_type='REQUEST', is_active=True)[:6]
-    tools = Tool.objects.filter(is_available=True)[:6]
-    upcoming_events = Event.objects.filter(event_date__gte=timezone.now(), is_active=True)[:3]
+    offers = ServiceListing.objects.filter(listing_type='OFFER', is_active=True).select_related('user__profile')[:6]
+    requests = ServiceListing.objects.filter(listing_type='REQUEST', is_active=True).select_related('user__profile')[:6]
+    tools = Tool.objects.filter(is_available=True).select_related('owner')[:6]
+    upcoming_events = EventOccurrence.objects.filter(
+        start__gte=timezone.now(),
+        event__is_active=True
+    ).select_related('event')[:3]
     
     context = {
         'offers': offers,
@@ -45,7 +68,13 @@ def dashboard(request):
     my_listings = ServiceListing.objects.filter(user=user, is_active=True)
     my_tools = Tool.objects.filter(owner=user)
     my_events = Event.objects.filter(organizer=user)
-    joined_events = user.joined_events.filter(event_date__gte=timezone.now())
+    # Joined events that still have a date ahead (the next one, for recurring events)
+    next_start = EventOccurrence.objects.filter(
+        event=OuterRef('pk'), start__gte=timezone.now()
+    ).order_by('start').values('start')[:1]
+    joined_events = user.joined_events.annotate(next_start=Subquery(next_start)).filter(
+        next_start__isnull=False
+    ).order_by('next_start')
     
     # Get user's rating
     avg_rating = Review.objects.filter(reviewed_user=user).aggregate(Avg('rating'))['rating__avg']
@@ -74,6 +103,7 @@ def register(request):
                 profile = profile_form.save(commit=False)
                 profile.user = user
                 profile.save()
+                schedule_variants(profile.profile_picture)
                 
                 messages.success(request, f'Welcome {user.username}! Your account has been created.')
                 login(request, user)
@@ -126,7 +156,9 @@ def edit_profile(request):
         profile_form = ProfileForm(request.POST, request.FILES, instance=profile)
         
         if profile_form.is_valid():
-            profile_form.save()
+            profile = profile_form.save()
+            if 'profile_picture' in profile_form.changed_data:
+                schedule_variants(profile.profile_picture)
             messages.success(request, 'Profile updated successfully!')
             return redirect('view_profile', username=request.user.username)
     else:
@@ -153,7 +185,28 @@ def view_profile(request, username):
     return render(request, 'profile/view_profile.html', context)
 
 # ============== TRANSACTIONS ==============
+def _record_transfer(transfer, link='/dashboard/'):
+    """
+    Save an unsaved transfer and move its credits, in one transaction. The sender's balance is
+    checked by the UPDATE that takes the credits, so two transfers at once cannot overdraw it.
+    Returns False, saving nothing, when the balance doesn't cover the amount.
+    Every movement of credits between users goes through here.
+    """
+    with transaction.atomic():
+        if not Profile.objects.filter(user_id=transfer.sender_id, time_credits__gte=transfer.amount).update(
+            time_credits=F('time_credits') - transfer.amount
+        ):
+            return False
+        Profile.objects.filter(user_id=transfer.receiver_id).update(time_credits=F('time_credits') + transfer.amount)
+        transfer.save()
+        notify(transfer.receiver, 'CREDIT_RECEIVED',
+               f"{transfer.sender.username} sent you {transfer.amount} credits!", link)
+        # The callers may hold an outer transaction; bump once the new balances are visible
+        transaction.on_commit(lambda: bump_model(Profile))
+    return True
+
 @login_required
+@rate_limit('transfers', methods=('POST',))
 def transfer_credits(request):
     """Transfer time credits to another user"""
     if request.method == 'POST':
@@ -161,18 +214,15 @@ def transfer_credits(request):
         if form.is_valid():
             transaction_obj = form.save(commit=False)
             transaction_obj.sender = request.user
-            
-            # Validation: Check if sender has enough credits
-            if request.user.profile.time_credits < transaction_obj.amount:
-                messages.error(request, "Insufficient time credits!")
-                return redirect('transfer_credits')
 
             # Prevent sending to self
             if transaction_obj.receiver == request.user:
                 messages.error(request, "You cannot send credits to yourself.")
                 return redirect('transfer_credits')
 
-            transaction_obj.save()
+            if not _record_transfer(transaction_obj):
+                messages.error(request, "Insufficient time credits!")
+                return redirect('transfer_credits')
             messages.success(request, f"Sent {transaction_obj.amount} hrs to {transaction_obj.receiver.username}")
             return redirect('dashboard')
     else:
@@ -180,13 +230,62 @@ def transfer_credits(request):
 
     return render(request, 'transfer.html', {'form': form})
 
+USER_SEARCH_LIMIT = 10
+USER_SEARCH_TIMEOUT = 30  # seconds
+
+def _prefix(key, prefix):
+    """Range condition for "key starts with prefix", which an index on key can answer"""
+    return Q(**{f'{key}__gte': prefix, f'{key}__lt': prefix + '\uffff'})
+
+def _user_search(prefix):
+    """Active members whose username, first name, last name or "first last" starts with prefix (lower case)"""
+    # Each key has an index on lower(...) (migration 0015)
+    users = User.objects.filter(is_active=True).annotate(
+        username_key=Lower('username'), first_name_key=Lower('first_name'), last_name_key=Lower('last_name'),
+    )
+    first, _, rest = prefix.partition(' ')
+    searches = [('username_key', _prefix('username_key', prefix)), ('last_name_key', _prefix('last_name_key', prefix))]
+    if rest:
+        searches.append(('last_name_key', Q(first_name_key=first) & _prefix('last_name_key', rest)))
+    else:
+        searches.append(('first_name_key', _prefix('first_name_key', prefix)))
+    
+    # One short ordered range scan per index: OR-ing the conditions makes the database
+    # read every row in username order instead
+    found = {}
+    for key, condition in searches:
+        rows = users.filter(condition).order_by(key).values('id', 'username', 'first_name', 'last_name')
+        # One spare row, so the requesting user can be left out and still leave a full list
+        for row in rows[:USER_SEARCH_LIMIT + 1]:
+            found.setdefault(row['id'], row)
+    return sorted(found.values(), key=lambda row: row['username'].lower())[:USER_SEARCH_LIMIT + 1]
+
+@login_required
+@query_budget(5)
+def user_search(request):
+    """Typeahead for choosing a member: JSON list of matches for ?q="""
+    prefix = ' '.join(request.GET.get('q', '').split()).lower()[:50]
+    if len(prefix) < 2:
+        return JsonResponse({'results': []})
+    
+    # Shared by everyone typing the same prefix; any user change (but a login) starts afresh
+    key = hashlib.sha1(prefix.encode()).hexdigest()
+    matches = cached('users', ['search', key], partial(_user_search, prefix), timeout=USER_SEARCH_TIMEOUT)
+    results = [
+        {'id': match['id'], 'username': match['username'],
+         'name': f"{match['first_name']} {match['last_name']}".strip()}
+        for match in matches if match['id'] != request.user.id
+    ]
+    return JsonResponse({'results': results[:USER_SEARCH_LIMIT]})
+
 # ============== SERVICE LISTINGS ==============
+@query_budget(8)
 def listing_browse(request):
     """Browse all service listings with filtering"""
     listing_type = request.GET.get('type', 'all')
     search_query = request.GET.get('q', '')
     
-    listings = ServiceListing.objects.filter(is_active=True)
+    listings = ServiceListing.objects.filter(is_active=True).select_related('user__profile').prefetch_related('skills')
     
     if listing_type == 'OFFER':
         listings = listings.filter(listing_type='OFFER')
@@ -260,11 +359,12 @@ def listing_delete(request, pk):
     return render(request, 'listings/delete.html', {'listing': listing})
 
 # ============== TOOLS ==============
+@query_budget(6)
 def tool_browse(request):
     """Browse available tools"""
     search_query = request.GET.get('q', '')
     
-    tools = Tool.objects.filter(is_available=True)
+    tools = Tool.objects.filter(is_available=True).select_related('owner')
     
     if search_query:
         tools = tools.filter(
@@ -287,6 +387,7 @@ def tool_create(request):
             tool = form.save(commit=False)
             tool.owner = request.user
             tool.save()
+            schedule_variants(tool.image)
             messages.success(request, 'Tool added successfully!')
             return redirect('tool_detail', pk=tool.pk)
     else:
@@ -370,6 +471,8 @@ def tool_edit(request, pk):
         form = ToolForm(request.POST, request.FILES, instance=tool)
         if form.is_valid():
             form.save()
+            if 'image' in form.changed_data:
+                schedule_variants(tool.image)
             messages.success(request, f'{tool.name} updated successfully!')
             return redirect('tool_detail', pk=tool.pk)
     else:
@@ -402,14 +505,20 @@ def tool_delete(request, pk):
     return render(request, 'tools/delete.html', {'tool': tool})
 
 # ============== EVENTS ==============
+@query_budget(6)
 def event_browse(request):
     """Browse community events"""
-    events = Event.objects.filter(
-        event_date__gte=timezone.now(),
-        is_active=True
-    ).order_by('event_date')
-    
-    context = {'events': events}
+    # Read the materialized occurrence window instead of expanding every series
+    now = timezone.now()
+    occurrences = EventOccurrence.objects.filter(
+        start__gte=now,
+        start__lt=now + timedelta(weeks=settings.EVENT_OCCURRENCE_WEEKS),
+        event__is_active=True
+    ).select_related('event__organizer').annotate(
+        participant_count=Count('event__participants')
+    ).order_by('start')
+    
+    context = {'occurrences': occurrences}
     return render(request, 'events/browse.html', context)
 
 @login_required
@@ -421,6 +530,7 @@ def event_create(request):
             event = form.save(commit=False)
             event.organizer = request.user
             event.save()
+            event.materialize_occurrences()
             messages.success(request, 'Event created successfully!')
             return redirect('event_detail', pk=event.pk)
     else:
@@ -433,9 +543,16 @@ def event_detail(request, pk):
     event = get_object_or_404(Event, pk=pk)
     is_participant = request.user.is_authenticated and request.user in event.participants.all()
     
+    upcoming_dates = []
+    if event.is_recurring:
+        now = timezone.now()
+        horizon = now + timedelta(weeks=settings.EVENT_OCCURRENCE_WEEKS)
+        upcoming_dates = list(islice(event.iter_occurrences(now, horizon), 5))
+    
     context = {
         'event': event,
         'is_participant': is_participant,
+        'upcoming_dates': upcoming_dates,
     }
     return render(request, 'events/detail.html', context)
 
@@ -493,124 +610,65 @@ def create_review(request, username):
     })
 
 # ============== MATCHING ALGORITHM ==============
-@login_required
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """
-    Calculate the great circle distance in kilometers between two points 
-    on the earth (specified in decimal degrees)
-    """
-    if not all([lat1, lon1, lat2, lon2]):
-        return float('inf')  # Return infinity if coordinates are missing
-    
-    # Convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [float(lon1), float(lat1), float(lon2), float(lat2)])
-    
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
-    km = 6371 * c  # Radius of earth in kilometers
-    return km
+def _match_entries(matches, own_key, other_key):
+    """The template's match dicts for ListingMatch rows: own_key is the user's listing, other_key the match"""
+    return [{
+        own_key: match.listing,
+        other_key: match.matched_listing,
+        'match_score': match.score,
+        'distance': match.distance_km,
+        'distance_display': f"{match.distance_km:.1f} km" if match.distance_km is not None else "Location not set",
+    } for match in matches]
 
+@login_required
+@query_budget(5)
 def find_matches(request):
-    """Find matching offers/requests for the user, prioritizing nearby matches"""
+    """Matching offers/requests for the user's listings, nearest first (precomputed by myapp/matching.py)"""
     user = request.user
     user_profile = user.profile
-    
-    # Get user's coordinates
-    user_lat = user_profile.latitude
-    user_lon = user_profile.longitude
-    
-    # Get user's requests
-    user_requests = ServiceListing.objects.filter(
-        user=user, 
-        listing_type='REQUEST',
-        is_active=True
-    )
-    
-    # Get user's offers
-    user_offers = ServiceListing.objects.filter(
-        user=user,
-        listing_type='OFFER',
-        is_active=True
-    )
-    
-    # Find matching offers for user's requests
-    matching_offers = []
-    for req in user_requests:
-        skills = req.skills.all()
-        matches = ServiceListing.objects.filter(
-            listing_type='OFFER',
-            is_active=True,
-            skills__in=skills
-        ).exclude(user=user).distinct().select_related('user__profile')
-        
-        for match in matches:
-            distance = calculate_distance(
-                user_lat, user_lon,
-                match.user.profile.latitude, match.user.profile.longitude
-            )
-            matching_offers.append({
-                'request': req,
-                'offer': match,
-                'match_score': len(set(req.skills.all()) & set(match.skills.all())),
-                'distance': distance,
-                'distance_display': f"{distance:.1f} km" if distance != float('inf') else "Location not set"
-            })
-    
-    # Find matching requests for user's offers
-    matching_requests = []
-    for offer in user_offers:
-        skills = offer.skills.all()
-        matches = ServiceListing.objects.filter(
-            listing_type='REQUEST',
-            is_active=True,
-            skills__in=skills
-        ).exclude(user=user).distinct().select_related('user__profile')
-        
-        for match in matches:
-            distance = calculate_distance(
-                user_lat, user_lon,
-                match.user.profile.latitude, match.user.profile.longitude
-            )
-            matching_requests.append({
-                'offer': offer,
-                'request': match,
-                'match_score': len(set(offer.skills.all()) & set(match.skills.all())),
-                'distance': distance,
-                'distance_display': f"{distance:.1f} km" if distance != float('inf') else "Location not set"
-            })
-    
-    # Sort by distance first, then by match score
-    matching_offers.sort(key=lambda x: (x['distance'], -x['match_score']))
-    matching_requests.sort(key=lambda x: (x['distance'], -x['match_score']))
-    
+
+    matches = ListingMatch.objects.filter(
+        listing__user=user, listing__is_active=True, matched_listing__is_active=True
+    ).select_related(
+        'listing', 'matched_listing__user__profile'
+    ).order_by(F('distance_km').asc(nulls_last=True), '-score', 'pk')
+
     context = {
-        'matching_offers': matching_offers[:10],
-        'matching_requests': matching_requests[:10],
-        'has_location': user_lat is not None and user_lon is not None,
+        'matching_offers': _match_entries(matches.filter(listing__listing_type='REQUEST')[:10], 'request', 'offer'),
+        'matching_requests': _match_entries(matches.filter(listing__listing_type='OFFER')[:10], 'offer', 'request'),
+        'has_location': user_profile.latitude is not None and user_profile.longitude is not None,
     }
     return render(request, 'matching/results.html', context)
 
 # ============== MESSAGING & NOTIFICATIONS ==============
 @login_required
+@query_budget(6)
 def inbox(request):
     """View all conversations"""
-    # Get all conversations where user is a participant
-    conversations = Conversation.objects.filter(
-        Q(participant1=request.user) | Q(participant2=request.user)
-    ).select_related('participant1', 'participant2', 'listing').prefetch_related('messages')
+    # Get all conversations where user is a participant (one indexed lookup on the membership table)
+    conversations = list(Conversation.objects.filter(
+        members__user=request.user
+    ).select_related(
+        'participant1__profile', 'participant2__profile', 'listing'
+    ).annotate(
+        has_unread=Exists(Message.objects.filter(
+            conversation=OuterRef('pk'), recipient=request.user, is_read=False
+        )),
+        last_message_id=Subquery(
+            Message.objects.filter(conversation=OuterRef('pk')).order_by('-id').values('id')[:1]
+        ),
+    ))
+    last_messages = Message.objects.in_bulk([conv.last_message_id for conv in conversations if conv.last_message_id])
     
     conversation_list = []
     for conv in conversations:
         other_user = conv.get_other_user(request.user)
-        last_message = conv.get_last_message()
+        last_message = last_messages.get(conv.last_message_id)
         conversation_list.append({
             'conversation': conv,
             'other_user': other_user,
             'last_message': last_message,
-            'has_unread': conv.has_unread_for(request.user),
+            'has_unread': conv.has_unread,
         })
     
     context = {
@@ -619,10 +677,80 @@ def inbox(request):
     }
     return render(request, 'messages/inbox.html', context)
 
+def _message_page(conversation, before_id=None, after_id=None):
+    """
+    One page of a thread in chronological order, plus whether more messages lie beyond it.
+    Without a cursor this is the latest page; before_id pages back through older
+    messages (into the archive once the live ones run out) and after_id fetches
+    the ones that arrived since.
+    """
+    limit = settings.CONVERSATION_PAGE_SIZE
+    thread = conversation.messages.order_by()
+    if after_id is not None:
+        page = list(thread.filter(id__gt=after_id).order_by('id')[:limit + 1])
+        return page[:limit], len(page) > limit
+    if before_id is not None:
+        thread = thread.filter(id__lt=before_id)
+    page = list(thread.order_by('-id')[:limit + 1])
+    if conversation.archived_up_to and (len(page) <= limit or page[-1].pk < conversation.archived_up_to):
+        # The page reaches back into archived messages (or messages kept live sit among them)
+        page = sorted(page + archived_messages(conversation, before_id, limit + 1),
+                      key=attrgetter('pk'), reverse=True)[:limit + 1]
+    return page[:limit][::-1], len(page) > limit
+
+def _message_page_json(request, conversation, thread_messages, has_more):
+    html = render_to_string('messages/_message_list.html', {
+        'thread_messages': thread_messages,
+        'conversation': conversation,
+    }, request=request)
+    return JsonResponse({
+        'html': html,
+        'count': len(thread_messages),
+        'first_id': thread_messages[0].pk if thread_messages else None,
+        'last_id': thread_messages[-1].pk if thread_messages else None,
+        'has_more': has_more,
+    })
+
+def _cursor(params, name):
+    try:
+        return int(params[name]) if name in params else None
+    except ValueError:
+        return None
+
+def _notify_new_message(conversation_pk, sender_username, recipient_pk):
+    Notification.objects.create(
+        user_id=recipient_pk,
+        notification_type='MESSAGE',
+        message=f"{sender_username} sent you a message",
+        link=f"/messages/conversation/{conversation_pk}/"
+    )
+
+def _send_message(conversation, message, sender, recipient):
+    """
+    Save an unsaved message from sender to recipient. The message INSERT and the
+    conversation's timestamp bump are one transaction. The recipient's notification is
+    written once that has committed, so it cannot slow down or roll back the send.
+    """
+    message.conversation = conversation
+    message.sender = sender
+    message.recipient = recipient
+    if message.requires_response:
+        message.response_status = 'PENDING'
+    
+    with transaction.atomic():
+        message.save()
+        Conversation.objects.filter(pk=conversation.pk).update(updated_at=message.created_at)
+        transaction.on_commit(
+            partial(_notify_new_message, conversation.pk, sender.username, recipient.pk), robust=True
+        )
+    return message
+
 @login_required
+@rate_limit('messages', methods=('POST',))
+@query_budget(10)
 def conversation_detail(request, pk):
     """View a conversation thread and send messages"""
-    conversation = get_object_or_404(Conversation, pk=pk)
+    conversation = get_object_or_404(Conversation.objects.select_related('participant1', 'participant2', 'listing'), pk=pk)
     
     # Check permission
     if request.user not in [conversation.participant1, conversation.participant2]:
@@ -636,44 +764,105 @@ def conversation_detail(request, pk):
     
     # Handle new message submission
     if request.method == 'POST':
+        # Plain form post, for browsers without JavaScript; the page itself uses conversation_send
         form = MessageForm(request.POST)
         if form.is_valid():
-            message = form.save(commit=False)
-            message.conversation = conversation
-            message.sender = request.user
-            message.recipient = other_user
-            if message.requires_response:
-                message.response_status = 'PENDING'
-            message.save()
-            
-            # Update conversation timestamp
-            conversation.save()  # This triggers auto_now update
-            
-            # Create notification for recipient
-            Notification.objects.create(
-                user=other_user,
-                notification_type='MESSAGE',
-                message=f"{request.user.username} sent you a message",
-                link=f"/messages/conversation/{conversation.pk}/"
-            )
-            
+            _send_message(conversation, form.save(commit=False), request.user, other_user)
             messages.success(request, 'Message sent!')
             return redirect('conversation_detail', pk=pk)
     else:
         form = MessageForm()
     
-    # Get all messages in conversation
-    conversation_messages = conversation.messages.all()
+    # Only the latest page; older messages are fetched on demand from conversation_history
+    thread_messages, has_older = _message_page(conversation)
     
     context = {
         'conversation': conversation,
         'other_user': other_user,
-        'messages': conversation_messages,
+        'thread_messages': thread_messages,
+        'has_older': has_older,
         'form': form,
     }
     return render(request, 'messages/conversation.html', context)
 
 @login_required
+@query_budget(6)
+def conversation_history(request, pk):
+    """JSON page of a thread: older messages with ?before_id=, newer ones with ?after_id="""
+    conversation = get_object_or_404(Conversation, pk=pk)
+    if request.user.id not in (conversation.participant1_id, conversation.participant2_id):
+        return JsonResponse({'error': 'You do not have permission to view this conversation.'}, status=403)
+    
+    before_id, after_id = _cursor(request.GET, 'before_id'), _cursor(request.GET, 'after_id')
+    thread_messages, has_more = _message_page(conversation, before_id=before_id, after_id=after_id)
+    
+    if after_id is not None and thread_messages:
+        # New arrivals are being shown to the reader now; those beyond this page are not yet
+        conversation.messages.filter(
+            id__gt=after_id, id__lte=thread_messages[-1].pk, recipient=request.user, is_read=False
+        ).update(is_read=True)
+    
+    return _message_page_json(request, conversation, thread_messages, has_more)
+
+@login_required
+@require_POST
+@rate_limit('messages')
+@query_budget(9)
+def conversation_send(request, pk):
+    """JSON send: store the message and return every message the sender does not have yet"""
+    conversation = get_object_or_404(Conversation.objects.select_related('participant1', 'participant2'), pk=pk)
+    if request.user.id not in (conversation.participant1_id, conversation.participant2_id):
+        return JsonResponse({'error': 'You do not have permission to view this conversation.'}, status=403)
+    
+    form = MessageForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    
+    message = _send_message(conversation, form.save(commit=False), request.user,
+                            conversation.get_other_user(request.user))
+    
+    # The new message plus anything that arrived since the sender's last known message
+    after_id = _cursor(request.POST, 'after_id')
+    thread_messages, has_more = _message_page(
+        conversation, after_id=after_id if after_id is not None else message.pk - 1
+    )
+    return _message_page_json(request, conversation, thread_messages, has_more)
+
+@login_required
+@query_budget(8)
+def message_search(request):
+    """Search the bodies of the user's messages, best matches first"""
+    query = request.GET.get('q', '').strip()
+    terms = query_terms(query)
+    
+    page = None
+    results = []
+    if terms:
+        page = Paginator(ranked_message_ids(request.user, terms), 20).get_page(request.GET.get('page'))
+        found = Message.objects.select_related(
+            'conversation__participant1', 'conversation__participant2', 'conversation__listing'
+        ).in_bulk([hit['message_id'] for hit in page])
+        for hit in page:
+            message = found.get(hit['message_id'])
+            if message is None or message.conversation is None:
+                continue
+            results.append({
+                'message': message,
+                'other_user': message.conversation.get_other_user(request.user),
+                'snippet': snippet(message.body, terms),
+                'matched': hit['matched'],
+            })
+    
+    context = {
+        'query': query,
+        'terms': terms,
+        'results': results,
+        'page': page,
+    }
+    return render(request, 'messages/search.html', context)
+
+@login_required
+@rate_limit('conversations')
 def start_conversation(request, username=None, listing_id=None):
     """Start a new conversation or redirect to existing one"""
     recipient = None
@@ -689,22 +878,11 @@ def start_conversation(request, username=None, listing_id=None):
         messages.error(request, 'Invalid recipient.')
         return redirect('inbox')
     
-    # Check if conversation already exists
-    existing_conv = Conversation.objects.filter(
-        Q(participant1=request.user, participant2=recipient) |
-        Q(participant1=recipient, participant2=request.user),
-        listing=listing
-    ).first()
-    
-    if existing_conv:
-        return redirect('conversation_detail', pk=existing_conv.pk)
-    
-    # Create new conversation
-    conversation = Conversation.objects.create(
-        participant1=request.user,
-        participant2=recipient,
-        listing=listing
-    )
+    # Reuse the existing thread, whichever of the two started it
+    conversation, created = Conversation.get_or_create_between(request.user, recipient, listing)
+    
+    if not created:
+        return redirect('conversation_detail', pk=conversation.pk)
     
     # If there's a listing, send initial message
     if listing:
@@ -729,52 +907,34 @@ def start_conversation(request, username=None, listing_id=None):
 @login_required
 def respond_to_message(request, pk, action):
     """Accept or decline a message request"""
-    message = get_object_or_404(Message, pk=pk, recipient=request.user)
+    message = get_object_or_404(Message.objects.select_related('sender', 'conversation'), pk=pk, recipient=request.user)
     
     if not message.requires_response:
         messages.error(request, 'This message does not require a response.')
-        return redirect('conversation_detail', pk=message.conversation.pk)
+        return redirect('conversation_detail', pk=message.conversation_id)
+    
+    if action not in ('accept', 'decline'):
+        return redirect('conversation_detail', pk=message.conversation_id)
+    
+    status = 'ACCEPTED' if action == 'accept' else 'DECLINED'
+    link = f"/messages/conversation/{message.conversation_id}/"
+    with transaction.atomic():
+        # Only the first answer counts, however often the link is clicked
+        if not Message.objects.filter(pk=message.pk, response_status='PENDING').update(response_status=status):
+            messages.error(request, 'You have already responded to this request.')
+            return redirect('conversation_detail', pk=message.conversation_id)
+        
+        # Notify the sender (and confirm in the thread) once this has committed
+        notify(message.sender, 'LISTING_RESPONSE', f"{request.user.username} {status.lower()} your request", link)
+        if action == 'accept':
+            post_message(message.conversation, request.user, message.sender, "✓ I have accepted your request!")
     
     if action == 'accept':
-        message.response_status = 'ACCEPTED'
-        message.save()
-        
-        # Create notification for sender
-        Notification.objects.create(
-            user=message.sender,
-            notification_type='LISTING_RESPONSE',
-            message=f"{request.user.username} accepted your request",
-            link=f"/messages/conversation/{message.conversation.pk}/"
-        )
-        
-        # Send confirmation message back
-        Message.objects.create(
-            conversation=message.conversation,
-            sender=request.user,
-            recipient=message.sender,
-            body=f"✓ I have accepted your request!"
-        )
-        
-        # Update conversation timestamp
-        message.conversation.save()
-        
         messages.success(request, 'Request accepted!')
-        
-    elif action == 'decline':
-        message.response_status = 'DECLINED'
-        message.save()
-        
-        # Create notification for sender
-        Notification.objects.create(
-            user=message.sender,
-            notification_type='LISTING_RESPONSE',
-            message=f"{request.user.username} declined your request",
-            link=f"/messages/conversation/{message.conversation.pk}/"
-        )
-        
+    else:
         messages.info(request, 'Request declined.')
     
-    return redirect('conversation_detail', pk=message.conversation.pk)
+    return redirect('conversation_detail', pk=message.conversation_id)
 
 @login_required
 def request_credits(request, conversation_pk):
@@ -804,18 +964,13 @@ def request_credits(request, conversation_pk):
             credit_message.recipient = other_user
             credit_message.is_credit_request = True
             credit_message.credit_status = 'PENDING'
-            credit_message.save()
-            
-            # Update conversation timestamp
-            conversation.save()
             
-            # Create notification
-            Notification.objects.create(
-                user=other_user,
-                notification_type='CREDIT_RECEIVED',
-                message=f"{request.user.username} requested {credit_amount} credits from you",
-                link=f"/messages/conversation/{conversation.pk}/"
-            )
+            with transaction.atomic():
+                credit_message.save()
+                Conversation.objects.filter(pk=conversation.pk).update(updated_at=credit_message.created_at)
+                notify(other_user, 'CREDIT_RECEIVED',
+                       f"{request.user.username} requested {credit_amount} credits from you",
+                       f"/messages/conversation/{conversation.pk}/")
             
             messages.success(request, f'Credit request for {credit_amount} hours sent to {other_user.username}!')
             return redirect('conversation_detail', pk=conversation_pk)
@@ -833,74 +988,43 @@ def request_credits(request, conversation_pk):
 def respond_to_credit_request(request, message_pk, action):
     """Accept or decline a credit request"""
     credit_message = get_object_or_404(Message, pk=message_pk, recipient=request.user, is_credit_request=True)
+    conversation_pk = credit_message.conversation_id
+    link = f"/messages/conversation/{conversation_pk}/"
     
-    if not credit_message.is_credit_request or credit_message.credit_status != 'PENDING':
-        messages.error(request, 'Invalid credit request.')
-        return redirect('conversation_detail', pk=credit_message.conversation.pk)
+    if action not in ('accept', 'decline'):
+        return redirect('conversation_detail', pk=conversation_pk)
     
-    if action == 'accept':
-        # Check if user still has enough credits
-        if request.user.profile.time_credits < credit_message.credit_amount:
-            messages.error(request, f'You do not have enough credits. You have {request.user.profile.time_credits} but need {credit_message.credit_amount}.')
-            return redirect('conversation_detail', pk=credit_message.conversation.pk)
-        
-        # Transfer credits
-        sender_profile = credit_message.sender.profile
-        recipient_profile = request.user.profile
-        
-        recipient_profile.time_credits -= credit_message.credit_amount
-        sender_profile.time_credits += credit_message.credit_amount
-        recipient_profile.save()
-        sender_profile.save()
-        
-        # Create transaction record
-        Transaction.objects.create(
-            sender=request.user,
-            recipient=credit_message.sender,
-            amount=credit_message.credit_amount,
-            description=credit_message.body
-        )
-        
-        # Update message status
-        credit_message.credit_status = 'ACCEPTED'
-        credit_message.save()
-        
-        # Send confirmation message
-        Message.objects.create(
-            conversation=credit_message.conversation,
-            sender=request.user,
-            recipient=credit_message.sender,
-            body=f"✓ I've sent you {credit_message.credit_amount} credits!"
-        )
-        
-        # Update conversation
-        credit_message.conversation.save()
-        
-        # Create notification
-        Notification.objects.create(
-            user=credit_message.sender,
-            notification_type='CREDIT_RECEIVED',
-            message=f"{request.user.username} sent you {credit_message.credit_amount} credits!",
-            link=f"/messages/conversation/{credit_message.conversation.pk}/"
-        )
-        
-        messages.success(request, f'Successfully sent {credit_message.credit_amount} credits to {credit_message.sender.username}!')
-        
-    elif action == 'decline':
-        credit_message.credit_status = 'DECLINED'
-        credit_message.save()
-        
-        # Create notification
-        Notification.objects.create(
-            user=credit_message.sender,
-            notification_type='CREDIT_RECEIVED',
-            message=f"{request.user.username} declined your credit request",
-            link=f"/messages/conversation/{credit_message.conversation.pk}/"
-        )
+    with transaction.atomic():
+        # Re-read under a row lock so a double submit cannot pay the same request twice
+        credit_message = Message.objects.select_for_update().select_related('sender', 'conversation').get(pk=credit_message.pk)
+        if credit_message.credit_status != 'PENDING':
+            messages.error(request, 'Invalid credit request.')
+            return redirect('conversation_detail', pk=conversation_pk)
+        amount = credit_message.credit_amount
         
+        if action == 'accept':
+            transfer = Transaction(sender=request.user, receiver=credit_message.sender,
+                                   amount=amount, description=credit_message.body[:255])
+            if not _record_transfer(transfer, link):
+                messages.error(request, f'You do not have enough credits. You have {request.user.profile.time_credits} but need {amount}.')
+                return redirect('conversation_detail', pk=conversation_pk)
+            credit_message.credit_status = 'ACCEPTED'
+            credit_message.save(update_fields=['credit_status'])
+            
+            post_message(credit_message.conversation, request.user, credit_message.sender,
+                         f"✓ I've sent you {amount} credits!")
+        else:
+            credit_message.credit_status = 'DECLINED'
+            credit_message.save(update_fields=['credit_status'])
+            
+            notify(credit_message.sender, 'CREDIT_RECEIVED', f"{request.user.username} declined your credit request", link)
+    
+    if action == 'accept':
+        messages.success(request, f'Successfully sent {amount} credits to {credit_message.sender.username}!')
+    else:
         messages.info(request, 'Credit request declined.')
     
-    return redirect('conversation_detail', pk=credit_message.conversation.pk)
+    return redirect('conversation_detail', pk=conversation_pk)
 
 @login_required
 def notifications(request):
@@ -934,38 +1058,32 @@ def respond_to_borrow_request(request, borrow_id, action):
     """Accept or decline a tool borrow request"""
     borrow_request = get_object_or_404(ToolBorrow, pk=borrow_id, tool__owner=request.user)
     
-    if borrow_request.status != 'PENDING':
-        messages.error(request, 'This request has already been processed.')
+    if action not in ('accept', 'decline'):
         return redirect('notifications')
     
-    if action == 'accept':
-        borrow_request.status = 'APPROVED'
-        borrow_request.tool.is_available = False
-        borrow_request.tool.save()
-        borrow_request.save()
-        
-        # Create notification for borrower
-        Notification.objects.create(
-            user=borrow_request.borrower,
-            notification_type='TOOL_APPROVED',
-            message=f"{request.user.username} approved your request to borrow {borrow_request.tool.name}",
-            link=f"/tools/{borrow_request.tool.pk}/"
-        )
-        
-        messages.success(request, f'Approved! {borrow_request.tool.name} is now marked as unavailable.')
-        
-    elif action == 'decline':
-        borrow_request.status = 'REJECTED'
-        borrow_request.save()
-        
-        # Create notification for borrower
-        Notification.objects.create(
-            user=borrow_request.borrower,
-            notification_type='TOOL_APPROVED',
-            message=f"{request.user.username} declined your request to borrow {borrow_request.tool.name}",
-            link=f"/tools/{borrow_request.tool.pk}/"
-        )
+    with transaction.atomic():
+        # Re-read under a row lock so the request is only ever answered once
+        borrow_request = ToolBorrow.objects.select_for_update().select_related('tool', 'borrower').get(pk=borrow_request.pk)
+        if borrow_request.status != 'PENDING':
+            messages.error(request, 'This request has already been processed.')
+            return redirect('notifications')
         
+        tool = borrow_request.tool
+        if action == 'accept':
+            borrow_request.status = 'APPROVED'
+            tool.is_available = False
+            tool.save(update_fields=['is_available'])
+            notify(borrow_request.borrower, 'TOOL_APPROVED',
+                   f"{request.user.username} approved your request to borrow {tool.name}", f"/tools/{tool.pk}/")
+        else:
+            borrow_request.status = 'REJECTED'
+            notify(borrow_request.borrower, 'TOOL_APPROVED',
+                   f"{request.user.username} declined your request to borrow {tool.name}", f"/tools/{tool.pk}/")
+        borrow_request.save(update_fields=['status'])
+    
+    if action == 'accept':
+        messages.success(request, f'Approved! {tool.name} is now marked as unavailable.')
+    else:
         messages.info(request, 'Request declined.')
     
     return redirect('notifications')
@@ -977,8 +1095,15 @@ def map_view(request):
     """Display map with nearby users, services, tools, and events"""
     return render(request, 'map/view.html')
 
+@rate_limit('map')
+@query_budget(4)
 def map_data(request):
     """API endpoint to return map markers data"""
+    # Every visitor sees the same markers, so the payload is shared until a profile, listing or tool changes
+    return JsonResponse(cached('map', ['markers'], _map_markers, timeout=60))
+
+def _map_markers():
+    """Build the marker payload served by map_data"""
     # Get all profiles with coordinates
     profiles = Profile.objects.filter(
         latitude__isnull=False, 
@@ -1000,12 +1125,6 @@ def map_data(request):
         owner__profile__longitude__isnull=False
     ).select_related('owner__profile')
     
-    # Get upcoming events with coordinates (if event has location coords)
-    events = Event.objects.filter(
-        is_active=True,
-        event_date__gte=timezone.now()
-    )[:20]
-    
     data = {
         'users': [
             {
@@ -1044,9 +1163,11 @@ def map_data(request):
         ],
     }
     
-    return JsonResponse(data)
+    return data
 
 @login_required
+@rate_limit('updates')
+@query_budget(6)
 def check_updates(request):
     """API endpoint to check for new messages and notifications"""
     # Get unread messages count
@@ -1099,3 +1220,34 @@ def check_updates(request):
     
     return JsonResponse(data)
 
+# ============== ANALYTICS ==============
+def _analytics_weeks(request):
+    try:
+        return min(max(int(request.GET.get('weeks', 12)), 1), 104)
+    except ValueError:
+        return 12
+
+@staff_member_required
+@query_budget(7)
+def analytics(request):
+    """Community analytics for organizers, read from the daily rollups (see myapp/rollups.py)"""
+    weeks = _analytics_weeks(request)
+    return render(request, 'analytics/dashboard.html', {
+        'summary': rollups.summary(weeks),
+        'weeks': weeks,
+        'week_options': [4, 12, 26, 52],
+    })
+
+@staff_member_required
+@query_budget(6)
+def analytics_data(request):
+    """The analytics page's numbers as JSON"""
+    return JsonResponse(rollups.summary(_analytics_weeks(request)))
+
+# ============== INSTRUMENTATION ==============
+@staff_member_required
+def metrics_summary(request):
+    """Rolling query counts and latency percentiles per view and template, and rate limit hits (this worker process only)"""
+    return JsonResponse({
+        'views': registry.summary(), 'templates': registry.template_summary(), 'rate_limits': rate_limit_stats.summary(),
+    })
@@ -0,0 +1,78 @@
+// Polls /api/check-updates/ for the unread badges and desktop notifications.
+// base.html passes the page-specific values as data-* attributes on the script tag.
+(function () {
+    const config = document.currentScript.dataset;
+
+    // Request notification permission on page load
+    if ('Notification' in window && Notification.permission === 'default') {
+        // Show a friendly prompt first
+        setTimeout(() => {
+            if (confirm('Enable desktop notifications to get alerts for new messages and activity?')) {
+                Notification.requestPermission();
+            }
+        }, 2000);
+    }
+
+    function updateBadge(badgeClass, linkHref, count) {
+        const badge = document.querySelector('.' + badgeClass);
+        if (count > 0) {
+            if (!badge) {
+                const link = document.querySelector(`a[href="${linkHref}"]`);
+                if (link) {
+                    const newBadge = document.createElement('span');
+                    newBadge.className = 'badge bg-danger rounded-pill ms-1 ' + badgeClass;
+                    newBadge.textContent = count;
+                    link.appendChild(newBadge);
+                }
+            } else {
+                badge.textContent = count;
+            }
+        } else if (badge) {
+            badge.remove();
+        }
+    }
+
+    function showNotification(title, body, tag, target) {
+        if (!('Notification' in window) || Notification.permission !== 'granted') {
+            return;
+        }
+        const notification = new Notification(title, {
+            body: body,
+            icon: config.icon,
+            tag: tag,
+            requireInteraction: false
+        });
+
+        notification.onclick = function () {
+            window.focus();
+            window.location.href = target;
+            notification.close();
+        };
+    }
+
+    // Check for new messages and notifications
+    function checkForUpdates() {
+        fetch(config.updatesUrl)
+            .then(response => response.json())
+            .then(data => {
+                updateBadge('message-badge', config.inboxUrl, data.unread_messages);
+                if (data.unread_messages > 0 && data.new_message) {
+                    showNotification('💬 New Message', `${data.new_message.sender}: ${data.new_message.body}`,
+                                     'message-notification', config.inboxUrl);
+                }
+
+                updateBadge('notification-badge', config.notificationsUrl, data.unread_notifications);
+                if (data.unread_notifications > 0 && data.new_notification) {
+                    showNotification('🔔 New Notification', data.new_notification.message,
+                                     'app-notification', config.notificationsUrl);
+                }
+            })
+            .catch(error => console.log('Update check failed:', error));
+    }
+
+    // Check for updates every 30 seconds
+    setInterval(checkForUpdates, 30000);
+
+    // Check immediately on load
+    checkForUpdates();
+})();